@@ -0,0 +1,282 @@
+"""
+Async (ASGI) serving mode.
+
+The same endpoints as app.py, with async handlers on Starlette, so one process holds
+many in-flight requests while OpenAI and Monday.com calls are waiting on the network.
+Webhook jobs run as asyncio tasks (AsyncWorkerPool) on the async OpenAI and Monday
+clients instead of one thread per job; the SQLite queue, cache and schema files are
+shared with the sync app.
+
+usage: gunicorn -k uvicorn.workers.UvicornWorker -w 2 --chdir src asgi_app:app
+"""
+import asyncio
+import json
+import logging
+import os
+from contextlib import asynccontextmanager
+from datetime import datetime
+
+from starlette.applications import Starlette
+from starlette.concurrency import iterate_in_threadpool
+from starlette.middleware import Middleware
+from starlette.middleware.base import BaseHTTPMiddleware
+from starlette.middleware.cors import CORSMiddleware
+from starlette.responses import HTMLResponse, JSONResponse, Response, StreamingResponse
+from starlette.routing import Route
+
+# First, so the .env values are in the environment before the other modules read it
+from config import settings
+from board_config import board_config_stats
+from board_schema import SCHEMA_CHANGE_EVENTS, invalidate_board_schema
+from job_queue import DUPLICATE, AsyncWorkerPool, JobQueue, webhook_event_id
+from main_2 import m_async, sse_event, stream_email
+from model_clients import close_async_openai_client, openai_readiness
+from monday_client import close_async_monday_clients, monday_stats
+from monday_pipeline import process_monday_item_async
+from model_routing import route_stats
+from resilience import DependencyUnavailable, resilience_stats
+from response_cache import get_response_cache
+from telemetry import WEBHOOKS, metrics_response, new_request_id, request_id_var, setup_logging
+from warmup import is_ready, warm_up_async, warmup_stats
+from webhook_auth import (
+    INVALID_SIGNATURE,
+    TOO_LARGE,
+    WEBHOOK_MAX_BYTES,
+    check_webhook_request,
+    client_address,
+    is_challenge,
+)
+
+ENV = settings.env
+SYSTEM_INSTRUCTIONS_PATH = settings.system_instructions_path
+os.makedirs(settings.log_dir, exist_ok=True)
+
+logger = setup_logging(settings.log_file_path)
+
+job_queue = JobQueue()
+job_workers = AsyncWorkerPool(job_queue, lambda item_id: process_monday_item_async(item_id, settings.monday_api_key))
+
+
+async def add_headers(request, call_next):
+    """Request id for the log lines of this request, plus the security headers app.py sets"""
+    token = request_id_var.set(request.headers.get('X-Request-ID') or new_request_id())
+    try:
+        response = await call_next(request)
+    finally:
+        request_id = request_id_var.get()
+        request_id_var.reset(token)
+    response.headers['X-Request-ID'] = request_id
+    response.headers['X-Content-Type-Options'] = 'nosniff'
+    response.headers['X-Frame-Options'] = 'DENY'
+    response.headers['X-XSS-Protection'] = '1; mode=block'
+    return response
+
+
+async def dev_request_text(request):
+    """(text, None) of a test endpoint's JSON body, or (None, error response) when it may not be used or is invalid"""
+    if ENV != 'development':
+        logger.warning(f"Attempt to access test endpoint in {ENV} environment")
+        return None, JSONResponse({
+            'error': 'This endpoint is only available in development environment'
+        }, status_code=403)
+
+    try:
+        data = await request.json()
+    except ValueError:
+        return None, JSONResponse({'error': 'Invalid JSON'}, status_code=400)
+    text = data.get('text', '') if isinstance(data, dict) else None
+    if not isinstance(text, str):
+        return None, JSONResponse({'error': "Expected a string in 'text'"}, status_code=400)
+    return text, None
+
+
+async def trigger_service(request):
+    text, error_response = await dev_request_text(request)
+    if error_response is not None:
+        return error_response
+    try:
+        return HTMLResponse(await m_async(text))
+    except DependencyUnavailable as e:
+        return JSONResponse({'error': str(e)}, status_code=503, headers={'Retry-After': str(int(e.retry_after or 1))})
+
+
+async def trigger_service_stream(request):
+    """Same as /questionandanswers, streamed as server-sent events: delta, email, verification, then done"""
+    text, error_response = await dev_request_text(request)
+    if error_response is not None:
+        return error_response
+
+    def events():
+        logger.info("Streaming the main service")
+        try:
+            for event, data in stream_email(text):
+                yield sse_event(event, data)
+        except Exception as e:
+            logger.exception("Streaming generation failed:")
+            yield sse_event('error', {'message': str(e)})
+        yield sse_event('done', {})
+
+    # stream_email runs on the sync OpenAI client: each event is pulled in a worker thread
+    return StreamingResponse(
+        iterate_in_threadpool(events()),
+        media_type='text/event-stream',
+        # Keep proxies (nginx) from buffering the stream
+        headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'}
+    )
+
+
+def rejected_response(rejected) -> JSONResponse:
+    WEBHOOKS.labels(outcome='rejected').inc()
+    status, error = rejected
+    return JSONResponse({'error': error}, status_code=status)
+
+
+async def read_body(request, limit: int):
+    """The request body, or None as soon as it is larger than limit (Content-Length may be missing)"""
+    body = bytearray()
+    async for chunk in request.stream():
+        body += chunk
+        if len(body) > limit:
+            return None
+    return bytes(body)
+
+
+async def monday_webhook(request):
+    if request.method == 'OPTIONS':
+        return Response('', status_code=200)
+
+    # Address, size and signature come from the headers: rejected requests are never read or parsed,
+    # except that a request without a valid signature may still be a challenge (see webhook_auth)
+    client_ip = client_address(request.headers.get('X-Forwarded-For'), request.client.host if request.client else '')
+    content_length = request.headers.get('Content-Length')
+    rejected = check_webhook_request(client_ip, request.headers.get('Authorization'),
+                                     int(content_length) if content_length and content_length.isdigit() else None)
+    if rejected is not None and rejected != INVALID_SIGNATURE:
+        return rejected_response(rejected)
+
+    body = await read_body(request, WEBHOOK_MAX_BYTES)
+    if body is None:
+        return rejected_response(TOO_LARGE)
+    raw_data = body.decode('utf-8', errors='replace')
+    try:
+        data = json.loads(raw_data) if raw_data else {}
+    except ValueError:
+        data = None
+
+    # Not documented to be signed, so answered without the JWT (see webhook_auth)
+    if is_challenge(data):
+        return JSONResponse({'challenge': data['challenge']})
+    if rejected is not None:
+        return rejected_response(rejected)
+    if data is None:
+        return JSONResponse({'error': 'Invalid JSON'}, status_code=400)
+    if not isinstance(data, dict):
+        return JSONResponse({'error': 'Expected a JSON object'}, status_code=400)
+
+    event = data.get('event') or {}
+    if not isinstance(event, dict):
+        return JSONResponse({'error': 'Expected a JSON object'}, status_code=400)
+
+    try:
+        if event.get('type') in SCHEMA_CHANGE_EVENTS and event.get('boardId'):
+            invalidate_board_schema(event['boardId'])
+            WEBHOOKS.labels(outcome='schema_change').inc()
+            return JSONResponse({'status': 'success'})
+
+        if 'pulseId' in event:
+            item_id = event['pulseId']
+            event_id = webhook_event_id(data, raw_data)
+            job_id, outcome = await asyncio.to_thread(job_queue.enqueue, item_id, event_id=event_id)
+            WEBHOOKS.labels(outcome=outcome).inc()
+            logger.info(f"Webhook for item {item_id} {outcome} as job {job_id}",
+                        extra={'item_id': str(item_id), 'job_id': job_id, 'event_id': event_id})
+            return JSONResponse({'status': outcome, 'job_id': job_id}, status_code=200 if outcome == DUPLICATE else 202)
+
+        return JSONResponse({'status': 'success'})
+
+    except Exception as e:
+        logger.exception(f"Error in webhook handler: {str(e)}")
+        # The details stay in the log, not in the response
+        return JSONResponse({'error': 'Internal server error'}, status_code=500)
+
+
+async def job_status(request):
+    job = await asyncio.to_thread(job_queue.get, request.path_params['job_id'])
+    if job is None:
+        return JSONResponse({'error': 'Job not found'}, status_code=404)
+    return JSONResponse(job)
+
+
+async def health_check(request):
+    try:
+        if not os.path.exists(SYSTEM_INSTRUCTIONS_PATH):
+            return JSONResponse({
+                'status': 'error',
+                'message': 'System instructions file not found'
+            }, status_code=500)
+
+        if not is_ready():
+            return JSONResponse({'status': 'warming', 'warmup': warmup_stats()}, status_code=503)
+
+        openai_status = openai_readiness()
+        if openai_status['status'] == 'error':
+            return JSONResponse({
+                'status': 'error',
+                'message': f"OpenAI API not reachable: {openai_status['error']}",
+                'openai': openai_status
+            }, status_code=500)
+
+        cache = get_response_cache()
+        resilience = resilience_stats()
+        degraded = any(circuit['state'] != 'closed' for circuit in resilience['circuits'].values())
+        return JSONResponse({
+            'status': 'degraded' if degraded else 'healthy',
+            'environment': ENV,
+            'server': 'asgi',
+            'timestamp': datetime.utcnow().isoformat(),
+            'openai': openai_status,
+            'monday': monday_stats(),
+            'resilience': resilience,
+            'model_routes': route_stats(),
+            'board_config': board_config_stats(),
+            'warmup': warmup_stats(),
+            'response_cache': await asyncio.to_thread(cache.stats) if cache is not None else None
+        })
+    except Exception as e:
+        logger.error(f"Health check failed: {str(e)}")
+        return JSONResponse({'status': 'error', 'message': str(e)}, status_code=500)
+
+
+async def metrics(request):
+    body, content_type = metrics_response()
+    return Response(body, headers={'Content-Type': content_type})
+
+
+@asynccontextmanager
+async def lifespan(app):
+    settings.require('OPENAI_API_KEY', 'MONDAY_API_KEY', 'MONDAY_AID')
+    job_workers.start()
+    # Serving starts right away, /health answers 503 until the warm-up is done
+    warm_up_task = asyncio.create_task(warm_up_async())
+    yield
+    warm_up_task.cancel()
+    await job_workers.stop(timeout=30)
+    await close_async_monday_clients()
+    await close_async_openai_client()
+
+
+app = Starlette(
+    routes=[
+        Route('/questionandanswers', trigger_service, methods=['POST']),
+        Route('/questionandanswers/stream', trigger_service_stream, methods=['POST']),
+        Route('/monday-webhook', monday_webhook, methods=['POST', 'PUT', 'OPTIONS']),
+        Route('/jobs/{job_id}', job_status, methods=['GET']),
+        Route('/health', health_check, methods=['GET']),
+        Route('/metrics', metrics, methods=['GET']),
+    ],
+    middleware=[
+        Middleware(CORSMiddleware, allow_origins=['*'], allow_methods=['*'], allow_headers=['*']),
+        Middleware(BaseHTTPMiddleware, dispatch=add_headers),
+    ],
+    lifespan=lifespan,
+)
@@ -0,0 +1,293 @@
+"""
+Regenerate the update emails of every item on a Monday.com board.
+
+Pages through the board with one paginated GraphQL query (instead of one
+get_monday_board_and_item_details call per item), generates emails with bounded
+concurrency and writes them back with batched mutations. Finished items are recorded
+in a checkpoint file after every page, so an interrupted run picks up where it stopped.
+
+With --batch-api the emails are generated through the OpenAI Batch API instead
+(see batch_generation.py): cheaper for the quarterly run, but finishes within 24h.
+
+usage: PYTHONPATH=src python3 src/backfill.py <board_id> [--concurrency 8] [--batch-api] [--dry-run]
+"""
+import argparse
+import json
+import logging
+import os
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+# First, so the .env values are in the environment before the other modules read it
+from config import APP_ROOT, settings
+from batch_generation import generate_emails_batch
+from board_config import get_board_config
+from field_classifier import compile_field_classifier
+from monday_client import get_monday_client
+from monday_pipeline import (
+    email_cache_key,
+    format_qa_text,
+    generate_email_content,
+    update_monday_items_email,
+)
+from response_cache import get_response_cache
+
+logger = logging.getLogger(__name__)
+
+ITEM_FIELDS = """
+    id
+    name
+    column_values {
+        id
+        text
+        value
+        type
+    }
+"""
+
+FIRST_PAGE_QUERY = """
+query ($boardId: [ID!], $limit: Int!) {
+    complexity { query after reset_in_x_seconds }
+    boards(ids: $boardId) {
+        id
+        columns {
+            id
+            title
+            type
+        }
+        items_page(limit: $limit) {
+            cursor
+            items {%s}
+        }
+    }
+}
+""" % ITEM_FIELDS
+
+NEXT_PAGE_QUERY = """
+query ($cursor: String!, $limit: Int!) {
+    complexity { query after reset_in_x_seconds }
+    next_items_page(cursor: $cursor, limit: $limit) {
+        cursor
+        items {%s}
+    }
+}
+""" % ITEM_FIELDS
+
+
+def iter_board_pages(board_id: str, api_key: str, page_size: int):
+    """Yield (fields, items) for each page of the board; fields is the board's FieldClassifier."""
+    client = get_monday_client(api_key)
+    data = client.execute(FIRST_PAGE_QUERY, {"boardId": [str(board_id)], "limit": page_size})
+    if data.get('errors') or not (data.get('data') or {}).get('boards'):
+        raise RuntimeError(f"Could not read board {board_id}: {data.get('errors')}")
+
+    board = data['data']['boards'][0]
+    fields = compile_field_classifier(board_id, board['columns'])
+    page = board['items_page']
+    yield fields, page['items']
+
+    while page.get('cursor'):
+        data = client.execute(NEXT_PAGE_QUERY, {"cursor": page['cursor'], "limit": page_size})
+        if data.get('errors'):
+            raise RuntimeError(f"Could not read next page of board {board_id}: {data['errors']}")
+        page = data['data']['next_items_page']
+        yield fields, page['items']
+
+
+def load_checkpoint(path: Path, board_id: str) -> dict:
+    if path.exists():
+        with open(path, 'r', encoding='utf-8') as file:
+            checkpoint = json.load(file)
+        if checkpoint.get('board_id') == str(board_id):
+            logger.info(f"Resuming from {path}: {len(checkpoint['done'])} items already done")
+            return checkpoint
+    return {'board_id': str(board_id), 'done': [], 'failed': {}}
+
+
+def save_checkpoint(path: Path, checkpoint: dict):
+    # Write then rename so an interrupted run never leaves a truncated checkpoint
+    tmp_path = path.with_suffix('.tmp')
+    with open(tmp_path, 'w', encoding='utf-8') as file:
+        json.dump(checkpoint, file)
+    os.replace(tmp_path, path)
+
+
+def generate_for_item(item: dict, fields):
+    """Return (item_id, email, error) for one item; never raises."""
+    try:
+        monday_data = fields.build_monday_data(item)
+        return item['id'], generate_email_content(monday_data), None
+    except Exception as e:
+        logger.error(f"Could not generate email for item {item['id']}: {str(e)}")
+        return item['id'], None, f"{e.__class__.__name__}: {str(e)}"
+
+
+def write_back(emails: dict, board_id: str, api_key: str, checkpoint: dict, checkpoint_path: Path,
+               batch_size: int, dry_run: bool) -> int:
+    """Write item id -> email in batched mutations, record the outcome in the checkpoint, return the count written."""
+    if dry_run:
+        # Nothing was written, so nothing is marked done for the real run
+        return len(emails)
+
+    updated = set()
+    batch = list(emails.items())
+    for i in range(0, len(batch), batch_size):
+        updated |= update_monday_items_email(dict(batch[i:i + batch_size]), api_key, board_id)
+    for item_id in set(emails) - updated:
+        checkpoint['failed'][item_id] = 'write-back failed'
+
+    for item_id in updated:
+        checkpoint['failed'].pop(item_id, None)
+    checkpoint['done'] = sorted(set(checkpoint['done']) | updated)
+    save_checkpoint(checkpoint_path, checkpoint)
+    return len(updated)
+
+
+def run_batch_api_backfill(board_id: str, api_key: str, checkpoint_path: Path, page_size: int = 100,
+                           batch_size: int = 25, limit: int = None, dry_run: bool = False) -> dict:
+    """
+    Same as run_backfill, but generates every email through the OpenAI Batch API:
+    slower to finish, cheaper per email. Emails already in the response cache are reused.
+    Submitted batches are recorded in the checkpoint before they are polled, so a restarted
+    run waits for them instead of submitting (and paying for) them again.
+    """
+    checkpoint = load_checkpoint(checkpoint_path, board_id)
+    done = set(checkpoint['done'])
+    started = time.perf_counter()
+    board = get_board_config(board_id)
+
+    prompts = {}
+    for fields, items in iter_board_pages(board_id, api_key, page_size):
+        for item in items:
+            if item['id'] in done:
+                continue
+            try:
+                prompts[item['id']] = format_qa_text(fields.build_monday_data(item))
+            except Exception as e:
+                checkpoint['failed'][item['id']] = f"{e.__class__.__name__}: {str(e)}"
+            if limit is not None and len(prompts) >= limit:
+                break
+        if limit is not None and len(prompts) >= limit:
+            break
+
+    emails = {}
+    cache = get_response_cache()
+    if cache is not None:
+        for item_id, formatted_text in list(prompts.items()):
+            cached = cache.get(email_cache_key(formatted_text, board))
+            if cached is not None:
+                emails[item_id] = cached
+                del prompts[item_id]
+    logger.info(f"Board {board_id}: {len(emails)} emails from cache, {len(prompts)} sent to the Batch API")
+
+    batches = checkpoint.setdefault('batches', {})
+
+    def batch_submitted(description, batch_id, input_file_id):
+        batches[description] = {'batch_id': batch_id, 'input_file_id': input_file_id}
+        save_checkpoint(checkpoint_path, checkpoint)
+
+    generated = generate_emails_batch(prompts, board.system_instructions_path, board.generation_model,
+                                      batches=batches, on_submitted=batch_submitted)
+    # The results are in, a later run submits new batches
+    checkpoint.pop('batches')
+    save_checkpoint(checkpoint_path, checkpoint)
+
+    for item_id, (email_output, mail_results, error) in generated.items():
+        if error:
+            checkpoint['failed'][item_id] = error
+            continue
+        logger.info(f"Item {item_id} verification result: {mail_results.isVerified}")
+        emails[item_id] = email_output.messageText
+        if cache is not None and mail_results.isVerified:
+            cache.put(email_cache_key(prompts[item_id], board), email_output.messageText)
+
+    written = write_back(emails, board_id, api_key, checkpoint, checkpoint_path, batch_size, dry_run)
+    return {
+        'board_id': str(board_id),
+        'written': written,
+        'failed': len(checkpoint['failed']),
+        'done_total': len(checkpoint['done']),
+        'seconds': round(time.perf_counter() - started, 1)
+    }
+
+
+def run_backfill(board_id: str, api_key: str, checkpoint_path: Path, concurrency: int = 8,
+                 page_size: int = 100, batch_size: int = 25, limit: int = None, dry_run: bool = False) -> dict:
+    """Generate and write back emails for every item of the board that is not in the checkpoint yet."""
+    checkpoint = load_checkpoint(checkpoint_path, board_id)
+    done = set(checkpoint['done'])
+    started = time.perf_counter()
+    generated = written = 0
+
+    with ThreadPoolExecutor(max_workers=concurrency, thread_name_prefix="backfill") as executor:
+        for fields, items in iter_board_pages(board_id, api_key, page_size):
+            todo = [item for item in items if item['id'] not in done]
+            if limit is not None:
+                todo = todo[:max(0, limit - generated)]
+            if not todo:
+                continue
+
+            emails = {}
+            for item_id, email, error in executor.map(lambda item: generate_for_item(item, fields), todo):
+                if error:
+                    checkpoint['failed'][item_id] = error
+                else:
+                    emails[item_id] = email
+            generated += len(todo)
+
+            written += write_back(emails, board_id, api_key, checkpoint, checkpoint_path, batch_size, dry_run)
+            done = set(checkpoint['done'])
+            logger.info(f"Board {board_id}: {written} written, {len(checkpoint['failed'])} failed, "
+                        f"{time.perf_counter() - started:.0f}s elapsed")
+
+            if limit is not None and generated >= limit:
+                break
+
+    return {
+        'board_id': str(board_id),
+        'written': written,
+        'failed': len(checkpoint['failed']),
+        'done_total': len(done),
+        'seconds': round(time.perf_counter() - started, 1)
+    }
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Regenerate the update emails for every item on a Monday.com board")
+    parser.add_argument('board_id', help="Monday.com board id")
+    parser.add_argument('--checkpoint', type=Path, help="checkpoint file (default src/data/backfill_<board_id>.json)")
+    parser.add_argument('--concurrency', type=int, default=8, help="emails generated in parallel (default 8)")
+    parser.add_argument('--page-size', type=int, default=100, help="items per Monday.com page, max 500 (default 100)")
+    parser.add_argument('--batch-size', type=int, default=25, help="items written per mutation (default 25)")
+    parser.add_argument('--limit', type=int, help="stop after this many items")
+    parser.add_argument('--dry-run', action='store_true', help="generate but do not write back to Monday.com")
+    parser.add_argument('--batch-api', action='store_true',
+                        help="generate through the OpenAI Batch API (cheaper, finishes within 24h)")
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+    settings.require('MONDAY_API_KEY')
+    api_key = settings.monday_api_key
+
+    checkpoint_path = args.checkpoint or APP_ROOT / 'data' / f"backfill_{args.board_id}.json"
+    os.makedirs(checkpoint_path.parent, exist_ok=True)
+
+    if args.batch_api:
+        summary = run_batch_api_backfill(
+            args.board_id, api_key, checkpoint_path,
+            page_size=args.page_size, batch_size=args.batch_size, limit=args.limit, dry_run=args.dry_run
+        )
+    else:
+        summary = run_backfill(
+            args.board_id, api_key, checkpoint_path,
+            concurrency=args.concurrency, page_size=args.page_size, batch_size=args.batch_size,
+            limit=args.limit, dry_run=args.dry_run
+        )
+    print(json.dumps(summary))
+    return 0 if summary['failed'] == 0 else 1
+
+
+if __name__ == '__main__':
+    sys.exit(main())
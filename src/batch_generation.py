@@ -0,0 +1,183 @@
+"""
+Bulk email generation through the OpenAI Batch API.
+
+For the quarterly lender-update run latency per email does not matter, but cost and
+throughput do: all generation requests go into one JSONL batch file, which is submitted
+and polled until done, and the results go through a second batch for the mailVerifed
+check. Outputs are validated with EmailOutput / MailResults.model_validate_json just like
+the synchronous path. The client honors OPENAI_BASE_URL, so it can run against a stub server.
+"""
+import io
+import json
+import logging
+import os
+import time
+from functools import partial
+
+from main_2 import EmailOutput, GENERATION_MODEL
+from model_clients import get_openai_client, load_system_instructions
+from model_routing import final_verify_model
+from validator import MailResults, verificationMessages
+
+logger = logging.getLogger(__name__)
+
+BATCH_POLL_SECONDS = float(os.getenv('BATCH_POLL_SECONDS', 30))
+BATCH_TIMEOUT_SECONDS = float(os.getenv('BATCH_TIMEOUT_SECONDS', 24 * 3600))
+BATCH_ENDPOINT = "/v1/chat/completions"
+BATCH_DONE_STATUSES = ('completed', 'failed', 'expired', 'cancelled')
+
+
+def response_format(model) -> dict:
+    """Strict json_schema response format for a flat pydantic model, as parse() would send it."""
+    schema = model.model_json_schema()
+    schema['additionalProperties'] = False
+    schema['required'] = list(schema['properties'])
+    return {
+        "type": "json_schema",
+        "json_schema": {"name": model.__name__, "schema": schema, "strict": True}
+    }
+
+
+def batch_line(custom_id: str, model_name: str, messages: list, output_model) -> dict:
+    return {
+        "custom_id": custom_id,
+        "method": "POST",
+        "url": BATCH_ENDPOINT,
+        "body": {
+            "model": model_name,
+            "messages": messages,
+            "response_format": response_format(output_model)
+        }
+    }
+
+
+def run_batch(lines: list, description: str, batch_id: str = None, on_submitted=None) -> dict:
+    """
+    Submit the request lines as one batch, wait for it, and return
+    custom_id -> (response body, error) for every line.
+    With batch_id, waits for that earlier submission of the same lines instead (a new batch
+    is submitted when it failed or expired). on_submitted(batch id, input file id) is called
+    right after a submission, before the wait.
+    """
+    client = get_openai_client()
+    batch = None
+    if batch_id:
+        batch = client.batches.retrieve(batch_id)
+        if batch.status in BATCH_DONE_STATUSES and batch.status != 'completed':
+            logger.warning(f"Batch {batch_id} ({description}) ended with status {batch.status}, submitting it again")
+            batch = None
+        else:
+            logger.info(f"Resuming batch {batch.id} ({description}): {batch.status}")
+    if batch is None:
+        payload = "\n".join(json.dumps(line, ensure_ascii=False) for line in lines).encode('utf-8')
+        input_file = client.files.create(file=(f"{description}.jsonl", io.BytesIO(payload)), purpose="batch")
+        batch = client.batches.create(
+            input_file_id=input_file.id,
+            endpoint=BATCH_ENDPOINT,
+            completion_window="24h",
+            metadata={"description": description}
+        )
+        logger.info(f"Submitted batch {batch.id} ({description}) with {len(lines)} requests")
+        if on_submitted is not None:
+            on_submitted(batch.id, input_file.id)
+
+    deadline = time.time() + BATCH_TIMEOUT_SECONDS
+    while batch.status not in BATCH_DONE_STATUSES:
+        if time.time() > deadline:
+            raise TimeoutError(f"Batch {batch.id} not finished after {BATCH_TIMEOUT_SECONDS}s (status {batch.status})")
+        time.sleep(BATCH_POLL_SECONDS)
+        batch = client.batches.retrieve(batch.id)
+        counts = batch.request_counts
+        logger.info(f"Batch {batch.id}: {batch.status}"
+                    + (f" {counts.completed}/{counts.total} done, {counts.failed} failed" if counts else ""))
+
+    if batch.status != 'completed':
+        raise RuntimeError(f"Batch {batch.id} ended with status {batch.status}: {batch.errors}")
+
+    results = {line['custom_id']: (None, "No result returned") for line in lines}
+    for file_id in (batch.output_file_id, batch.error_file_id):
+        if not file_id:
+            continue
+        for raw in client.files.content(file_id).text.splitlines():
+            if not raw.strip():
+                continue
+            record = json.loads(raw)
+            if record.get('custom_id') not in results:
+                # A resumed batch may hold items that are not asked for this time
+                continue
+            response = record.get('response') or {}
+            if record.get('error') or response.get('status_code') != 200:
+                error = record.get('error') or (response.get('body') or {}).get('error')
+                results[record['custom_id']] = (None, str(error))
+            else:
+                results[record['custom_id']] = (response['body'], None)
+    return results
+
+
+def _message_content(body: dict) -> str:
+    return body['choices'][0]['message']['content']
+
+
+def generate_emails_batch(prompts: dict, system_instructions_path, model: str = GENERATION_MODEL,
+                          batches: dict = None, on_submitted=None) -> dict:
+    """
+    Generate and verify emails for many prompts at once, written by model.
+    prompts maps an id to the formatted Q&A text; returns id -> (EmailOutput, MailResults, error).
+    batches maps a batch description to the {'batch_id', 'input_file_id'} of an earlier
+    submission to wait for; on_submitted(description, batch id, input file id) is called
+    for every new submission (see run_batch).
+    """
+    if not prompts:
+        return {}
+    system_content = load_system_instructions(system_instructions_path)
+
+    generation_lines = [
+        batch_line(custom_id, model, [
+            {"role": "system", "content": system_content},
+            {"role": "user", "content": user_content},
+        ], EmailOutput)
+        for custom_id, user_content in prompts.items()
+    ]
+    batches = batches or {}
+
+    def batch_for(description):
+        return {
+            'batch_id': (batches.get(description) or {}).get('batch_id'),
+            'on_submitted': partial(on_submitted, description) if on_submitted is not None else None,
+        }
+
+    generated = run_batch(generation_lines, "email-generation", **batch_for("email-generation"))
+
+    results = {}
+    emails = {}
+    for custom_id, (body, error) in generated.items():
+        if error:
+            results[custom_id] = (None, None, error)
+            continue
+        try:
+            emails[custom_id] = EmailOutput.model_validate_json(_message_content(body))
+        except Exception as e:
+            results[custom_id] = (None, None, f"Invalid EmailOutput: {str(e)}")
+
+    verification_lines = [
+        # One call per email here, so it goes straight to the model whose verdict counts
+        batch_line(custom_id, final_verify_model(),
+                   verificationMessages(prompts[custom_id], email_output.messageText), MailResults)
+        for custom_id, email_output in emails.items()
+    ]
+    verified = (run_batch(verification_lines, "email-verification", **batch_for("email-verification"))
+                if verification_lines else {})
+
+    for custom_id, email_output in emails.items():
+        body, error = verified.get(custom_id, (None, "No verification result"))
+        try:
+            if error:
+                raise RuntimeError(error)
+            mail_results = MailResults.model_validate_json(_message_content(body))
+        except Exception as e:
+            # Same fallback as mailVerifed when the check itself fails
+            logger.error(f"Failed to validate email {custom_id}: {str(e)}")
+            mail_results = MailResults(issueDesc="Validation failed due to technical error", isVerified=False)
+        results[custom_id] = (email_output, mail_results, None)
+
+    return results
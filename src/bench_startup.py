@@ -0,0 +1,122 @@
+"""
+Import-time benchmark for the serving entry points.
+
+Every gunicorn worker (and every new instance the autoscaler starts) imports the app
+module before it can take a request, so that import is kept on a budget: each module is
+imported RUNS times in a fresh interpreter with -X importtime, and the median wall time,
+the slowest imports and any module that should have been deferred (openai, httpx, jwt:
+imported on first use, see model_clients.py, monday_client.py and webhook_auth.py) are
+reported. Exits 1 when the median is over --budget-ms or a deferred module was imported,
+so it can gate CI.
+The keys are dummies and the data files go to a temporary directory; nothing is called.
+
+usage:
+    python3 src/bench_startup.py
+    python3 src/bench_startup.py app --runs 10 --budget-ms 600 --top 20
+"""
+import argparse
+import os
+import re
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+APP_ROOT = os.path.dirname(os.path.abspath(__file__))
+# Modules the entry points must not import at startup
+DEFERRED_MODULES = {
+    'app': ('openai', 'httpx', 'jwt'),
+    'asgi_app': ('openai', 'jwt'),
+}
+STARTUP_IMPORT_BUDGET_MS = float(os.getenv('STARTUP_IMPORT_BUDGET_MS', 800))
+
+_IMPORTTIME_RE = re.compile(r'^import time:\s+(\d+) \|\s+(\d+) \|( *)(\S+)$')
+
+
+def bench_env(data_dir: str) -> dict:
+    # Any PROMETHEUS_MULTIPROC_DIR, even empty, turns on multiprocess metrics files
+    env = {name: value for name, value in os.environ.items() if name.lower() != 'prometheus_multiproc_dir'}
+    env.update({
+        'OPENAI_API_KEY': 'bench',
+        'MONDAY_API_KEY': 'bench',
+        'MONDAY_AID': 'bench',
+        'JOB_WORKERS': '0',
+        'JOB_QUEUE_PATH': os.path.join(data_dir, 'jobs.db'),
+        'RESPONSE_CACHE_PATH': os.path.join(data_dir, 'responses.db'),
+        'BOARD_SCHEMA_MARKER_DIR': os.path.join(data_dir, 'board_schema'),
+    })
+    return env
+
+
+def import_once(module: str, env: dict) -> tuple:
+    """Import module in a new interpreter; returns (wall ms, {module: (self us, cumulative us, depth)})."""
+    started = time.perf_counter()
+    result = subprocess.run(
+        [sys.executable, '-X', 'importtime', '-c', f"import {module}"],
+        cwd=APP_ROOT, env=env, capture_output=True, text=True
+    )
+    wall_ms = (time.perf_counter() - started) * 1000
+    if result.returncode != 0:
+        raise RuntimeError(f"import {module} failed:\n{result.stderr[-2000:]}")
+
+    imports = {}
+    for line in result.stderr.splitlines():
+        match = _IMPORTTIME_RE.match(line)
+        if match:
+            depth = (len(match.group(3)) - 1) // 2
+            imports[match.group(4)] = (int(match.group(1)), int(match.group(2)), depth)
+    return wall_ms, imports
+
+
+def bench_module(module: str, runs: int, top: int, env: dict) -> dict:
+    walls, import_ms, last = [], [], {}
+    for _ in range(runs):
+        wall_ms, imports = import_once(module, env)
+        walls.append(wall_ms)
+        import_ms.append(imports.get(module, (0, 0, 0))[1] / 1000)
+        last = imports
+
+    # Slowest modules imported directly by the entry point or its own modules
+    slowest = sorted(((cumulative, name) for name, (_, cumulative, depth) in last.items() if 1 <= depth <= 2),
+                     reverse=True)[:top]
+    deferred = [name for name in DEFERRED_MODULES.get(module, ()) if name in last]
+    return {
+        'module': module,
+        'wall_ms': statistics.median(walls),
+        'import_ms': statistics.median(import_ms),
+        'modules': len(last),
+        'slowest': [(name, cumulative / 1000) for cumulative, name in slowest],
+        'deferred_imported': deferred,
+    }
+
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(description="Measure how long the entry points take to import")
+    parser.add_argument('modules', nargs='*', default=list(DEFERRED_MODULES), help="modules to import (default app asgi_app)")
+    parser.add_argument('--runs', type=int, default=5, help="imports per module, the median is reported (default 5)")
+    parser.add_argument('--budget-ms', type=float, default=STARTUP_IMPORT_BUDGET_MS,
+                        help=f"median import time allowed per module (default {STARTUP_IMPORT_BUDGET_MS:.0f})")
+    parser.add_argument('--top', type=int, default=10, help="slowest imports listed (default 10)")
+    args = parser.parse_args(argv)
+
+    failed = False
+    with tempfile.TemporaryDirectory() as data_dir:
+        env = bench_env(data_dir)
+        for module in args.modules:
+            result = bench_module(module, args.runs, args.top, env)
+            over = result['import_ms'] > args.budget_ms
+            failed = failed or over or bool(result['deferred_imported'])
+
+            print(f"{module}: import {result['import_ms']:.0f} ms (budget {args.budget_ms:.0f} ms"
+                  f"{', OVER' if over else ''}), interpreter total {result['wall_ms']:.0f} ms, "
+                  f"{result['modules']} modules")
+            for name, ms in result['slowest']:
+                print(f"  {ms:8.1f} ms  {name}")
+            if result['deferred_imported']:
+                print(f"  imported at startup but should be deferred: {', '.join(result['deferred_imported'])}")
+    return 1 if failed else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
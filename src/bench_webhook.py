@@ -0,0 +1,292 @@
+"""
+Load test and latency benchmark for the webhook pipeline.
+
+Starts fake Monday.com and OpenAI servers (stub_servers.py) with configurable latency and
+error profiles, serves the Flask app in-process against them (or drives an already running
+server with --target), sends /monday-webhook or /questionandanswers requests at a fixed
+rate, and reports p50/p95/p99 latency, throughput and the per-stage breakdown (fetch,
+format, generate, verify, write-back) taken from the finished jobs. --server asgi serves
+asgi_app.py on uvicorn instead, to compare it with the sync Flask app and its worker threads.
+
+usage:
+    python3 src/bench_webhook.py --rate 20 --duration 30 --openai-latency 1500
+    python3 src/bench_webhook.py --endpoint qa --rate 5 --duration 20
+    python3 src/bench_webhook.py --server asgi --rate 100 --duration 30 --async-concurrency 200
+    python3 src/bench_webhook.py --stubs-only --monday-port 9001 --openai-port 9002
+    python3 src/bench_webhook.py --target http://localhost:5000 --rate 50
+"""
+import argparse
+import json
+import logging
+import os
+import socket
+import sys
+import tempfile
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+from requests.adapters import HTTPAdapter
+
+from stub_servers import FakeMondayServer, FakeOpenAIServer, LatencyProfile
+
+STAGES = ('fetch_ms', 'format_ms', 'generate_ms', 'verify_ms', 'write_back_ms')
+# Monday.com address the webhook auth accepts
+MONDAY_SOURCE_IP = '185.237.4.1'
+
+
+def percentile(values: list, pct: float):
+    if not values:
+        return None
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, max(0, round(pct / 100 * len(ordered)) - 1))
+    return round(ordered[index], 1)
+
+
+def summarize(values: list) -> dict:
+    return {
+        'count': len(values),
+        'p50': percentile(values, 50),
+        'p95': percentile(values, 95),
+        'p99': percentile(values, 99),
+        'max': round(max(values), 1) if values else None,
+    }
+
+
+def start_stubs(args):
+    monday = FakeMondayServer(
+        LatencyProfile(args.monday_latency, args.monday_jitter, args.monday_error_rate),
+        port=args.monday_port
+    ).start()
+    openai_stub = FakeOpenAIServer(
+        LatencyProfile(args.openai_latency, args.openai_jitter, args.openai_error_rate),
+        port=args.openai_port
+    ).start()
+    return monday, openai_stub
+
+
+def serve_app_in_process(monday_url: str, openai_url: str, job_workers: int, server: str = 'flask',
+                         async_concurrency: int = 100):
+    """Import the app against the stubs and serve it on a local port; returns its base URL."""
+    data_dir = tempfile.mkdtemp(prefix='spark-bench-')
+    os.environ.update({
+        'OPENAI_API_KEY': 'bench',
+        'MONDAY_API_KEY': 'bench',
+        'MONDAY_AID': 'bench',
+        'ENV': 'development',
+        'MONDAY_API_URL': monday_url,
+        'OPENAI_BASE_URL': openai_url,
+        'JOB_QUEUE_PATH': os.path.join(data_dir, 'jobs.db'),
+        'JOB_WORKERS': str(job_workers),
+        'JOB_ASYNC_CONCURRENCY': str(async_concurrency),
+        'MONDAY_ASYNC_POOL_SIZE': str(async_concurrency),
+        'JOB_DEBOUNCE_SECONDS': '0',
+        'JOB_POLL_SECONDS': '0.05',
+        # Every request carries the same Q&A; caching would hide the generation cost
+        'RESPONSE_CACHE_ENABLED': 'false',
+        'BOARD_SCHEMA_MARKER_DIR': os.path.join(data_dir, 'board_schema'),
+    })
+    if server == 'asgi':
+        return _serve_asgi()
+
+    from werkzeug.serving import make_server
+    import app as flask_app
+
+    logging.getLogger().setLevel(logging.WARNING)
+    logging.getLogger('werkzeug').setLevel(logging.WARNING)
+    server = make_server('127.0.0.1', 0, flask_app.app, threaded=True)
+    threading.Thread(target=server.serve_forever, name='bench-app', daemon=True).start()
+    return f"http://127.0.0.1:{server.server_port}"
+
+
+def _serve_asgi() -> str:
+    """Serve asgi_app on uvicorn in a background thread (one process, one event loop)."""
+    import uvicorn
+    import asgi_app
+
+    logging.getLogger().setLevel(logging.WARNING)
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        port = sock.getsockname()[1]
+    server = uvicorn.Server(uvicorn.Config(asgi_app.app, host='127.0.0.1', port=port, log_level='warning',
+                                           backlog=2048, timeout_keep_alive=30))
+    threading.Thread(target=server.run, name='bench-app', daemon=True).start()
+    while not server.started:
+        time.sleep(0.05)
+    return f"http://127.0.0.1:{port}"
+
+
+def wait_until_ready(target: str, timeout: float = 30):
+    """Wait for the warm-up (/health answers 503 until it is done), as a load balancer would."""
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        try:
+            if requests.get(f"{target}/health", timeout=5).status_code != 503:
+                return
+        except requests.RequestException:
+            pass
+        time.sleep(0.1)
+    print(f"{target} not ready after {timeout:.0f}s, measuring anyway", file=sys.stderr)
+
+
+def make_session(pool_size: int) -> requests.Session:
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size)
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    return session
+
+
+def send_request(session, target: str, endpoint: str, sequence: int) -> dict:
+    started = time.perf_counter()
+    try:
+        if endpoint == 'qa':
+            text = json.dumps({'question1': 'How is the business doing?',
+                               'answer1': f"Sales doubled this quarter (run {sequence})"})
+            response = session.post(f"{target}/questionandanswers", json={'text': text}, timeout=120)
+            job_id = None
+        else:
+            body = {'event': {'pulseId': 100000 + sequence, 'boardId': 1, 'triggerUuid': uuid.uuid4().hex}}
+            response = session.post(f"{target}/monday-webhook", json=body, timeout=30,
+                                    headers={'X-Forwarded-For': MONDAY_SOURCE_IP})
+            job_id = response.json().get('job_id') if response.status_code in (200, 202) else None
+        status = response.status_code
+    except requests.RequestException as e:
+        status, job_id = f"{e.__class__.__name__}", None
+    return {'latency_ms': (time.perf_counter() - started) * 1000, 'status': status, 'job_id': job_id}
+
+
+def drive_load(target: str, endpoint: str, rate: float, duration: float, max_in_flight: int) -> tuple:
+    """Send requests open-loop at the given rate; returns (results, elapsed seconds)."""
+    session = make_session(max_in_flight)
+    total = int(rate * duration)
+    futures = []
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=max_in_flight) as executor:
+        for sequence in range(total):
+            delay = started + sequence / rate - time.perf_counter()
+            if delay > 0:
+                time.sleep(delay)
+            futures.append(executor.submit(send_request, session, target, endpoint, sequence))
+        results = [future.result() for future in futures]
+    return results, time.perf_counter() - started
+
+
+def wait_for_jobs(target: str, job_ids: list, timeout: float) -> list:
+    """Poll /jobs/<id> until every job finished or the timeout passed; returns the job records."""
+    session = make_session(4)
+    pending = set(job_ids)
+    finished = {}
+    deadline = time.time() + timeout
+    while pending and time.time() < deadline:
+        for job_id in list(pending):
+            response = session.get(f"{target}/jobs/{job_id}", timeout=10)
+            if response.status_code == 200 and response.json()['status'] in ('succeeded', 'failed'):
+                finished[job_id] = response.json()
+                pending.discard(job_id)
+        if pending:
+            time.sleep(0.2)
+    return list(finished.values()) + [{'id': job_id, 'status': 'timeout'} for job_id in pending]
+
+
+def build_report(args, results: list, elapsed: float, jobs: list) -> dict:
+    ok_statuses = (200, 202)
+    ok = [r for r in results if r['status'] in ok_statuses]
+    report = {
+        'server': args.target or args.server,
+        'endpoint': args.endpoint,
+        'target_rate': args.rate,
+        'duration_s': round(elapsed, 1),
+        'requests': len(results),
+        'errors': len(results) - len(ok),
+        'error_statuses': sorted({str(r['status']) for r in results if r['status'] not in ok_statuses}),
+        'throughput_rps': round(len(ok) / elapsed, 1) if elapsed else None,
+        'response_latency_ms': summarize([r['latency_ms'] for r in ok]),
+    }
+
+    if jobs:
+        succeeded = [job for job in jobs if job['status'] == 'succeeded']
+        end_to_end = [(job['updated_at'] - job['created_at']) * 1000 for job in succeeded]
+        report['jobs'] = {
+            'succeeded': len(succeeded),
+            'failed': sum(1 for job in jobs if job['status'] == 'failed'),
+            'timed_out': sum(1 for job in jobs if job['status'] == 'timeout'),
+            'retried': sum(1 for job in jobs if job.get('attempts', 1) > 1),
+        }
+        if succeeded:
+            span = max(job['updated_at'] for job in succeeded) - min(job['created_at'] for job in succeeded)
+            report['jobs']['throughput_per_s'] = round(len(succeeded) / span, 2) if span > 0 else None
+        report['job_latency_ms'] = summarize(end_to_end)
+        timings = [(job.get('result') or {}).get('timings') or {} for job in succeeded]
+        report['stages_ms'] = {stage: summarize([t[stage] for t in timings if stage in t]) for stage in STAGES}
+    return report
+
+
+def print_report(report: dict):
+    print(f"\n{report['server']} {report['endpoint']}: {report['requests']} requests in {report['duration_s']}s "
+          f"(target {report['target_rate']}/s), {report['errors']} errors {report['error_statuses'] or ''}")
+    print(f"  throughput          {report['throughput_rps']} req/s")
+    rows = [('response latency', report['response_latency_ms'])]
+    if 'jobs' in report:
+        print(f"  jobs                {report['jobs']}")
+        rows.append(('job end-to-end', report['job_latency_ms']))
+        rows += [(f"  {stage[:-3]}", summary) for stage, summary in report['stages_ms'].items()]
+    print(f"  {'':20}{'p50':>10}{'p95':>10}{'p99':>10}{'max':>10}   (ms)")
+    for name, summary in rows:
+        values = ''.join(f"{'-' if summary[k] is None else summary[k]:>10}" for k in ('p50', 'p95', 'p99', 'max'))
+        print(f"  {name:20}{values}")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark the webhook pipeline against local fake Monday/OpenAI servers")
+    parser.add_argument('--endpoint', choices=('webhook', 'qa'), default='webhook')
+    parser.add_argument('--rate', type=float, default=10, help="requests per second (default 10)")
+    parser.add_argument('--duration', type=float, default=10, help="seconds of load (default 10)")
+    parser.add_argument('--max-in-flight', type=int, default=256, help="concurrent client requests (default 256)")
+    parser.add_argument('--drain-timeout', type=float, default=120, help="seconds to wait for queued jobs (default 120)")
+    parser.add_argument('--server', choices=('flask', 'asgi'), default='flask',
+                        help="in-process app: sync Flask with job threads, or asgi_app on uvicorn (default flask)")
+    parser.add_argument('--job-workers', type=int, default=4, help="JOB_WORKERS of the in-process Flask app (default 4)")
+    parser.add_argument('--async-concurrency', type=int, default=100,
+                        help="JOB_ASYNC_CONCURRENCY of the in-process ASGI app (default 100)")
+    parser.add_argument('--target', help="base URL of an already running app instead of serving it in-process")
+    parser.add_argument('--stubs-only', action='store_true', help="only run the fake servers until interrupted")
+    parser.add_argument('--monday-port', type=int, default=0)
+    parser.add_argument('--openai-port', type=int, default=0)
+    parser.add_argument('--monday-latency', type=float, default=150, help="ms (default 150)")
+    parser.add_argument('--monday-jitter', type=float, default=50, help="ms (default 50)")
+    parser.add_argument('--monday-error-rate', type=float, default=0.0)
+    parser.add_argument('--openai-latency', type=float, default=1500, help="ms (default 1500)")
+    parser.add_argument('--openai-jitter', type=float, default=500, help="ms (default 500)")
+    parser.add_argument('--openai-error-rate', type=float, default=0.0)
+    parser.add_argument('--json', action='store_true', help="print the report as JSON")
+    args = parser.parse_args(argv)
+
+    monday, openai_stub = start_stubs(args)
+    if args.stubs_only:
+        print(f"MONDAY_API_URL={monday.url}\nOPENAI_BASE_URL={openai_stub.url}\n(Ctrl+C to stop)")
+        try:
+            while True:
+                time.sleep(3600)
+        except KeyboardInterrupt:
+            return 0
+
+    target = args.target or serve_app_in_process(monday.url, openai_stub.url, args.job_workers,
+                                                 args.server, args.async_concurrency)
+    wait_until_ready(target)
+    results, elapsed = drive_load(target, args.endpoint, args.rate, args.duration, args.max_in_flight)
+    job_ids = [r['job_id'] for r in results if r['job_id']]
+    jobs = wait_for_jobs(target, job_ids, args.drain_timeout) if job_ids else []
+
+    report = build_report(args, results, elapsed, jobs)
+    if args.json:
+        print(json.dumps(report, indent=2))
+    else:
+        print_report(report)
+    return 0 if report['errors'] == 0 else 1
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,244 @@
+"""
+Per-board configuration: where the email goes, how columns are classified, which prompt
+and model write it.
+
+One deployment serves many boards (programs): each board's entry in BOARD_CONFIG_PATH
+overrides the "defaults" entry, and boards without an entry use the defaults, which are
+the values this service always had. The file is read once into a dict of compiled
+BoardConfig objects, so a lookup per item is a dictionary lookup; the file's mtime is
+checked at most every BOARD_CONFIG_CHECK_INTERVAL seconds and a changed file is loaded
+again in every worker without a restart. A file that does not parse, or names an
+instructions file or IP range that is not valid, is logged and the previous
+configuration stays in use.
+
+BOARD_CONFIG_PATH (JSON, optional):
+    {"defaults": {"output_column": "long_text_mkkg84hp",
+                  "system_instructions": "systemInstructions.txt",
+                  "generation_model": "gpt-4o",
+                  "title_roles": {"<column title>": "<role>"},
+                  "skip_types": ["status", ...]},
+     "boards": {"<board id>": {"name": "<program>", "field_roles": {"<column id>": "<role>"}, ...}},
+     "monday_ip_ranges": ["185.237.4.0/24"]}
+
+system_instructions paths are relative to src/. The older FIELD_ROLES_PATH file
+({"titles": ..., "boards": {"<board id>": {"<column id>": "<role>"}}}) is still read for the
+title roles and field roles the board config file does not set.
+"""
+import json
+import logging
+import os
+import threading
+import time
+from dataclasses import dataclass, field
+from ipaddress import ip_network
+from pathlib import Path
+
+from model_routing import GENERATION_MODEL
+
+logger = logging.getLogger(__name__)
+
+APP_ROOT = Path(os.path.dirname(os.path.abspath(__file__)))
+BOARD_CONFIG_PATH = Path(os.getenv('BOARD_CONFIG_PATH', APP_ROOT / 'boards.json'))
+FIELD_ROLES_PATH = Path(os.getenv('FIELD_ROLES_PATH', APP_ROOT / 'field_roles.json'))
+BOARD_CONFIG_CHECK_INTERVAL = float(os.getenv('BOARD_CONFIG_CHECK_INTERVAL', 10))
+
+# Long-text column the generated email is written to
+DEFAULT_OUTPUT_COLUMN = 'long_text_mkkg84hp'
+DEFAULT_SYSTEM_INSTRUCTIONS = 'systemInstructions.txt'
+# Monday.com's webhook addresses (185.237.4.1 through 185.237.4.6 seen so far)
+DEFAULT_MONDAY_IP_RANGES = ('185.237.4.0/24',)
+
+BOARD_KEYS = {'name', 'output_column', 'system_instructions', 'generation_model', 'field_roles', 'title_roles',
+              'skip_types'}
+
+
+@dataclass(frozen=True)
+class BoardConfig:
+    board_id: str
+    name: str = ''
+    output_column: str = DEFAULT_OUTPUT_COLUMN
+    system_instructions_path: Path = APP_ROOT / DEFAULT_SYSTEM_INSTRUCTIONS
+    generation_model: str = GENERATION_MODEL
+    # column id -> role, and column title -> role, on top of field_classifier's defaults
+    field_roles: dict = field(default_factory=dict)
+    title_roles: dict = field(default_factory=dict)
+    # None keeps field_classifier.SKIP_TYPES
+    skip_types: frozenset = None
+    # Registry load this config came from; compiled field classifiers are rebuilt when it changes
+    version: int = 0
+
+    def summary(self) -> dict:
+        return {
+            'name': self.name,
+            'output_column': self.output_column,
+            'system_instructions': str(self.system_instructions_path.relative_to(APP_ROOT)
+                                       if self.system_instructions_path.is_relative_to(APP_ROOT)
+                                       else self.system_instructions_path),
+            'generation_model': self.generation_model,
+            'field_roles': len(self.field_roles),
+        }
+
+
+def _read_json(path: Path) -> dict:
+    if not path.exists():
+        return {}
+    with open(path, 'r', encoding='utf-8') as file:
+        data = json.load(file)
+    if not isinstance(data, dict):
+        raise ValueError(f"{path} must hold a JSON object")
+    return data
+
+
+def _board_config(board_id: str, entry: dict, version: int) -> BoardConfig:
+    instructions = APP_ROOT / entry.get('system_instructions', DEFAULT_SYSTEM_INSTRUCTIONS)
+    if not instructions.exists():
+        raise ValueError(f"System instructions {instructions} of board {board_id or 'defaults'} not found")
+    skip_types = entry.get('skip_types')
+    return BoardConfig(
+        board_id=board_id,
+        name=entry.get('name', ''),
+        output_column=entry.get('output_column', DEFAULT_OUTPUT_COLUMN),
+        system_instructions_path=instructions,
+        generation_model=entry.get('generation_model', GENERATION_MODEL),
+        field_roles=dict(entry.get('field_roles', {})),
+        title_roles=dict(entry.get('title_roles', {})),
+        skip_types=frozenset(skip_types) if skip_types is not None else None,
+        version=version,
+    )
+
+
+class BoardRegistry:
+    """The compiled board configurations of BOARD_CONFIG_PATH, reloaded when the file changes."""
+
+    def __init__(self, path: Path = BOARD_CONFIG_PATH, field_roles_path: Path = FIELD_ROLES_PATH,
+                 check_interval: float = BOARD_CONFIG_CHECK_INTERVAL):
+        self.path = Path(path)
+        self.field_roles_path = Path(field_roles_path)
+        self.check_interval = check_interval
+        self.version = 0
+        self._lock = threading.Lock()
+        self._defaults = {}
+        self._entries = {}
+        self._boards = {'': BoardConfig('')}
+        self._networks = tuple(ip_network(cidr) for cidr in DEFAULT_MONDAY_IP_RANGES)
+        self._mtimes = None
+        self._checked_at = 0.0
+        self._loaded_at = None
+        self._error = None
+        self.reload()
+
+    def _file_mtimes(self) -> tuple:
+        mtimes = []
+        for path in (self.path, self.field_roles_path):
+            try:
+                mtimes.append(os.stat(path).st_mtime_ns)
+            except FileNotFoundError:
+                mtimes.append(None)
+        return tuple(mtimes)
+
+    def reload(self) -> bool:
+        """Load the files again; returns False (and keeps the current config) when they are invalid."""
+        with self._lock:
+            mtimes = self._file_mtimes()
+            try:
+                config = _read_json(self.path)
+                legacy = _read_json(self.field_roles_path)
+                version = self.version + 1
+
+                defaults = dict(config.get('defaults', {}))
+                boards_entries = {str(board_id): entry for board_id, entry in config.get('boards', {}).items()}
+                legacy_roles = {str(board_id): roles for board_id, roles in legacy.get('boards', {}).items()}
+                for name, entry in (('defaults', defaults), *boards_entries.items()):
+                    unknown = set(entry) - BOARD_KEYS
+                    if unknown:
+                        logger.warning(f"Unknown board config keys for {name}: {', '.join(sorted(unknown))}")
+
+                defaults['title_roles'] = {**legacy.get('titles', {}), **defaults.get('title_roles', {})}
+                entries = {}
+                for board_id in {**legacy_roles, **boards_entries}:
+                    entry = boards_entries.get(board_id, {})
+                    entries[board_id] = {
+                        **defaults,
+                        **entry,
+                        'title_roles': {**defaults['title_roles'], **entry.get('title_roles', {})},
+                        'field_roles': {**defaults.get('field_roles', {}), **legacy_roles.get(board_id, {}),
+                                        **entry.get('field_roles', {})},
+                    }
+
+                boards = {board_id: _board_config(board_id, entry, version) for board_id, entry in entries.items()}
+                default_board = _board_config('', defaults, version)
+                networks = tuple(ip_network(cidr) for cidr in config.get('monday_ip_ranges', DEFAULT_MONDAY_IP_RANGES))
+            except (OSError, ValueError, TypeError, AttributeError) as e:
+                logger.error(f"Board config not loaded, keeping the current one: {str(e)}")
+                self._error = str(e)
+                self._mtimes = mtimes
+                return False
+
+            self._defaults = defaults
+            self._entries = entries
+            self._boards = {**boards, '': default_board}
+            self._networks = networks
+            self.version = version
+            self._mtimes = mtimes
+            self._loaded_at = time.time()
+            self._error = None
+        if self.path.exists() or self.field_roles_path.exists():
+            logger.info(f"Loaded board config version {version}: {len(entries)} boards")
+        return True
+
+    def _check_for_changes(self):
+        now = time.monotonic()
+        if now - self._checked_at < self.check_interval:
+            return
+        self._checked_at = now
+        if self._file_mtimes() != self._mtimes:
+            self.reload()
+
+    def get(self, board_id) -> BoardConfig:
+        """The board's configuration (the defaults, under its id, for a board without an entry)."""
+        self._check_for_changes()
+        board_id = str(board_id or '')
+        config = self._boards.get(board_id)
+        if config is None:
+            with self._lock:
+                config = self._boards.get(board_id)
+                if config is None:
+                    config = _board_config(board_id, self._defaults, self.version)
+                    self._boards[board_id] = config
+        return config
+
+    def monday_networks(self) -> tuple:
+        self._check_for_changes()
+        return self._networks
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                'path': str(self.path),
+                'version': self.version,
+                'loaded_at': self._loaded_at,
+                'error': self._error,
+                'boards': {board_id: self._boards[board_id].summary() for board_id in self._entries},
+                'defaults': self._boards[''].summary(),
+            }
+
+
+_registry = None
+_registry_lock = threading.Lock()
+
+
+def get_board_registry() -> BoardRegistry:
+    global _registry
+    if _registry is None:
+        with _registry_lock:
+            if _registry is None:
+                _registry = BoardRegistry()
+    return _registry
+
+
+def get_board_config(board_id) -> BoardConfig:
+    return get_board_registry().get(board_id)
+
+
+def board_config_stats() -> dict:
+    return get_board_registry().stats()
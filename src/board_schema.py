@@ -0,0 +1,130 @@
+"""
+Per-board cache of Monday.com column schemas.
+
+A board's columns rarely change, so item fetches only ask for column_values and the
+column id -> title map and field classifier (field_classifier.py) are built once per
+board per worker. Entries expire after
+BOARD_SCHEMA_TTL seconds and can be invalidated explicitly (e.g. on a create_column
+webhook); invalidation touches a marker file so every gunicorn worker drops its copy.
+"""
+import logging
+import os
+import threading
+import time
+from pathlib import Path
+
+from board_config import get_board_config
+from field_classifier import compile_field_classifier
+from monday_client import get_monday_client
+from telemetry import record_cache
+
+logger = logging.getLogger(__name__)
+
+APP_ROOT = Path(os.path.dirname(os.path.abspath(__file__)))
+BOARD_SCHEMA_TTL = float(os.getenv('BOARD_SCHEMA_TTL', 3600))
+# An item with column ids missing from a schema older than this triggers a refetch
+BOARD_SCHEMA_MIN_AGE = float(os.getenv('BOARD_SCHEMA_MIN_AGE', 60))
+BOARD_SCHEMA_MARKER_DIR = Path(os.getenv('BOARD_SCHEMA_MARKER_DIR', APP_ROOT / 'data' / 'board_schema'))
+
+# Webhook event types that mean a board's columns changed
+SCHEMA_CHANGE_EVENTS = {'create_column', 'delete_column', 'change_column_title'}
+
+BOARD_COLUMNS_QUERY = """
+query ($boardId: [ID!]) {
+    complexity {
+        query
+        after
+        reset_in_x_seconds
+    }
+    boards(ids: $boardId) {
+        id
+        columns {
+            id
+            title
+            type
+        }
+    }
+}
+"""
+
+_schemas = {}
+_schemas_lock = threading.Lock()
+
+
+def _marker_path(board_id) -> Path:
+    return BOARD_SCHEMA_MARKER_DIR / f"{board_id}.invalidated"
+
+
+def _invalidated_at(board_id) -> float:
+    try:
+        return os.stat(_marker_path(board_id)).st_mtime
+    except FileNotFoundError:
+        return 0.0
+
+
+def _fetch_board_schema(board_id: str, api_key: str) -> dict:
+    data = get_monday_client(api_key).execute(BOARD_COLUMNS_QUERY, {"boardId": [str(board_id)]})
+    boards = (data.get('data') or {}).get('boards')
+    if data.get('errors') or not boards:
+        raise RuntimeError(f"Could not read columns of board {board_id}: {data.get('errors')}")
+    columns = boards[0]['columns']
+    logger.info(f"Fetched schema of board {board_id}: {len(columns)} columns")
+    return {
+        'columns': columns,
+        'titles': {col['id']: col['title'] for col in columns},
+        'fields': compile_field_classifier(board_id, columns),
+        'fetched_at': time.time()
+    }
+
+
+def get_board_schema(board_id, api_key: str) -> dict:
+    """
+    Return {'columns': [...], 'titles': {column id: title}, 'fields': FieldClassifier,
+    'fetched_at': ts} for the board,
+    fetching it only when it is not cached, expired or invalidated.
+    """
+    board_id = str(board_id)
+    schema = _schemas.get(board_id)
+    if (schema is not None and time.time() - schema['fetched_at'] < BOARD_SCHEMA_TTL
+            and schema['fetched_at'] > _invalidated_at(board_id)):
+        record_cache('board_schema', True)
+        return schema
+
+    with _schemas_lock:
+        schema = _schemas.get(board_id)
+        if (schema is None or time.time() - schema['fetched_at'] >= BOARD_SCHEMA_TTL
+                or schema['fetched_at'] <= _invalidated_at(board_id)):
+            record_cache('board_schema', False)
+            schema = _fetch_board_schema(board_id, api_key)
+            _schemas[board_id] = schema
+    return schema
+
+
+def invalidate_board_schema(board_id):
+    """Drop the cached schema of a board in this and every other worker."""
+    board_id = str(board_id)
+    with _schemas_lock:
+        _schemas.pop(board_id, None)
+    os.makedirs(BOARD_SCHEMA_MARKER_DIR, exist_ok=True)
+    _marker_path(board_id).touch()
+    logger.info(f"Invalidated schema of board {board_id}")
+
+
+def get_field_classifier(board_id, api_key: str, column_ids=()):
+    """
+    The board's compiled FieldClassifier. When some of column_ids are unknown (a column
+    was added since the schema was cached) the schema is refetched, at most once per
+    BOARD_SCHEMA_MIN_AGE so columns Monday never lists do not cause a fetch per item.
+    After a board config reload the roles are compiled again from the cached columns.
+    """
+    schema = get_board_schema(board_id, api_key)
+    if (any(column_id not in schema['titles'] for column_id in column_ids)
+            and time.time() - schema['fetched_at'] > BOARD_SCHEMA_MIN_AGE):
+        invalidate_board_schema(board_id)
+        schema = get_board_schema(board_id, api_key)
+
+    # The board config was reloaded since the roles were compiled
+    config = get_board_config(board_id)
+    if schema['fields'].config_version != config.version:
+        schema['fields'] = compile_field_classifier(board_id, schema['columns'], config)
+    return schema['fields']
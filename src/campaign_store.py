@@ -0,0 +1,204 @@
+"""
+Persistent index of the campaigns published on sparkil.org.
+
+getDataFromSite.py upserts every crawled campaign here, keyed by project_id, with the time
+it was first seen, last changed (its content hash differs) and last checked; campaigns that
+drop out of the sitemap are marked removed instead of deleted. The email pipeline looks
+campaigns up by business name to add the campaign page to the prompt (campaign_context),
+from an in-memory name index reloaded every CAMPAIGN_INDEX_TTL seconds, so no request
+scrapes the site or scans the table. The SQLite file is shared by all gunicorn workers.
+"""
+import hashlib
+import logging
+import os
+import re
+import sqlite3
+import threading
+import time
+import unicodedata
+from pathlib import Path
+
+logger = logging.getLogger(__name__)
+
+APP_ROOT = Path(os.path.dirname(os.path.abspath(__file__)))
+CAMPAIGN_STORE_PATH = Path(os.getenv('CAMPAIGN_STORE_PATH', APP_ROOT / 'data' / 'campaigns.db'))
+CAMPAIGN_CONTEXT_ENABLED = os.getenv('CAMPAIGN_CONTEXT_ENABLED', 'true').lower() == 'true'
+CAMPAIGN_INDEX_TTL = float(os.getenv('CAMPAIGN_INDEX_TTL', 300))
+# Shorter business names match too many titles by substring
+CAMPAIGN_MIN_NAME_LENGTH = 3
+
+CAMPAIGN_FIELDS = ('project_id', 'url', 'title', 'description', 'content')
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS campaigns (
+    project_id TEXT PRIMARY KEY,
+    url TEXT,
+    title TEXT NOT NULL,
+    description TEXT,
+    content TEXT,
+    content_hash TEXT NOT NULL,
+    first_seen REAL NOT NULL,
+    updated_at REAL NOT NULL,
+    checked_at REAL NOT NULL,
+    removed_at REAL
+);
+CREATE INDEX IF NOT EXISTS idx_campaigns_updated_at ON campaigns (updated_at);
+"""
+
+# Upsert outcomes
+INSERTED = 'inserted'
+UPDATED = 'updated'
+UNCHANGED = 'unchanged'
+
+_NON_WORD_RE = re.compile(r'[\W_]+')
+
+
+def normalize_name(name: str) -> str:
+    """Business / campaign name reduced to lowercase words, for matching."""
+    name = unicodedata.normalize('NFKC', name or '').casefold()
+    return _NON_WORD_RE.sub(' ', name).strip()
+
+
+def _content_hash(campaign: dict) -> str:
+    payload = '\0'.join(campaign.get(field) or '' for field in CAMPAIGN_FIELDS[1:])
+    return hashlib.sha256(payload.encode('utf-8')).hexdigest()
+
+
+class CampaignStore:
+    """Campaigns keyed by project_id in SQLite, safe to share between threads and processes."""
+
+    def __init__(self, db_path=CAMPAIGN_STORE_PATH, index_ttl: float = CAMPAIGN_INDEX_TTL):
+        self.db_path = Path(db_path)
+        self.index_ttl = index_ttl
+        self._local = threading.local()
+        self._index = None
+        self._index_loaded_at = 0.0
+        self._index_lock = threading.Lock()
+        os.makedirs(self.db_path.parent, exist_ok=True)
+        self._conn().executescript(_SCHEMA)
+
+    def _conn(self) -> sqlite3.Connection:
+        # One connection per thread and process, as in JobQueue: the store may be opened in the
+        # gunicorn master when the app is preloaded, and a forked worker must not reuse its connection
+        conn = getattr(self._local, 'conn', None)
+        if conn is None or self._local.pid != os.getpid():
+            conn = sqlite3.connect(self.db_path, timeout=30, isolation_level=None)
+            conn.row_factory = sqlite3.Row
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA synchronous=NORMAL')
+            self._local.conn = conn
+            self._local.pid = os.getpid()
+        return conn
+
+    def upsert(self, campaign: dict) -> str:
+        """Insert or update a campaign (dict with CAMPAIGN_FIELDS); returns INSERTED, UPDATED or UNCHANGED."""
+        now = time.time()
+        content_hash = _content_hash(campaign)
+        values = [campaign.get(field) for field in CAMPAIGN_FIELDS]
+        conn = self._conn()
+        row = conn.execute(
+            "SELECT content_hash, removed_at FROM campaigns WHERE project_id = ?", (campaign['project_id'],)
+        ).fetchone()
+        if row is None:
+            conn.execute(
+                "INSERT INTO campaigns (project_id, url, title, description, content, content_hash, "
+                "first_seen, updated_at, checked_at) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                (*values, content_hash, now, now, now)
+            )
+            return INSERTED
+        if row['content_hash'] == content_hash and row['removed_at'] is None:
+            conn.execute("UPDATE campaigns SET checked_at = ? WHERE project_id = ?", (now, campaign['project_id']))
+            return UNCHANGED
+        conn.execute(
+            "UPDATE campaigns SET url = ?, title = ?, description = ?, content = ?, content_hash = ?, "
+            "updated_at = ?, checked_at = ?, removed_at = NULL WHERE project_id = ?",
+            (*values[1:], content_hash, now, now, campaign['project_id'])
+        )
+        return UPDATED
+
+    def mark_removed(self, project_ids) -> int:
+        """Mark campaigns no longer published; returns how many were still active."""
+        now = time.time()
+        cursor = self._conn().executemany(
+            "UPDATE campaigns SET removed_at = ?, updated_at = ? WHERE project_id = ? AND removed_at IS NULL",
+            [(now, now, project_id) for project_id in project_ids]
+        )
+        return cursor.rowcount
+
+    def get(self, project_id: str):
+        row = self._conn().execute("SELECT * FROM campaigns WHERE project_id = ?", (str(project_id),)).fetchone()
+        return dict(row) if row is not None else None
+
+    def active(self) -> list:
+        """Published campaigns, most recently changed first."""
+        rows = self._conn().execute("SELECT * FROM campaigns WHERE removed_at IS NULL ORDER BY updated_at DESC")
+        return [dict(row) for row in rows]
+
+    def changed_since(self, timestamp: float) -> list:
+        """Campaigns added, changed or removed after timestamp."""
+        rows = self._conn().execute("SELECT * FROM campaigns WHERE updated_at > ? ORDER BY updated_at", (timestamp,))
+        return [dict(row) for row in rows]
+
+    def _name_index(self) -> list:
+        """(normalized title, campaign) of the published campaigns, reloaded every index_ttl seconds."""
+        if self._index is None or time.monotonic() - self._index_loaded_at > self.index_ttl:
+            with self._index_lock:
+                if self._index is None or time.monotonic() - self._index_loaded_at > self.index_ttl:
+                    self._index = [(normalize_name(campaign['title']), campaign) for campaign in self.active()]
+                    self._index_loaded_at = time.monotonic()
+        return self._index
+
+    def find_by_business(self, business_name: str):
+        """
+        The published campaign of a business: the one whose title is the business name,
+        else the shortest title containing it. None when nothing matches.
+        """
+        name = normalize_name(business_name)
+        if len(name) < CAMPAIGN_MIN_NAME_LENGTH:
+            return None
+        matches = [(title, campaign) for title, campaign in self._name_index() if name in title]
+        if not matches:
+            return None
+        for title, campaign in matches:
+            if title == name:
+                return campaign
+        return min(matches, key=lambda match: len(match[0]))[1]
+
+    def stats(self) -> dict:
+        row = self._conn().execute(
+            "SELECT COUNT(*) AS campaigns, SUM(removed_at IS NULL) AS active, MAX(checked_at) AS last_checked "
+            "FROM campaigns"
+        ).fetchone()
+        return {'campaigns': row['campaigns'], 'active': row['active'] or 0, 'last_checked': row['last_checked']}
+
+
+_store = None
+_store_lock = threading.Lock()
+
+
+def get_campaign_store() -> CampaignStore:
+    """Return the process-wide store, or None when CAMPAIGN_CONTEXT_ENABLED is off or nothing was crawled yet."""
+    global _store
+    if not CAMPAIGN_CONTEXT_ENABLED or not CAMPAIGN_STORE_PATH.exists():
+        return None
+    if _store is None:
+        with _store_lock:
+            if _store is None:
+                _store = CampaignStore()
+    return _store
+
+
+def campaign_context(business_name: str) -> str:
+    """Campaign page text of a business for the prompt, '' when it has none or the lookup fails."""
+    store = get_campaign_store()
+    if store is None or not business_name:
+        return ''
+    try:
+        campaign = store.find_by_business(business_name)
+    except sqlite3.Error as e:
+        logger.warning(f"Campaign lookup failed: {str(e)}")
+        return ''
+    if campaign is None:
+        return ''
+    logger.info(f"Adding campaign {campaign['project_id']} to the prompt of {business_name}")
+    return '\n'.join(part for part in (campaign['title'], campaign['content']) if part)
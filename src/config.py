@@ -0,0 +1,56 @@
+"""
+Application settings, loaded once per process.
+
+Importing this module loads the project's .env (a local file read, nothing else), so it
+is imported first by the entry points (app.py, asgi_app.py, the command line tools):
+every module that reads its own settings from the environment at import then sees the
+.env values too. The settings the entry points share are on the `settings` object.
+Required keys are checked by settings.require() when a serving process starts, not when
+a module is imported, so tools and benchmarks can import any module without them.
+"""
+import os
+from dataclasses import dataclass, field
+from pathlib import Path
+
+from dotenv import load_dotenv
+
+APP_ROOT = Path(os.path.dirname(os.path.abspath(__file__)))
+ROOT_DIR = APP_ROOT.parent
+ENV_PATH = ROOT_DIR / '.env'
+
+load_dotenv(ENV_PATH)
+
+
+@dataclass(frozen=True)
+class Settings:
+    env: str = field(default_factory=lambda: os.getenv('ENV', 'production'))
+    port: int = field(default_factory=lambda: int(os.getenv('PORT', 5000)))
+    openai_api_key: str = field(default_factory=lambda: os.getenv('OPENAI_API_KEY'))
+    monday_api_key: str = field(default_factory=lambda: os.getenv('MONDAY_API_KEY'))
+    monday_aid: str = field(default_factory=lambda: os.getenv('MONDAY_AID'))
+    # Signing secret of the Monday.com app; when set, webhooks must carry its JWT (webhook_auth.py)
+    monday_signing_secret: str = field(default_factory=lambda: os.getenv('MONDAY_SIGNING_SECRET'))
+    # Set by gunicorn.conf.py: the app is imported once in the master, each worker starts in post_fork
+    startup_after_fork: bool = field(default_factory=lambda: os.getenv('STARTUP_AFTER_FORK', 'false').lower() == 'true')
+
+    app_root: Path = APP_ROOT
+    system_instructions_path: Path = APP_ROOT / 'systemInstructions.txt'
+    static_files_path: Path = APP_ROOT / 'statics'
+    log_dir: Path = APP_ROOT / 'logs'
+
+    @property
+    def log_file_path(self) -> Path:
+        return self.log_dir / 'app.log'
+
+    @property
+    def is_development(self) -> bool:
+        return self.env == 'development'
+
+    def require(self, *names: str):
+        """Raise ValueError for the first of these environment variables that is not set."""
+        for name in names:
+            if not getattr(self, name.lower()):
+                raise ValueError(f"{name} not found in environment variables")
+
+
+settings = Settings()
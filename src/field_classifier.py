@@ -0,0 +1,133 @@
+"""
+Per-board classification of Monday.com columns.
+
+Each column of a board gets a role once, when the board's schema is fetched (see
+board_schema.py), so turning an item into the business info / Q&A structure is one pass
+over its column values with a dictionary lookup per column, and new boards are set up
+in the board config (board_config.py) instead of code. Roles come from, in order: the
+board's field_roles, the column title (the board's title_roles, then DEFAULT_TITLE_ROLES /
+DEFAULT_TITLE_FRAGMENT_ROLES) and the column type (the board's skip_types, SKIP_TYPES by
+default, are never sent to the model). The board's output column is always skipped.
+"""
+import logging
+from dataclasses import dataclass, field
+
+from board_config import BoardConfig, get_board_config
+
+logger = logging.getLogger(__name__)
+
+OWNER_NAME = 'owner_name'
+DESCRIPTION = 'description'
+BUSINESS_NAME = 'business_name'
+INCLUDE = 'include'
+SKIP = 'skip'
+ROLES = {OWNER_NAME, DESCRIPTION, BUSINESS_NAME, INCLUDE, SKIP}
+
+# Column types that never carry an answer worth sending
+SKIP_TYPES = {'creation_log', 'status', 'mirror', 'board_relation', 'file', 'link', 'item_id'}
+
+# Roles of the columns of the current intake form, by exact title / part of the title
+DEFAULT_TITLE_ROLES = {
+    'שם בעל/ת העסק': OWNER_NAME,
+}
+DEFAULT_TITLE_FRAGMENT_ROLES = {
+    'ספרו לנו בבקשה בכמה משפטים מה שלום העסק שלכם': DESCRIPTION,
+}
+
+# Marks a business name typed into the description column
+BUSINESS_NAME_PREFIX = 'businessName:'
+
+
+@dataclass
+class FieldClassifier:
+    board_id: str
+    # column id -> title / role, for every column of the board
+    titles: dict = field(default_factory=dict)
+    roles: dict = field(default_factory=dict)
+    # BoardConfig.version the roles were compiled from
+    config_version: int = 0
+
+    def build_monday_data(self, item: dict) -> dict:
+        """
+        The business info / Q&A structure of an item: the Q&A pairs worth sending to the
+        model (non-empty, no links, first column of each title) and the business fields.
+        """
+        business_info = {
+            'name': '',
+            'description': '',
+            'owner_name': ''
+        }
+        qa_pairs = []
+        seen_questions = set()
+
+        for column_value in item['column_values']:
+            role = self.roles.get(column_value['id'])
+            answer = column_value['text']
+            # Columns missing from the schema are skipped like SKIP ones
+            if role is None or role == SKIP or not answer or not isinstance(answer, str):
+                continue
+
+            if role == OWNER_NAME:
+                business_info['owner_name'] = answer
+            elif role == DESCRIPTION:
+                if BUSINESS_NAME_PREFIX in answer:
+                    business_info['name'] = answer.replace(BUSINESS_NAME_PREFIX, '').strip()
+                else:
+                    business_info['description'] = answer
+            elif role == BUSINESS_NAME:
+                business_info['name'] = answer.strip()
+
+            question = self.titles[column_value['id']]
+            if answer.startswith('http') or question in seen_questions:
+                continue
+            seen_questions.add(question)
+            qa_pairs.append({
+                'question': question,
+                'answer': answer,
+                'type': column_value['type']
+            })
+
+        return {
+            'business': business_info,
+            'qa_pairs': qa_pairs,
+            'board_id': self.board_id
+        }
+
+
+def _valid_role(role, source: str):
+    if role is not None and role not in ROLES:
+        logger.warning(f"Unknown field role {role!r} in {source}, ignoring it")
+        return None
+    return role
+
+
+def _title_role(title: str, title_roles: dict):
+    role = title_roles.get(title)
+    if role is None:
+        role = next((role for fragment, role in DEFAULT_TITLE_FRAGMENT_ROLES.items() if fragment in title), None)
+    return _valid_role(role, 'titles')
+
+
+def compile_field_classifier(board_id, columns: list, config: BoardConfig = None) -> FieldClassifier:
+    """Classifier of a board from its schema columns (dicts with id, title, type) and its board config."""
+    board_id = str(board_id)
+    config = config or get_board_config(board_id)
+    title_roles = {**DEFAULT_TITLE_ROLES, **config.title_roles}
+    skip_types = SKIP_TYPES if config.skip_types is None else config.skip_types
+
+    classifier = FieldClassifier(board_id, config_version=config.version)
+    for column in columns:
+        # The column the email is written to would feed the last email back into the prompt
+        if column['id'] == config.output_column:
+            role = SKIP
+        else:
+            role = (_valid_role(config.field_roles.get(column['id']), f"board {board_id}")
+                    or _title_role(column['title'], title_roles))
+        if role is None:
+            role = SKIP if column.get('type') in skip_types else INCLUDE
+        classifier.titles[column['id']] = column['title']
+        classifier.roles[column['id']] = role
+
+    logger.info(f"Classified {len(columns)} columns of board {board_id}: "
+                f"{sum(role != SKIP for role in classifier.roles.values())} sent to the model")
+    return classifier
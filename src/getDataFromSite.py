@@ -1,34 +1,110 @@
+"""
+Crawl the campaigns listed in the sparkil.org product sitemap into the campaign store.
+
+Campaign pages are fetched by a bounded pool of CRAWL_WORKERS threads over one pooled
+keep-alive session. Every page's ETag / Last-Modified and the sitemap's <lastmod> are kept
+in a SQLite cache (CRAWL_CACHE_PATH): pages whose lastmod did not change are not requested
+at all, the others are requested conditionally and a 304 keeps what was stored. Campaigns
+are upserted into campaign_store.py as each page completes, so an interrupted run resumes
+where it stopped; the optional spreadsheet export is only written again when a campaign
+was added, changed or removed.
+Pages are parsed with lxml when it is installed (CRAWL_PARSER to choose), html.parser otherwise.
+
+Usage: python src/getDataFromSite.py [--export output.xlsx|output.csv] [--sitemap URL] [--workers N] [--full]
+"""
+# First, so the .env values are in the environment before the other modules read it
+from config import settings  # noqa: F401
+import argparse
+import logging
+import os
+import sqlite3
+import sys
+import time
+import xml.etree.ElementTree as ET
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from pathlib import Path
+
 import requests
 from bs4 import BeautifulSoup
-import xml.etree.ElementTree as ET
-import pandas as pd
-
-def scrape_campaign_data(url):
-    headers = {
-        "User-Agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/87.0.4280.88 Safari/537.36",
-        "Accept-Language": "en-US,en;q=0.9",
-        "Accept": "text/html,application/xhtml+xml,application/xml;q=0.9,image/webp,*/*;q=0.8",
-        "Connection": "keep-alive"
-    }
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 
-    response = requests.get(url, headers=headers)
-    if response.status_code != 200:
-        print(f"Failed to retrieve the webpage: {url}. Status code: {response.status_code}")
-        return None
+from campaign_store import CAMPAIGN_STORE_PATH, INSERTED, UNCHANGED, UPDATED, CampaignStore
+
+logger = logging.getLogger(__name__)
+
+APP_ROOT = Path(os.path.dirname(os.path.abspath(__file__)))
+SITEMAP_URL = os.getenv('CRAWL_SITEMAP_URL', 'https://sparkil.org/product-sitemap.xml')
+CRAWL_CACHE_PATH = Path(os.getenv('CRAWL_CACHE_PATH', APP_ROOT / 'data' / 'crawl_cache.db'))
+CRAWL_WORKERS = int(os.getenv('CRAWL_WORKERS', 8))
+CRAWL_CONNECT_TIMEOUT = float(os.getenv('CRAWL_CONNECT_TIMEOUT', 5))
+CRAWL_READ_TIMEOUT = float(os.getenv('CRAWL_READ_TIMEOUT', 30))
+CRAWL_MAX_RETRIES = int(os.getenv('CRAWL_MAX_RETRIES', 3))
+
+HEADERS = {
+    "User-Agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/87.0.4280.88 Safari/537.36",
+    "Accept-Language": "en-US,en;q=0.9",
+    "Accept": "text/html,application/xhtml+xml,application/xml;q=0.9,image/webp,*/*;q=0.8",
+    "Connection": "keep-alive"
+}
+SITEMAP_NAMESPACES = {"ns": "http://www.sitemaps.org/schemas/sitemap/0.9"}
+COLUMNS = ["project_id", "title", "description", "content"]
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS pages (
+    url TEXT PRIMARY KEY,
+    etag TEXT,
+    last_modified TEXT,
+    sitemap_lastmod TEXT,
+    fetched_at REAL NOT NULL,
+    project_id TEXT NOT NULL
+);
+"""
+
+# Page fetch outcomes
+CHANGED = 'changed'
+NOT_MODIFIED = 'not_modified'
+FAILED = 'failed'
 
-    soup = BeautifulSoup(response.text, "html.parser")
+
+def _default_parser() -> str:
+    try:
+        import lxml  # noqa: F401
+        return 'lxml'
+    except ImportError:
+        return 'html.parser'
+
+
+HTML_PARSER = os.getenv('CRAWL_PARSER') or _default_parser()
+
+
+def make_session(pool_size: int = CRAWL_WORKERS) -> requests.Session:
+    """Keep-alive session with a connection per worker, retrying connection errors, 429 and 5xx."""
+    session = requests.Session()
+    retry = Retry(total=CRAWL_MAX_RETRIES, backoff_factor=1, status_forcelist=(429, 500, 502, 503, 504),
+                  allowed_methods=('GET',), respect_retry_after_header=True)
+    adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size, pool_block=True, max_retries=retry)
+    session.mount('https://', adapter)
+    session.mount('http://', adapter)
+    session.headers.update(HEADERS)
+    return session
+
+
+def parse_campaign_page(html: str) -> dict:
+    """The campaign fields of a page; None for the ones it does not have."""
+    soup = BeautifulSoup(html, HTML_PARSER)
 
     title_tag = soup.find("h1", class_="product_title entry-title")
-    title = title_tag.get_text(strip=True) if title_tag else "Title not found"
+    title = title_tag.get_text(strip=True) if title_tag else None
 
     description_tag = soup.find("p", string=lambda text: text and "mortgage advisor" in text)
-    description = description_tag.get_text(strip=True) if description_tag else "Description not found"
+    description = description_tag.get_text(strip=True) if description_tag else None
 
     content_div = soup.find("div", class_="large-12 columns nasa-content-panel")
-    content = content_div.get_text(separator="\n", strip=True) if content_div else "Content not found"
+    content = content_div.get_text(separator="\n", strip=True) if content_div else None
 
     project_id_tag = soup.find("input", {"id": "spark_campaign_id"})
-    project_id = project_id_tag["value"] if project_id_tag else "Project ID not found"
+    project_id = project_id_tag["value"] if project_id_tag else None
 
     return {
         "project_id": project_id,
@@ -37,34 +113,188 @@ def scrape_campaign_data(url):
         "content": content
     }
 
-def process_sitemap(sitemap_url, output_path):
-    headers = {
-        "User-Agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/87.0.4280.88 Safari/537.36",
-        "Accept-Language": "en-US,en;q=0.9",
-        "Accept": "text/html,application/xhtml+xml,application/xml;q=0.9,image/webp,*/*;q=0.8",
-        "Connection": "keep-alive"
-    }
 
-    response = requests.get(sitemap_url, headers=headers)
+def scrape_campaign_data(url, session=None, etag=None, last_modified=None):
+    """
+    Fetch and parse one campaign page. Returns (outcome, headers, data): data is the parsed
+    campaign when the page changed, None when the server answered 304 or the fetch failed.
+    """
+    conditional = {}
+    if etag:
+        conditional['If-None-Match'] = etag
+    if last_modified:
+        conditional['If-Modified-Since'] = last_modified
+
+    try:
+        response = (session or make_session(1)).get(
+            url, headers=conditional, timeout=(CRAWL_CONNECT_TIMEOUT, CRAWL_READ_TIMEOUT)
+        )
+    except requests.RequestException as e:
+        logger.warning(f"Failed to retrieve the webpage: {url}. {str(e)}")
+        return FAILED, {}, None
+    if response.status_code == 304:
+        return NOT_MODIFIED, {}, None
+    if response.status_code != 200:
+        logger.warning(f"Failed to retrieve the webpage: {url}. Status code: {response.status_code}")
+        return FAILED, {}, None
+
+    validators = {'etag': response.headers.get('ETag'), 'last_modified': response.headers.get('Last-Modified')}
+    return CHANGED, validators, parse_campaign_page(response.text)
+
+
+def fetch_sitemap(sitemap_url, session) -> dict:
+    """{campaign url: sitemap <lastmod> or None} of the sitemap."""
+    response = session.get(sitemap_url, timeout=(CRAWL_CONNECT_TIMEOUT, CRAWL_READ_TIMEOUT))
     if response.status_code != 200:
-        print(f"Failed to retrieve the sitemap. Status code: {response.status_code}")
-        return
+        raise RuntimeError(f"Failed to retrieve the sitemap. Status code: {response.status_code}")
 
     root = ET.fromstring(response.content)
-    namespaces = {"ns": "http://www.sitemaps.org/schemas/sitemap/0.9"}
-    urls = [url.find("ns:loc", namespaces).text for url in root.findall("ns:url", namespaces)]
-
-    campaign_data_list = []
-    for url in urls:
-        campaign_data = scrape_campaign_data(url)
-        if campaign_data:
-            campaign_data_list.append(campaign_data)
-
-    # Convert the list of dictionaries to a DataFrame and save as an Excel file
-    df = pd.DataFrame(campaign_data_list)
-    df.to_excel(output_path, index=False)
-    print(f"Data successfully saved to {output_path}")
-
-# Define the output path
-output_path = "/Users/avimunk/PycharmProjects/spark_poc/files/export.xlsx"
-process_sitemap("https://sparkil.org/product-sitemap.xml", output_path)
+    urls = {}
+    for url in root.findall("ns:url", SITEMAP_NAMESPACES):
+        lastmod = url.find("ns:lastmod", SITEMAP_NAMESPACES)
+        urls[url.find("ns:loc", SITEMAP_NAMESPACES).text.strip()] = lastmod.text.strip() if lastmod is not None else None
+    return urls
+
+
+class PageCache:
+    """HTTP validators of the crawled pages and the campaign each one holds, in SQLite."""
+
+    def __init__(self, db_path=CRAWL_CACHE_PATH):
+        Path(db_path).parent.mkdir(parents=True, exist_ok=True)
+        self.conn = sqlite3.connect(str(db_path))
+        self.conn.row_factory = sqlite3.Row
+        self.conn.execute('PRAGMA journal_mode=WAL')
+        self.conn.executescript(_SCHEMA)
+
+    def pages(self) -> dict:
+        return {row['url']: row for row in self.conn.execute('SELECT * FROM pages')}
+
+    def save(self, url, validators: dict, sitemap_lastmod, project_id):
+        with self.conn:
+            self.conn.execute(
+                'INSERT OR REPLACE INTO pages (url, etag, last_modified, sitemap_lastmod, fetched_at, project_id) '
+                'VALUES (?, ?, ?, ?, ?, ?)',
+                (url, validators.get('etag'), validators.get('last_modified'), sitemap_lastmod, time.time(), project_id)
+            )
+
+    def touch(self, url, sitemap_lastmod):
+        with self.conn:
+            self.conn.execute('UPDATE pages SET sitemap_lastmod = ?, fetched_at = ? WHERE url = ?',
+                              (sitemap_lastmod, time.time(), url))
+
+    def remove_missing(self, urls) -> list:
+        """Drop the pages no longer in the sitemap; returns their project ids."""
+        missing = {url: page['project_id'] for url, page in self.pages().items() if url not in urls}
+        with self.conn:
+            self.conn.executemany('DELETE FROM pages WHERE url = ?', [(url,) for url in missing])
+        return list(missing.values())
+
+    def close(self):
+        self.conn.close()
+
+
+def write_output(campaigns, output_path):
+    """Spreadsheet export of the campaigns, with the old placeholders for missing fields."""
+    # Imported here so pandas is only needed with --export
+    import pandas as pd
+    output_path = Path(output_path)
+    output_path.parent.mkdir(parents=True, exist_ok=True)
+    rows = [{
+        "project_id": campaign["project_id"],
+        "title": campaign["title"] or "Title not found",
+        "description": campaign["description"] or "Description not found",
+        "content": campaign["content"] or "Content not found",
+    } for campaign in campaigns]
+    df = pd.DataFrame(rows, columns=COLUMNS)
+    if output_path.suffix.lower() == '.csv':
+        df.to_csv(output_path, index=False)
+    else:
+        df.to_excel(output_path, index=False)
+
+
+def process_sitemap(sitemap_url=SITEMAP_URL, output_path=None, workers=CRAWL_WORKERS,
+                    cache_path=CRAWL_CACHE_PATH, store_path=CAMPAIGN_STORE_PATH, full=False) -> dict:
+    """
+    Crawl the sitemap's campaigns into the campaign store and, when output_path is given,
+    export them. full=True ignores the cache validators and fetches every page again.
+    Returns the count of pages per outcome.
+    """
+    session = make_session(workers)
+    cache = PageCache(cache_path)
+    store = CampaignStore(store_path)
+    try:
+        urls = fetch_sitemap(sitemap_url, session)
+        cached = cache.pages()
+        counts = {INSERTED: 0, UPDATED: 0, UNCHANGED: 0, NOT_MODIFIED: 0, FAILED: 0, 'skipped': 0}
+
+        # Unchanged <lastmod> in the sitemap: the page is not requested at all
+        to_fetch = []
+        for url, lastmod in urls.items():
+            page = cached.get(url)
+            if not full and page is not None and lastmod and page['sitemap_lastmod'] == lastmod:
+                counts['skipped'] += 1
+            else:
+                to_fetch.append((url, lastmod, page))
+
+        started = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            futures = {
+                executor.submit(scrape_campaign_data, url, session,
+                                None if full or page is None else page['etag'],
+                                None if full or page is None else page['last_modified']): (url, lastmod)
+                for url, lastmod, page in to_fetch
+            }
+            # Results are stored from this thread as they arrive, the workers only fetch and parse
+            for future in as_completed(futures):
+                url, lastmod = futures[future]
+                outcome, validators, data = future.result()
+                if outcome == CHANGED:
+                    if not data['project_id']:
+                        # Not cached either, so the page is fetched again next run
+                        logger.warning(f"No project id on {url}, skipped")
+                        outcome = FAILED
+                    else:
+                        outcome = store.upsert(dict(data, url=url))
+                        cache.save(url, validators, lastmod, data['project_id'])
+                elif outcome == NOT_MODIFIED:
+                    cache.touch(url, lastmod)
+                counts[outcome] += 1
+
+        removed = store.mark_removed(cache.remove_missing(urls))
+        logger.info(f"Crawled {len(urls)} campaigns in {time.perf_counter() - started:.1f}s: {counts}, {removed} removed")
+
+        if output_path is not None:
+            changed = counts[INSERTED] + counts[UPDATED] + removed
+            if changed or not Path(output_path).exists():
+                write_output(store.active(), output_path)
+                logger.info(f"Data successfully saved to {output_path}")
+            else:
+                logger.info(f"No campaign changed, {output_path} is up to date")
+        return dict(counts, removed=removed)
+    finally:
+        cache.close()
+        session.close()
+
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(description="Crawl the campaigns of the sparkil.org sitemap into the campaign store")
+    parser.add_argument('--export', type=Path, help="also write the campaigns to this .xlsx or .csv file")
+    parser.add_argument('--sitemap', default=SITEMAP_URL, help="sitemap URL")
+    parser.add_argument('--workers', type=int, default=CRAWL_WORKERS,
+                        help=f"pages fetched in parallel (default {CRAWL_WORKERS})")
+    parser.add_argument('--cache', type=Path, default=CRAWL_CACHE_PATH, help="page cache file")
+    parser.add_argument('--store', type=Path, default=CAMPAIGN_STORE_PATH, help="campaign store file")
+    parser.add_argument('--full', action='store_true', help="fetch every page again, ignoring the cache")
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+    try:
+        counts = process_sitemap(args.sitemap, args.export, args.workers, args.cache, args.store, args.full)
+    except (requests.RequestException, RuntimeError, ET.ParseError) as e:
+        logger.error(str(e))
+        return 1
+    return 1 if counts[FAILED] else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
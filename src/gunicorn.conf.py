@@ -0,0 +1,49 @@
+"""
+gunicorn settings for the Flask app.
+
+usage: gunicorn -c src/gunicorn.conf.py          (serves app:app from src/)
+
+The app is preloaded: the master imports it once (settings, logging, modules) and the
+workers are forked from it, instead of every worker importing everything again. Threads
+and network connections do not survive a fork, so each worker starts its job workers and
+warms up (clients, TLS connections, prompts, board schemas) in post_fork; /health answers
+503 until it is warm. Every setting can be overridden on the command line or with the
+environment variables below.
+"""
+import os
+import sys
+
+chdir = os.path.dirname(os.path.abspath(__file__))
+wsgi_app = os.getenv('GUNICORN_APP', 'app:app')
+bind = os.getenv('GUNICORN_BIND', f"0.0.0.0:{os.getenv('PORT', 5000)}")
+workers = int(os.getenv('WEB_CONCURRENCY', 3))
+worker_class = os.getenv('GUNICORN_WORKER_CLASS', 'sync')
+threads = int(os.getenv('GUNICORN_THREADS', 1))
+# /questionandanswers generates and verifies in the request (tens of seconds)
+timeout = int(os.getenv('GUNICORN_TIMEOUT', 120))
+graceful_timeout = int(os.getenv('GUNICORN_GRACEFUL_TIMEOUT', 30))
+keepalive = int(os.getenv('GUNICORN_KEEPALIVE', 5))
+preload_app = os.getenv('GUNICORN_PRELOAD', 'true').lower() == 'true'
+
+# Read by the app at import, which happens after this file is loaded
+os.environ.setdefault('WEB_CONCURRENCY', str(workers))
+if preload_app:
+    os.environ['STARTUP_AFTER_FORK'] = 'true'
+
+
+def post_fork(server, worker):
+    """Start the worker's threads and warm-up; the app module was imported by the master."""
+    if not preload_app:
+        return
+    module = sys.modules.get(wsgi_app.split(':')[0])
+    startup = getattr(module, 'startup', None)
+    if startup is not None:
+        startup()
+        server.log.info(f"Worker {worker.pid} started, warming up")
+
+
+def child_exit(server, worker):
+    # Drop the exited worker's live gauges from the multiprocess metrics
+    if os.getenv('PROMETHEUS_MULTIPROC_DIR'):
+        from prometheus_client import multiprocess
+        multiprocess.mark_process_dead(worker.pid)
@@ -0,0 +1,410 @@
+"""
+Local SQLite-backed job queue with a background worker pool.
+
+The Monday.com webhook only enqueues the item id and returns; worker threads pick
+jobs up, run the pipeline, and retry failures with exponential backoff. The queue
+lives in a single SQLite file so every gunicorn worker shares it and no outside
+broker is required. The ASGI app (asgi_app.py) runs jobs as asyncio tasks with
+AsyncWorkerPool instead of worker threads. Workers only claim jobs while
+resilience.accepting_jobs() says OpenAI and Monday.com can take more work; a job
+stopped by an open circuit or rate limit is deferred without using up an attempt.
+"""
+import asyncio
+import hashlib
+import json
+import logging
+import os
+import random
+import sqlite3
+import threading
+import time
+import uuid
+from pathlib import Path
+
+from resilience import DependencyUnavailable, accepting_jobs, job_limiter
+from telemetry import JOBS, correlation, record_retry
+
+logger = logging.getLogger(__name__)
+
+APP_ROOT = Path(os.path.dirname(os.path.abspath(__file__)))
+JOB_QUEUE_PATH = Path(os.getenv('JOB_QUEUE_PATH', APP_ROOT / 'data' / 'jobs.db'))
+JOB_WORKERS = int(os.getenv('JOB_WORKERS', 2))
+# Jobs one ASGI worker runs at the same time (asyncio tasks, see AsyncWorkerPool)
+JOB_ASYNC_CONCURRENCY = int(os.getenv('JOB_ASYNC_CONCURRENCY', 100))
+JOB_MAX_ATTEMPTS = int(os.getenv('JOB_MAX_ATTEMPTS', 4))
+JOB_RETRY_BASE_SECONDS = float(os.getenv('JOB_RETRY_BASE_SECONDS', 5))
+JOB_RETRY_MAX_SECONDS = float(os.getenv('JOB_RETRY_MAX_SECONDS', 300))
+JOB_POLL_SECONDS = float(os.getenv('JOB_POLL_SECONDS', 1))
+# A running job whose lease expires (worker crashed or was killed) is picked up again
+JOB_LEASE_SECONDS = float(os.getenv('JOB_LEASE_SECONDS', 300))
+# Events for an item that already has a queued job are folded into it; the job waits
+# this long after the latest event, but never more than JOB_COALESCE_MAX_WAIT after the first
+JOB_DEBOUNCE_SECONDS = float(os.getenv('JOB_DEBOUNCE_SECONDS', 3))
+JOB_COALESCE_MAX_WAIT = float(os.getenv('JOB_COALESCE_MAX_WAIT', 60))
+# How long delivered event ids are remembered to drop Monday's duplicate deliveries
+WEBHOOK_DEDUP_SECONDS = float(os.getenv('WEBHOOK_DEDUP_SECONDS', 3600))
+
+# Outcomes of JobQueue.enqueue
+ENQUEUED = 'queued'
+COALESCED = 'coalesced'
+DUPLICATE = 'duplicate'
+
+QUEUED = 'queued'
+RUNNING = 'running'
+SUCCEEDED = 'succeeded'
+FAILED = 'failed'
+
+LEASE_EXPIRED_ERROR = 'Lease expired on the last attempt (worker crashed or was killed)'
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS jobs (
+    id TEXT PRIMARY KEY,
+    item_id TEXT NOT NULL,
+    status TEXT NOT NULL,
+    attempts INTEGER NOT NULL DEFAULT 0,
+    max_attempts INTEGER NOT NULL,
+    run_at REAL NOT NULL,
+    lease_until REAL,
+    last_error TEXT,
+    result TEXT,
+    created_at REAL NOT NULL,
+    updated_at REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS idx_jobs_status_run_at ON jobs (status, run_at);
+CREATE INDEX IF NOT EXISTS idx_jobs_item_status ON jobs (item_id, status);
+CREATE TABLE IF NOT EXISTS seen_events (
+    event_id TEXT PRIMARY KEY,
+    job_id TEXT NOT NULL,
+    seen_at REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS idx_seen_events_seen_at ON seen_events (seen_at);
+"""
+
+
+def webhook_event_id(data: dict, raw_data: str) -> str:
+    """Id of a webhook delivery: Monday's triggerUuid, or a hash of the body when it is missing"""
+    trigger_uuid = data['event'].get('triggerUuid')
+    if trigger_uuid:
+        return str(trigger_uuid)
+    return hashlib.sha256(raw_data.encode('utf-8')).hexdigest()
+
+
+def retry_delay(attempts: int) -> float:
+    """Exponential backoff with jitter for the given (1-based) attempt number."""
+    delay = min(JOB_RETRY_MAX_SECONDS, JOB_RETRY_BASE_SECONDS * (2 ** (attempts - 1)))
+    return delay + random.uniform(0, delay / 4)
+
+
+class JobQueue:
+    """A durable FIFO of pipeline jobs stored in SQLite."""
+
+    def __init__(self, db_path=JOB_QUEUE_PATH, max_attempts: int = JOB_MAX_ATTEMPTS):
+        self.db_path = Path(db_path)
+        self.max_attempts = max_attempts
+        self._local = threading.local()
+        os.makedirs(self.db_path.parent, exist_ok=True)
+        self._conn().executescript(_SCHEMA)
+
+    def _conn(self) -> sqlite3.Connection:
+        # sqlite3 connections must not be shared between threads, nor with a forked child:
+        # the queue is created in the gunicorn master when the app is preloaded
+        conn = getattr(self._local, 'conn', None)
+        if conn is None or self._local.pid != os.getpid():
+            conn = sqlite3.connect(self.db_path, timeout=30, isolation_level=None)
+            conn.row_factory = sqlite3.Row
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA synchronous=NORMAL')
+            self._local.conn = conn
+            self._local.pid = os.getpid()
+        return conn
+
+    def enqueue(self, item_id, event_id: str = None):
+        """
+        Queue the given Monday.com item and return (job_id, outcome).
+
+        outcome is DUPLICATE when event_id was already delivered, COALESCED when the item
+        already had a queued job (its start is pushed back by the debounce window), and
+        ENQUEUED when a new job was created.
+        """
+        now = time.time()
+        conn = self._conn()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            if event_id:
+                row = conn.execute(
+                    "SELECT job_id FROM seen_events WHERE event_id = ? AND seen_at >= ?",
+                    (event_id, now - WEBHOOK_DEDUP_SECONDS)
+                ).fetchone()
+                if row is not None:
+                    conn.execute("COMMIT")
+                    logger.info(f"Dropped duplicate event {event_id} for item {item_id}")
+                    return row['job_id'], DUPLICATE
+
+            queued = conn.execute(
+                "SELECT id, run_at, created_at FROM jobs WHERE item_id = ? AND status = ? ORDER BY created_at LIMIT 1",
+                (str(item_id), QUEUED)
+            ).fetchone()
+            if queued is not None:
+                job_id, outcome = queued['id'], COALESCED
+                run_at = max(queued['run_at'], min(now + JOB_DEBOUNCE_SECONDS, queued['created_at'] + JOB_COALESCE_MAX_WAIT))
+                conn.execute("UPDATE jobs SET run_at = ?, updated_at = ? WHERE id = ?", (run_at, now, job_id))
+            else:
+                job_id, outcome = uuid.uuid4().hex, ENQUEUED
+                conn.execute(
+                    "INSERT INTO jobs (id, item_id, status, attempts, max_attempts, run_at, created_at, updated_at) "
+                    "VALUES (?, ?, ?, 0, ?, ?, ?, ?)",
+                    (job_id, str(item_id), QUEUED, self.max_attempts, now + JOB_DEBOUNCE_SECONDS, now, now)
+                )
+
+            if event_id:
+                conn.execute("DELETE FROM seen_events WHERE seen_at < ?", (now - WEBHOOK_DEDUP_SECONDS,))
+                conn.execute("INSERT INTO seen_events (event_id, job_id, seen_at) VALUES (?, ?, ?)", (event_id, job_id, now))
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+
+        if outcome == COALESCED:
+            logger.info(f"Coalesced event for item {item_id} into queued job {job_id}")
+        else:
+            logger.info(f"Enqueued job {job_id} for item {item_id}")
+        return job_id, outcome
+
+    def get(self, job_id: str) -> dict:
+        """Return the job as a dict, or None if it does not exist."""
+        row = self._conn().execute("SELECT * FROM jobs WHERE id = ?", (job_id,)).fetchone()
+        if row is None:
+            return None
+        job = dict(row)
+        job['result'] = json.loads(job['result']) if job['result'] else None
+        return job
+
+    def claim(self) -> dict:
+        """
+        Atomically take the next due job, or return None if nothing is ready.
+        Items that already have a job running are skipped, so at most one generation
+        per item is in progress across all workers.
+        """
+        now = time.time()
+        conn = self._conn()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            # A lease that expired on the last attempt means the job took its worker down (OOM,
+            # killed on timeout) without reaching fail(): it fails instead of being claimed again
+            abandoned = conn.execute(
+                "SELECT id, attempts FROM jobs WHERE status = ? AND lease_until < ? AND attempts >= max_attempts",
+                (RUNNING, now)
+            ).fetchall()
+            for job in abandoned:
+                conn.execute(
+                    "UPDATE jobs SET status = ?, last_error = ?, lease_until = NULL, updated_at = ? WHERE id = ?",
+                    (FAILED, LEASE_EXPIRED_ERROR, now, job['id'])
+                )
+            row = conn.execute(
+                "SELECT * FROM jobs "
+                "WHERE ((status = ? AND run_at <= ?) OR (status = ? AND lease_until < ?)) "
+                "AND item_id NOT IN (SELECT item_id FROM jobs WHERE status = ? AND lease_until >= ?) "
+                "ORDER BY run_at LIMIT 1",
+                (QUEUED, now, RUNNING, now, RUNNING, now)
+            ).fetchone()
+            if row is not None:
+                conn.execute(
+                    "UPDATE jobs SET status = ?, attempts = attempts + 1, lease_until = ?, updated_at = ? WHERE id = ?",
+                    (RUNNING, now + JOB_LEASE_SECONDS, now, row['id'])
+                )
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+        for job in abandoned:
+            JOBS.labels(outcome=FAILED).inc()
+            logger.error(f"Job {job['id']} failed permanently after {job['attempts']} attempts: {LEASE_EXPIRED_ERROR}")
+        if row is None:
+            return None
+        job = dict(row)
+        job['attempts'] += 1
+        return job
+
+    def complete(self, job_id: str, result: dict = None):
+        self._conn().execute(
+            "UPDATE jobs SET status = ?, result = ?, last_error = NULL, lease_until = NULL, updated_at = ? WHERE id = ?",
+            (SUCCEEDED, json.dumps(result) if result is not None else None, time.time(), job_id)
+        )
+
+    def fail(self, job: dict, error: str):
+        """Record a failed attempt and either reschedule the job or mark it failed."""
+        now = time.time()
+        if job['attempts'] >= job['max_attempts']:
+            status, run_at = FAILED, job['run_at']
+            JOBS.labels(outcome=FAILED).inc()
+            logger.error(f"Job {job['id']} failed permanently after {job['attempts']} attempts: {error}")
+        else:
+            status, run_at = QUEUED, now + retry_delay(job['attempts'])
+            JOBS.labels(outcome='retried').inc()
+            record_retry('job')
+            logger.warning(f"Job {job['id']} attempt {job['attempts']} failed, retrying in {run_at - now:.1f}s: {error}")
+        self._conn().execute(
+            "UPDATE jobs SET status = ?, run_at = ?, last_error = ?, lease_until = NULL, updated_at = ? WHERE id = ?",
+            (status, run_at, error, now, job['id'])
+        )
+
+    def defer(self, job: dict, delay: float, reason: str):
+        """Put a job back in the queue for later without counting the attempt (a dependency was unavailable)."""
+        now = time.time()
+        delay = max(delay or 0, JOB_POLL_SECONDS)
+        JOBS.labels(outcome='deferred').inc()
+        logger.warning(f"Job {job['id']} deferred for {delay:.1f}s: {reason}")
+        self._conn().execute(
+            "UPDATE jobs SET status = ?, attempts = attempts - 1, run_at = ?, last_error = ?, lease_until = NULL, "
+            "updated_at = ? WHERE id = ?",
+            (QUEUED, now + delay, reason, now, job['id'])
+        )
+
+
+class WorkerPool:
+    """Background threads that pull jobs from a JobQueue and run a handler on each item id."""
+
+    def __init__(self, queue: JobQueue, handler, workers: int = JOB_WORKERS):
+        self.queue = queue
+        self.handler = handler
+        self.workers = workers
+        self._stop = threading.Event()
+        self._threads = []
+
+    def start(self):
+        if self._threads:
+            return
+        job_limiter.set_max(self.workers)
+        for i in range(self.workers):
+            thread = threading.Thread(target=self._run, name=f"job-worker-{i}", daemon=True)
+            thread.start()
+            self._threads.append(thread)
+        logger.info(f"Started {self.workers} job workers on {self.queue.db_path}")
+
+    def stop(self, timeout: float = None):
+        self._stop.set()
+        for thread in self._threads:
+            thread.join(timeout)
+        self._threads = []
+
+    def _run(self):
+        while not self._stop.is_set():
+            # Leave jobs queued while a dependency is down or slow
+            if not accepting_jobs():
+                self._stop.wait(JOB_POLL_SECONDS)
+                continue
+
+            try:
+                job = self.queue.claim()
+            except sqlite3.Error as e:
+                logger.error(f"Could not claim job: {str(e)}")
+                job = None
+
+            if job is None:
+                job_limiter.release()
+                self._stop.wait(JOB_POLL_SECONDS)
+                continue
+
+            try:
+                self._run_job(job)
+            finally:
+                job_limiter.release()
+
+    def _run_job(self, job: dict):
+        with correlation(job_id=job['id'], item_id=job['item_id']):
+            logger.info(f"Running job {job['id']} for item {job['item_id']} (attempt {job['attempts']})")
+            try:
+                result = self.handler(job['item_id'])
+            except DependencyUnavailable as e:
+                self.queue.defer(job, e.retry_after, str(e))
+                return
+            except Exception as e:
+                logger.exception(f"Job {job['id']} raised:")
+                self.queue.fail(job, f"{e.__class__.__name__}: {str(e)}")
+                return
+            self.queue.complete(job['id'], result)
+            JOBS.labels(outcome=SUCCEEDED).inc()
+            logger.info(f"Job {job['id']} succeeded")
+
+
+class AsyncWorkerPool:
+    """
+    WorkerPool for the ASGI app: jobs run as asyncio tasks on the event loop, up to
+    `concurrency` at a time, instead of one thread each. A single dispatcher claims jobs
+    while slots are free; the short SQLite queue calls run in threads.
+    """
+
+    def __init__(self, queue: JobQueue, handler, concurrency: int = JOB_ASYNC_CONCURRENCY):
+        self.queue = queue
+        self.handler = handler
+        self.concurrency = concurrency
+        self._stop = None
+        self._dispatcher = None
+        self._running = set()
+
+    def start(self):
+        """Start dispatching; must be called from the running event loop."""
+        if self._dispatcher is not None:
+            return
+        job_limiter.set_max(self.concurrency)
+        self._stop = asyncio.Event()
+        self._dispatcher = asyncio.create_task(self._dispatch(), name="job-dispatcher")
+        logger.info(f"Started async job workers (concurrency {self.concurrency}) on {self.queue.db_path}")
+
+    async def stop(self, timeout: float = None):
+        """Stop claiming jobs and wait up to timeout for the running ones."""
+        if self._dispatcher is None:
+            return
+        self._stop.set()
+        await self._dispatcher
+        self._dispatcher = None
+        if self._running:
+            _, pending = await asyncio.wait(set(self._running), timeout=timeout)
+            for task in pending:
+                # Their leases expire and another worker picks them up
+                task.cancel()
+
+    async def _dispatch(self):
+        slots = asyncio.Semaphore(self.concurrency)
+        while not self._stop.is_set():
+            await slots.acquire()
+            job = None
+            if accepting_jobs():
+                try:
+                    job = await asyncio.to_thread(self.queue.claim)
+                except sqlite3.Error as e:
+                    logger.error(f"Could not claim job: {str(e)}")
+                if job is None:
+                    job_limiter.release()
+
+            if job is None:
+                slots.release()
+                try:
+                    await asyncio.wait_for(self._stop.wait(), JOB_POLL_SECONDS)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+
+            task = asyncio.create_task(self._run_job(job, slots), name=f"job-{job['id']}")
+            self._running.add(task)
+            task.add_done_callback(self._running.discard)
+
+    async def _run_job(self, job: dict, slots: asyncio.Semaphore):
+        try:
+            with correlation(job_id=job['id'], item_id=job['item_id']):
+                logger.info(f"Running job {job['id']} for item {job['item_id']} (attempt {job['attempts']})")
+                try:
+                    result = await self.handler(job['item_id'])
+                except DependencyUnavailable as e:
+                    await asyncio.to_thread(self.queue.defer, job, e.retry_after, str(e))
+                    return
+                except Exception as e:
+                    logger.exception(f"Job {job['id']} raised:")
+                    await asyncio.to_thread(self.queue.fail, job, f"{e.__class__.__name__}: {str(e)}")
+                    return
+                await asyncio.to_thread(self.queue.complete, job['id'], result)
+                JOBS.labels(outcome=SUCCEEDED).inc()
+                logger.info(f"Job {job['id']} succeeded")
+        finally:
+            job_limiter.release()
+            slots.release()
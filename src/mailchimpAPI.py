@@ -1,96 +1,65 @@
-import os
-import requests
-from requests.auth import HTTPBasicAuth
-import hashlib
+"""
+Command line for the lenders audience in Mailchimp (see mailchimp_client.py).
 
+    python src/mailchimpAPI.py refresh [--full]     sync the local audience snapshot
+    python src/mailchimpAPI.py tags                 list the audience's tags
+    python src/mailchimpAPI.py members TAG          subscribed members tagged TAG (from the snapshot)
+    python src/mailchimpAPI.py contact EMAIL        full record of one member
+"""
+# First, so the .env values are in the environment before the other modules read it
+from config import settings  # noqa: F401
+import argparse
+import json
+import sys
 
-# Read API key and data center from environment variables
-API_KEY = os.environ.get('MAILCHIMP_API_KEY')
-DATA_CENTER = os.environ.get('MAILCHIMP_DATA_CENTER')
+from mailchimp_client import MailchimpAPIError, MailchimpClient, get_audience_snapshot
 
-# Check if environment variables are set
-if not API_KEY or not DATA_CENTER:
-    raise ValueError("MAILCHIMP_API_KEY and MAILCHIMP_DATA_CENTER must be set as environment variables")
-#todo: add this env vearibles to Ec2 PM2
 
-LIST_ID = '370513c0ab'
-
-def getFullContactInfo():
-    email = 'tehilix@gmail.com'
-        # Hash the email to generate subscriber_hash
-    subscriber_hash = hashlib.md5(email.lower().encode()).hexdigest()
-
-    # API request to retrieve full contact details
-    url = f'https://{DATA_CENTER}.api.mailchimp.com/3.0/lists/{LIST_ID}/members/{subscriber_hash}'
-    response = requests.get(url, auth=HTTPBasicAuth('anystring', API_KEY))
-
-    if response.status_code == 200:
-        contact_data = response.json()
-        print(contact_data)  # This will contain all available fields
-    else:
-        print(f"Error: {response.status_code} - {response.text}")
+def getFullContactInfo(email):
+    """Full record of one member, straight from the API."""
+    return MailchimpClient().get_member(email)
 
 
 def get_all_tags():
     """Fetch and return all tags from Mailchimp."""
-    url = f'https://{DATA_CENTER}.api.mailchimp.com/3.0/lists/{LIST_ID}/tag-search'
-    count = 100  # Maximum allowed per page
-    offset = 0
-    all_tags = []
-
-    # Loop to fetch all tags with pagination
-    while True:
-        params = {'count': count, 'offset': offset}
-        response = requests.get(url, params=params, auth=HTTPBasicAuth('anystring', API_KEY))
-
-        if response.status_code != 200:
-            print(f"Failed to retrieve tags: {response.status_code} - {response.text}")
-            break
-
-        tags_data = response.json()
-        tags = tags_data.get('tags', [])
-
-        if not tags:
-            break  # Exit if no more tags are available
-
-        all_tags.extend(tags)  # Collect tags from this page
-        offset += count  # Move to the next page
+    return MailchimpClient().list_tags()
 
-    return all_tags
 
 def get_contacts_by_tag(tag_name):
-    """Fetch and print all contacts for a given tag name."""
-    url = f'https://{DATA_CENTER}.api.mailchimp.com/3.0/lists/{LIST_ID}/members'
-    params = {'tag': tag_name, 'count': 100}  # Use the tag name as a filter
-
-    response = requests.get(url, params=params, auth=HTTPBasicAuth('anystring', API_KEY))
-
-    if response.status_code != 200:
-        print(f"Failed to retrieve contacts: {response.status_code} - {response.text}")
-        return
-
-    contacts_data = response.json()
-    members = contacts_data.get('members', [])
-
-    print(f"Contacts for tag '{tag_name}':")
-    for member in members:
-        email = member.get('email_address', 'N/A')
-        full_name = f"{member.get('merge_fields', {}).get('FNAME', '')} {member.get('merge_fields', {}).get('LNAME', '')}".strip()
-        member_tags = [tag['name'] for tag in member.get('tags', [])]
-
-        print(f"- Name: {full_name}, Email: {email}, Tags: {member_tags}")
-
-#getFullContactInfo()
-
-# Main logic to retrieve and filter tags
-all_tags = get_all_tags()
-print(all_tags)
-#print("Tags containing the word 'Be Beauty' (case-insensitive):")
-'''
-for tag in all_tags:
-    if 'Here to Make You Smile' in tag['name'].lower():
-        #print(f"- {tag['name']} (ID: {tag['id']})")
-        # Use the tag name, not the ID
-        get_contacts_by_tag(tag['name'])
-
-'''
\ No newline at end of file
+    """Subscribed members with a tag, from the local snapshot (refreshed first if there is none)."""
+    snapshot = get_audience_snapshot()
+    if snapshot.stats()['synced_at'] is None:
+        snapshot.refresh()
+    return snapshot.members_by_tag(tag_name)
+
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(description="Mailchimp lenders audience")
+    commands = parser.add_subparsers(dest='command', required=True)
+    refresh = commands.add_parser('refresh', help="sync the local audience snapshot")
+    refresh.add_argument('--full', action='store_true', help="reload every member instead of the changed ones")
+    commands.add_parser('tags', help="list the audience's tags")
+    members = commands.add_parser('members', help="subscribed members with a tag")
+    members.add_argument('tag')
+    contact = commands.add_parser('contact', help="full record of one member")
+    contact.add_argument('email')
+    args = parser.parse_args(argv)
+
+    try:
+        if args.command == 'refresh':
+            result = get_audience_snapshot().refresh(full=args.full)
+        elif args.command == 'tags':
+            result = get_all_tags()
+        elif args.command == 'members':
+            result = get_contacts_by_tag(args.tag)
+        else:
+            result = getFullContactInfo(args.email)
+    except (MailchimpAPIError, ValueError) as e:
+        print(f"Error: {str(e)}", file=sys.stderr)
+        return 1
+    print(json.dumps(result, ensure_ascii=False, indent=2))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
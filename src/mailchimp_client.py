@@ -0,0 +1,269 @@
+"""
+Mailchimp Marketing API client and local snapshot of the lenders audience.
+
+MailchimpClient reads the members and tags of an audience with every page after the first
+fetched concurrently (MAILCHIMP_CONCURRENCY; Mailchimp allows 10 connections per key) over
+one pooled keep-alive session, asking only for the member fields the snapshot keeps.
+AudienceSnapshot keeps the members in SQLite (MAILCHIMP_SNAPSHOT_PATH) and refreshes it
+incrementally with since_last_changed, plus a full reload every MAILCHIMP_FULL_REFRESH_SECONDS
+to drop deleted members. Members are indexed in memory by tag (tags are the businesses
+lenders gave to), so the distribution list of a business is a dict lookup.
+Nothing here touches the network or checks the key until it is used.
+"""
+import hashlib
+import json
+import logging
+import os
+import re
+import sqlite3
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+import requests
+from requests.adapters import HTTPAdapter
+from requests.auth import HTTPBasicAuth
+from urllib3.util.retry import Retry
+
+from campaign_store import normalize_name
+
+logger = logging.getLogger(__name__)
+
+APP_ROOT = Path(os.path.dirname(os.path.abspath(__file__)))
+MAILCHIMP_API_KEY = os.getenv('MAILCHIMP_API_KEY')
+# The key ends with its data center ("...-us21"), so this is only needed to override it
+MAILCHIMP_DATA_CENTER = os.getenv('MAILCHIMP_DATA_CENTER')
+MAILCHIMP_LIST_ID = os.getenv('MAILCHIMP_LIST_ID', '370513c0ab')
+MAILCHIMP_PAGE_SIZE = int(os.getenv('MAILCHIMP_PAGE_SIZE', 1000))
+MAILCHIMP_CONCURRENCY = int(os.getenv('MAILCHIMP_CONCURRENCY', 4))
+MAILCHIMP_TIMEOUT = (float(os.getenv('MAILCHIMP_CONNECT_TIMEOUT', 5)), float(os.getenv('MAILCHIMP_READ_TIMEOUT', 60)))
+MAILCHIMP_MAX_RETRIES = int(os.getenv('MAILCHIMP_MAX_RETRIES', 3))
+MAILCHIMP_SNAPSHOT_PATH = Path(os.getenv('MAILCHIMP_SNAPSHOT_PATH', APP_ROOT / 'data' / 'mailchimp_audience.db'))
+MAILCHIMP_FULL_REFRESH_SECONDS = float(os.getenv('MAILCHIMP_FULL_REFRESH_SECONDS', 24 * 3600))
+
+# Member fields kept in the snapshot; everything else is left out of the responses
+MEMBER_FIELDS = ('id', 'email_address', 'status', 'merge_fields', 'tags', 'last_changed')
+TAG_FIELDS = ('id', 'name')
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS members (
+    id TEXT PRIMARY KEY,
+    email_address TEXT NOT NULL,
+    full_name TEXT,
+    status TEXT,
+    tags TEXT NOT NULL,
+    last_changed TEXT
+);
+CREATE TABLE IF NOT EXISTS sync (
+    list_id TEXT PRIMARY KEY,
+    last_changed TEXT,
+    full_sync_at REAL,
+    synced_at REAL
+);
+"""
+
+_DATA_CENTER_RE = re.compile(r'-([a-z]+\d+)$')
+
+
+class MailchimpAPIError(Exception):
+    """Raised when a Mailchimp API call fails after the session's retries."""
+
+    def __init__(self, message, status_code=None):
+        super().__init__(message)
+        self.status_code = status_code
+
+
+class MailchimpClient:
+    """Pooled client for the Mailchimp Marketing API (v3.0)."""
+
+    def __init__(self, api_key: str = None, data_center: str = None, concurrency: int = MAILCHIMP_CONCURRENCY,
+                 page_size: int = MAILCHIMP_PAGE_SIZE):
+        api_key = api_key or MAILCHIMP_API_KEY
+        if not api_key:
+            raise ValueError("MAILCHIMP_API_KEY must be set as an environment variable")
+        data_center = data_center or MAILCHIMP_DATA_CENTER
+        if not data_center:
+            match = _DATA_CENTER_RE.search(api_key)
+            if not match:
+                raise ValueError("MAILCHIMP_DATA_CENTER must be set when the API key does not end with it")
+            data_center = match.group(1)
+
+        self.base_url = f"https://{data_center}.api.mailchimp.com/3.0"
+        self.concurrency = concurrency
+        self.page_size = page_size
+        self.session = requests.Session()
+        retry = Retry(total=MAILCHIMP_MAX_RETRIES, backoff_factor=1, status_forcelist=(429, 500, 502, 503, 504),
+                      allowed_methods=('GET',), respect_retry_after_header=True)
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=concurrency, pool_block=True, max_retries=retry)
+        self.session.mount('https://', adapter)
+        self.session.auth = HTTPBasicAuth('anystring', api_key)
+
+    def get(self, path: str, params: dict = None) -> dict:
+        try:
+            response = self.session.get(f"{self.base_url}{path}", params=params, timeout=MAILCHIMP_TIMEOUT)
+        except requests.RequestException as e:
+            raise MailchimpAPIError(f"Mailchimp request failed: {str(e)}")
+        if response.status_code != 200:
+            raise MailchimpAPIError(f"Mailchimp API error: {response.status_code} - {response.text}",
+                                    status_code=response.status_code)
+        return response.json()
+
+    def _paginate(self, path: str, key: str, fields: tuple, params: dict = None) -> list:
+        """All items of a paginated collection: the first page gives total_items, the rest are fetched concurrently."""
+        params = dict(params or {}, count=self.page_size,
+                      fields=','.join([f"{key}.{field}" for field in fields] + ['total_items']))
+
+        first = self.get(path, dict(params, offset=0))
+        items = first.get(key, [])
+        offsets = range(self.page_size, first.get('total_items', 0), self.page_size)
+        if offsets:
+            with ThreadPoolExecutor(max_workers=self.concurrency) as executor:
+                for page in executor.map(lambda offset: self.get(path, dict(params, offset=offset)), offsets):
+                    items.extend(page.get(key, []))
+        return items
+
+    def list_members(self, list_id: str = MAILCHIMP_LIST_ID, since_last_changed: str = None,
+                     fields: tuple = MEMBER_FIELDS) -> list:
+        """Members of an audience, only the ones changed after since_last_changed (ISO 8601) when given."""
+        # A stable order, so members do not shift between concurrently fetched pages
+        params = {'sort_field': 'last_changed', 'sort_dir': 'ASC'}
+        if since_last_changed:
+            params['since_last_changed'] = since_last_changed
+        return self._paginate(f"/lists/{list_id}/members", 'members', fields, params)
+
+    def list_tags(self, list_id: str = MAILCHIMP_LIST_ID) -> list:
+        """Every tag of an audience ({id, name})."""
+        return self._paginate(f"/lists/{list_id}/tag-search", 'tags', TAG_FIELDS)
+
+    def get_member(self, email: str, list_id: str = MAILCHIMP_LIST_ID) -> dict:
+        """Full record of one member."""
+        return self.get(f"/lists/{list_id}/members/{subscriber_hash(email)}")
+
+    def close(self):
+        self.session.close()
+
+
+def subscriber_hash(email: str) -> str:
+    return hashlib.md5(email.lower().encode()).hexdigest()
+
+
+def _member_row(member: dict) -> tuple:
+    merge_fields = member.get('merge_fields') or {}
+    full_name = f"{merge_fields.get('FNAME', '')} {merge_fields.get('LNAME', '')}".strip()
+    tags = [tag['name'] for tag in member.get('tags') or []]
+    return (member['id'], member['email_address'], full_name, member.get('status'),
+            json.dumps(tags, ensure_ascii=False), member.get('last_changed'))
+
+
+class AudienceSnapshot:
+    """Local copy of an audience's members with a tag -> members index."""
+
+    def __init__(self, client: MailchimpClient = None, list_id: str = MAILCHIMP_LIST_ID,
+                 db_path=MAILCHIMP_SNAPSHOT_PATH, full_refresh_seconds: float = MAILCHIMP_FULL_REFRESH_SECONDS):
+        self._client = client
+        self.list_id = list_id
+        self.db_path = Path(db_path)
+        self.full_refresh_seconds = full_refresh_seconds
+        self._lock = threading.Lock()
+        self._index = None
+        os.makedirs(self.db_path.parent, exist_ok=True)
+        self.conn = sqlite3.connect(self.db_path, timeout=30, isolation_level=None, check_same_thread=False)
+        self.conn.row_factory = sqlite3.Row
+        self.conn.execute('PRAGMA journal_mode=WAL')
+        self.conn.executescript(_SCHEMA)
+
+    @property
+    def client(self) -> MailchimpClient:
+        if self._client is None:
+            self._client = MailchimpClient()
+        return self._client
+
+    def _sync_state(self):
+        return self.conn.execute("SELECT * FROM sync WHERE list_id = ?", (self.list_id,)).fetchone()
+
+    def refresh(self, full: bool = False) -> dict:
+        """
+        Bring the snapshot up to date: only the members changed since the last refresh, or a
+        full reload when asked, when there is none yet or it is older than full_refresh_seconds.
+        """
+        with self._lock:
+            state = self._sync_state()
+            now = time.time()
+            full = full or state is None or state['last_changed'] is None or \
+                now - (state['full_sync_at'] or 0) > self.full_refresh_seconds
+
+            started = time.perf_counter()
+            members = self.client.list_members(self.list_id, since_last_changed=None if full else state['last_changed'])
+            rows = [_member_row(member) for member in members]
+            # last_changed is ISO 8601 in UTC, so the text order is the time order
+            watermark = max([row[5] for row in rows if row[5]] + ([state['last_changed']] if state and not full else []),
+                            default=None)
+
+            with self.conn:
+                self.conn.execute("BEGIN")
+                if full:
+                    self.conn.execute("DELETE FROM members")
+                self.conn.executemany(
+                    "INSERT OR REPLACE INTO members (id, email_address, full_name, status, tags, last_changed) "
+                    "VALUES (?, ?, ?, ?, ?, ?)", rows
+                )
+                self.conn.execute(
+                    "INSERT INTO sync (list_id, last_changed, full_sync_at, synced_at) VALUES (?, ?, ?, ?) "
+                    "ON CONFLICT(list_id) DO UPDATE SET last_changed = excluded.last_changed, "
+                    "full_sync_at = COALESCE(excluded.full_sync_at, full_sync_at), synced_at = excluded.synced_at",
+                    (self.list_id, watermark, now if full else None, now)
+                )
+            self._index = None
+
+        logger.info(f"Mailchimp audience {self.list_id}: {'full' if full else 'incremental'} refresh of "
+                    f"{len(rows)} members in {time.perf_counter() - started:.1f}s")
+        return {'full': full, 'members': len(rows)}
+
+    def _tag_index(self) -> dict:
+        """normalized tag name -> members, built from the snapshot on first use after a refresh."""
+        index = self._index
+        if index is None:
+            with self._lock:
+                index = {}
+                for row in self.conn.execute("SELECT email_address, full_name, status, tags FROM members"):
+                    member = {'email': row['email_address'], 'name': row['full_name'], 'status': row['status']}
+                    for tag in json.loads(row['tags']):
+                        index.setdefault(normalize_name(tag), []).append(member)
+                self._index = index
+        return index
+
+    def members_by_tag(self, tag: str, status: str = 'subscribed') -> list:
+        """Members with this tag ({email, name, status}), only the ones with status when it is given."""
+        members = self._tag_index().get(normalize_name(tag), [])
+        return [member for member in members if status is None or member['status'] == status]
+
+    def lenders_for_business(self, business_name: str) -> list:
+        """Subscribed email addresses of the lenders of a business (tagged with its name)."""
+        return [member['email'] for member in self.members_by_tag(business_name)]
+
+    def stats(self) -> dict:
+        state = self._sync_state()
+        return {
+            'members': self.conn.execute("SELECT COUNT(*) FROM members").fetchone()[0],
+            'tags': len(self._tag_index()),
+            'synced_at': state['synced_at'] if state else None,
+            'last_changed': state['last_changed'] if state else None,
+        }
+
+    def close(self):
+        self.conn.close()
+
+
+_snapshot = None
+_snapshot_lock = threading.Lock()
+
+
+def get_audience_snapshot() -> AudienceSnapshot:
+    """The process-wide snapshot of MAILCHIMP_LIST_ID; it is only read, call refresh() to sync it."""
+    global _snapshot
+    if _snapshot is None:
+        with _snapshot_lock:
+            if _snapshot is None:
+                _snapshot = AudienceSnapshot()
+    return _snapshot
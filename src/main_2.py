@@ -1,26 +1,44 @@
 # Description: This script is used to generate an email output based on the user input and system instructions. The user input is combined with the system instructions and sent to the OpenAI API for processing. The response is then parsed to extract the email output details. The email output is saved to an RTF file along with additional content. The script also calls the mailVerified function from the validator.py file to verify the email message against the questions and answers provided.
 # the html in s3 here http://sparkpoc1.s3.amazonaws.com/statics/index.html
 
+import asyncio
+import contextvars
 import os
 import logging
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
+import jiter
 from pydantic import BaseModel
-from openai import OpenAI
-from validator import mailVerifed, MailResults
+from validator import mailVerifed, mailVerifedWithUsage, mailVerifedWithUsageAsync, MailResults
+from model_clients import get_async_openai_client, get_openai_client, load_system_instructions
+from resilience import openai_call, openai_call_async
+from model_routing import GENERATION_MODEL, record_route_call
+from telemetry import SAMPLED, span
 from pathlib import Path
 import json
 
 # Constants for file paths
 SYSTEM_INSTRUCTIONS_FILE = 'systemInstructions.txt'
 
-# Configure logging
-logger = logging.getLogger(__name__)
 
-#logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
-logging.basicConfig(
-    level=logging.INFO,
-    format='%(asctime)s - %(name)s - %(levelname)s - %(filename)s:%(lineno)d - %(message)s'
-)
+# How the email is verified, see m(): sequential, fused, async or threshold
+PIPELINE_MODES = ('sequential', 'fused', 'async', 'threshold')
+PIPELINE_MODE = os.getenv('PIPELINE_MODE', 'sequential')
+# threshold mode skips mailVerifed when the self-check is verified with at least this confidence
+VERIFY_SKIP_CONFIDENCE = float(os.getenv('VERIFY_SKIP_CONFIDENCE', 0.9))
+VERIFY_WORKERS = int(os.getenv('VERIFY_WORKERS', 4))
+# EmailOutput fields sent to the tester page piece by piece while they are generated
+STREAMED_FIELDS = ('emailSubject', 'messageText')
+
+_verify_executor = None
+_verify_executor_lock = threading.Lock()
+# Background verification tasks of m_async(), referenced until they finish
+_background_verifications = set()
+
+# Handlers are set up by the entry point (telemetry.setup_logging)
+logger = logging.getLogger(__name__)
 
 def email_output_to_html(email_text, email_verified: MailResults):
     """Convert the email output to HTML format."""
@@ -88,6 +106,18 @@ class EmailOutput(BaseModel):
     isTooSad: bool 
     businessName: str
 
+# EmailOutput plus the model's own verification, used by the fused pipeline modes
+class FusedEmailOutput(EmailOutput):
+    isVerified: bool
+    issueDesc: str
+    confidence: float
+
+FUSED_VERIFICATION_INSTRUCTIONS = """
+After writing the email, check that messageText generally reflects the user's answers in the questions and answers.
+If it does, set isVerified=True and leave issueDesc empty. If it does not, set isVerified=False and describe in issueDesc why the message is incorrect.
+Set confidence to a number between 0 and 1 for how sure you are of that check.
+"""
+
 def get_openai_api_key():
     """Retrieve the OpenAI API key from environment variables or prompt the user."""
     openai_api_key = os.getenv('OPENAI_API_KEY')
@@ -103,13 +133,9 @@ def get_openai_api_key():
     return openai_api_key
 
 def prepare_messages(file_path):
-    """Load the system instructions from file."""
+    """Load the system instructions from file (cached until the file changes)."""
     try:
-        logger.info(f"Attempting to read file from: {file_path}")
-        with open(file_path, 'r', encoding='utf-8') as file:
-            content = file.read()
-            logger.info(f"Successfully read {len(content)} characters from file")
-            return content
+        return load_system_instructions(file_path)
     except FileNotFoundError:
         logger.error(f"File not found: {file_path}")
         raise
@@ -117,18 +143,164 @@ def prepare_messages(file_path):
         logger.error(f"Error reading file {file_path}: {e}")
         raise
 
-def m(ex_qanda=None, html_response=True, system_instructions_path=None):
+def _usage_tokens(usage):
+    """Prompt/completion token counts of a completion's usage (zeros when unknown)."""
+    if usage is None:
+        return 0, 0
+    return usage.prompt_tokens, usage.completion_tokens
+
+def _messages(system_content, user_content):
+    return [
+        {
+            "role": "system", 
+            "content": system_content
+        },
+        {"role": "user", "content": user_content},
+    ]
+
+def _generate(client, system_content, user_content, response_format, model=GENERATION_MODEL):
+    """Run one structured generation call and return the parsed output with its usage."""
+    messages = _messages(system_content, user_content)
+    with openai_call(messages):
+        started = time.perf_counter()
+        completion = client.beta.chat.completions.parse(
+            model=model,
+            messages=messages,
+            response_format=response_format
+        )
+    record_route_call('generate', model, time.perf_counter() - started, completion.usage)
+    
+    # Get the JSON string
+    output_str = completion.choices[0].message.content
+    
+    # Use model_validate_json instead of parse_raw
+    return response_format.model_validate_json(output_str), completion.usage
+
+async def _generate_async(client, system_content, user_content, response_format, model=GENERATION_MODEL):
+    """_generate on the AsyncOpenAI client."""
+    messages = _messages(system_content, user_content)
+    async with openai_call_async(messages):
+        started = time.perf_counter()
+        completion = await client.beta.chat.completions.parse(
+            model=model,
+            messages=messages,
+            response_format=response_format
+        )
+    record_route_call('generate', model, time.perf_counter() - started, completion.usage)
+    return response_format.model_validate_json(completion.choices[0].message.content), completion.usage
+
+def _log_verification(future, mode, started):
+    """Log the outcome of a verification that ran in the background."""
+    email_verified, usage = future.result()
+    prompt_tokens, completion_tokens = _usage_tokens(usage)
+    logger.info(
+        f"Background verification ({mode}): verified={email_verified.isVerified} "
+        f"verify_ms={(time.perf_counter() - started) * 1000:.0f} "
+        f"verify_prompt_tokens={prompt_tokens} verify_completion_tokens={completion_tokens}"
+    )
+    if not email_verified.isVerified:
+        logger.warning(f"Background verification flagged email: {email_verified.issueDesc}")
+
+def _self_check(mode, fused_output):
+    """
+    The fused output's own verdict when it is enough (fused mode, or threshold mode with a
+    confident verified self-check); None when mailVerifed has to run.
+    """
+    if mode not in ('fused', 'threshold'):
+        return None
+    if mode == 'threshold' and (not fused_output.isVerified or fused_output.confidence < VERIFY_SKIP_CONFIDENCE):
+        logger.info(f"Self-check confidence {fused_output.confidence:.2f} below {VERIFY_SKIP_CONFIDENCE}, verifying")
+        return None
+    return MailResults(issueDesc=fused_output.issueDesc, isVerified=fused_output.isVerified)
+
+def _verify(mode, questions_and_answers, email_output, fused_output=None):
+    """Verification verdict and its usage for a mode that waits for it (every mode but background async)."""
+    self_check = _self_check(mode, fused_output)
+    if self_check is not None:
+        return self_check, None
+    return mailVerifedWithUsage(questions_and_answers, email_output.messageText)
+
+async def _verify_async(mode, questions_and_answers, email_output, fused_output=None):
+    self_check = _self_check(mode, fused_output)
+    if self_check is not None:
+        return self_check, None
+    return await mailVerifedWithUsageAsync(questions_and_answers, email_output.messageText)
+
+def _partial_fields(snapshot: str) -> dict:
+    """Fields of a JSON object that is still being streamed; the last string may be cut off."""
+    try:
+        parsed = jiter.from_json(snapshot.encode('utf-8'), partial_mode='trailing-strings')
+    except ValueError:
+        # Cut in the middle of an escape sequence; the next chunk completes it
+        return {}
+    return parsed if isinstance(parsed, dict) else {}
+
+def _system_content(system_instructions_path, mode):
+    if system_instructions_path is None:
+        script_dir = Path(os.path.dirname(os.path.abspath(__file__)))
+        system_instructions_path = str(script_dir / 'systemInstructions.txt')
+
+    logger.info(f"Using system instructions path: {system_instructions_path}", extra=SAMPLED)
+    system_content = prepare_messages(system_instructions_path)
+    if mode in ('fused', 'threshold'):
+        return system_content + FUSED_VERIFICATION_INSTRUCTIONS
+    return system_content
+
+def _verification_executor():
+    global _verify_executor
+    if _verify_executor is None:
+        with _verify_executor_lock:
+            if _verify_executor is None:
+                _verify_executor = ThreadPoolExecutor(max_workers=VERIFY_WORKERS, thread_name_prefix="verify")
+    return _verify_executor
+
+def _finish(mode, stage_timings, email_output, email_verified, generate_usage, verify_usage, html_response):
+    """Log the run and build m()'s return value."""
+    generate_prompt, generate_completion = _usage_tokens(generate_usage)
+    verify_prompt, verify_completion = _usage_tokens(verify_usage)
+    logger.info(
+        f"Pipeline mode={mode} generate_ms={stage_timings['generate_ms']:.0f} "
+        f"verify_ms={stage_timings['verify_ms']:.0f} "
+        f"total_ms={stage_timings['generate_ms'] + stage_timings['verify_ms']:.0f} "
+        f"prompt_tokens={generate_prompt + verify_prompt} "
+        f"completion_tokens={generate_completion + verify_completion}"
+        + (" verification=pending" if email_verified is None else "")
+    )
+
+    # None while the verification runs in the background (async mode)
+    stage_timings['verified'] = email_verified.isVerified if email_verified is not None else None
+    if email_verified is not None:
+        logger.info(f"Email verification result: {email_verified.isVerified}")
+        # The correlation filter adds the job and item ids
+        logger.debug(f"Email verification details: {email_verified.issueDesc}")
+
+    if html_response:
+        return email_output_to_html(email_output, email_verified)
+    else:
+        return email_output.messageText
+
+def m(ex_qanda=None, html_response=True, system_instructions_path=None, pipeline_mode=None, timings=None, model=None):
     """
     Generate and validate the email output.
+
+    pipeline_mode (default PIPELINE_MODE) picks how verification is done:
+    sequential - generate, then verify with mailVerifed (two calls, in order)
+    fused      - one call whose schema includes the self-check
+    async      - generate, verify in the background; the text is returned without waiting
+    threshold  - fused call, plus mailVerifed only when the self-check is not verified
+                 or its confidence is below VERIFY_SKIP_CONFIDENCE
+
+    When a timings dict is passed, generate_ms, verify_ms and the verdict ('verified': True,
+    False, or None when it is still pending) are added to it.
+    model (default GENERATION_MODEL) writes the email, e.g. the board's generation_model.
     """
     try:
-        if system_instructions_path is None:
-            script_dir = Path(os.path.dirname(os.path.abspath(__file__)))
-            system_instructions_path = str(script_dir / 'systemInstructions.txt')
-            
-        logger.info(f"Using system instructions path: {system_instructions_path}")
-        system_content = prepare_messages(system_instructions_path)
-        logger.info("Successfully loaded system instructions")
+        mode = pipeline_mode or PIPELINE_MODE
+        model = model or GENERATION_MODEL
+        if mode not in PIPELINE_MODES:
+            raise ValueError(f"Unknown pipeline mode: {mode}")
+
+        system_content = _system_content(system_instructions_path, mode)
         
         questions_and_answers = ""
         if ex_qanda:
@@ -137,43 +309,146 @@ def m(ex_qanda=None, html_response=True, system_instructions_path=None):
             
         user_content = questions_and_answers
 
-        # Initialize OpenAI client
-        client = OpenAI()
+        # Shared OpenAI client of this worker
+        client = get_openai_client()
 
-        completion = client.beta.chat.completions.parse(
-            model="gpt-4o",
-            messages=[
-                {
-                    "role": "system", 
-                    "content": system_content
-                },
-                {"role": "user", "content": user_content},
-            ],
-            response_format=EmailOutput
-        )
-        
-        # Get the JSON string
-        email_output_str = completion.choices[0].message.content
-        
-        # Use model_validate_json instead of parse_raw
-        email_output = EmailOutput.model_validate_json(email_output_str)
-        
-        # Now verify with the parsed model
-        email_verified = mailVerifed(questions_and_answers, email_output.messageText)
-        print("==========check this =============================")
-        print("this is the email output", email_verified)
-        #todo: add the output from vaildator to monday and remove this print
-        logger.info(f"Email verification result: {email_verified.isVerified}")
+        # Filled by the spans even when the caller passed no timings dict
+        stage_timings = timings if timings is not None else {}
+        with span('generate', stage_timings, pipeline_mode=mode):
+            if mode in ('fused', 'threshold'):
+                fused_output, generate_usage = _generate(client, system_content, user_content, FusedEmailOutput, model)
+                email_output = EmailOutput(**fused_output.model_dump(include=set(EmailOutput.model_fields)))
+            else:
+                fused_output = None
+                email_output, generate_usage = _generate(client, system_content, user_content, EmailOutput, model)
+        generated = time.perf_counter()
 
-        if html_response:
-            return email_output_to_html(email_output, email_verified)
-        else:
-            return email_output.messageText
+        email_verified, verify_usage, verify_future = None, None, None
+        with span('verify', stage_timings, pipeline_mode=mode):
+            if mode == 'async' and not html_response:
+                # Run in a copy of this context so the background log lines keep the job/item ids
+                verify_future = _verification_executor().submit(
+                    contextvars.copy_context().run, mailVerifedWithUsage, questions_and_answers, email_output.messageText
+                )
+                verify_future.add_done_callback(lambda f: _log_verification(f, mode, generated))
+            else:
+                # The tester page shows the verdict, so async mode waits for it there too
+                email_verified, verify_usage = _verify(mode, questions_and_answers, email_output, fused_output)
+
+        return _finish(mode, stage_timings, email_output, email_verified, generate_usage, verify_usage, html_response)
             
     except Exception as e:
         logger.error(f"Error in m(): {str(e)}")
         logger.error(f"Full error details: {e.__class__.__name__}: {str(e)}")
         raise
 
+async def m_async(ex_qanda=None, html_response=True, system_instructions_path=None, pipeline_mode=None, timings=None,
+                  model=None):
+    """
+    m() for the ASGI app: the same pipeline modes on the AsyncOpenAI client, so the event
+    loop serves other requests while the model calls are in flight. In async mode the
+    background verification is an asyncio task instead of a thread.
+    """
+    try:
+        mode = pipeline_mode or PIPELINE_MODE
+        model = model or GENERATION_MODEL
+        if mode not in PIPELINE_MODES:
+            raise ValueError(f"Unknown pipeline mode: {mode}")
+
+        # Reads the instructions file when its mtime changed
+        system_content = await asyncio.to_thread(_system_content, system_instructions_path, mode)
+        questions_and_answers = ex_qanda or ""
+        client = get_async_openai_client()
+
+        stage_timings = timings if timings is not None else {}
+        with span('generate', stage_timings, pipeline_mode=mode):
+            if mode in ('fused', 'threshold'):
+                fused_output, generate_usage = await _generate_async(
+                    client, system_content, questions_and_answers, FusedEmailOutput, model
+                )
+                email_output = EmailOutput(**fused_output.model_dump(include=set(EmailOutput.model_fields)))
+            else:
+                fused_output = None
+                email_output, generate_usage = await _generate_async(
+                    client, system_content, questions_and_answers, EmailOutput, model
+                )
+        generated = time.perf_counter()
+
+        email_verified, verify_usage = None, None
+        with span('verify', stage_timings, pipeline_mode=mode):
+            if mode == 'async' and not html_response:
+                task = asyncio.create_task(mailVerifedWithUsageAsync(questions_and_answers, email_output.messageText))
+                _background_verifications.add(task)
+                task.add_done_callback(_background_verifications.discard)
+                task.add_done_callback(lambda t: _log_verification(t, mode, generated))
+            else:
+                email_verified, verify_usage = await _verify_async(
+                    mode, questions_and_answers, email_output, fused_output
+                )
+
+        return _finish(mode, stage_timings, email_output, email_verified, generate_usage, verify_usage, html_response)
+
+    except Exception as e:
+        logger.error(f"Error in m_async(): {str(e)}")
+        logger.error(f"Full error details: {e.__class__.__name__}: {str(e)}")
+        raise
+
+def sse_event(event: str, data: dict) -> str:
+    """One server-sent event of a stream_email() pair (shared by app.py and asgi_app.py)"""
+    return f"event: {event}\ndata: {json.dumps(data, ensure_ascii=False)}\n\n"
+
+def stream_email(ex_qanda, system_instructions_path=None, pipeline_mode=None, model=None):
+    """
+    Generate and verify the email like m(), yielding (event, data) pairs as it goes:
+    ('delta', {'field', 'text'}) for each new piece of emailSubject / messageText,
+    ('email', EmailOutput fields) once generation is done, then
+    ('verification', MailResults fields). The verdict is always waited for, as m() does
+    for the tester page.
+    """
+    mode = pipeline_mode or PIPELINE_MODE
+    model = model or GENERATION_MODEL
+    if mode not in PIPELINE_MODES:
+        raise ValueError(f"Unknown pipeline mode: {mode}")
+
+    system_content = _system_content(system_instructions_path, mode)
+    questions_and_answers = ex_qanda or ""
+    response_format = FusedEmailOutput if mode in ('fused', 'threshold') else EmailOutput
+    stage_timings = {}
+
+    with span('generate', stage_timings, pipeline_mode=mode, streamed=True):
+        messages = _messages(system_content, questions_and_answers)
+        sent = dict.fromkeys(STREAMED_FIELDS, 0)
+        started = time.perf_counter()
+        with openai_call(messages), get_openai_client().beta.chat.completions.stream(
+            model=model,
+            messages=messages,
+            response_format=response_format,
+            stream_options={"include_usage": True}
+        ) as stream:
+            for event in stream:
+                if event.type != 'content.delta':
+                    continue
+                fields = _partial_fields(event.snapshot)
+                for field in STREAMED_FIELDS:
+                    value = fields.get(field)
+                    if isinstance(value, str) and len(value) > sent[field]:
+                        yield 'delta', {'field': field, 'text': value[sent[field]:]}
+                        sent[field] = len(value)
+            completion = stream.get_final_completion()
+        record_route_call('generate', model, time.perf_counter() - started, completion.usage)
+
+        output = completion.choices[0].message.parsed
+        if output is None:
+            raise ValueError(f"Model returned no email: {completion.choices[0].message.refusal}")
+        email_output = EmailOutput(**output.model_dump(include=set(EmailOutput.model_fields)))
+    yield 'email', email_output.model_dump()
+
+    with span('verify', stage_timings, pipeline_mode=mode, streamed=True):
+        email_verified, _ = _verify(mode, questions_and_answers, email_output,
+                                    output if response_format is FusedEmailOutput else None)
+    logger.info(f"Email verification result: {email_verified.isVerified}")
+    yield 'verification', email_verified.model_dump()
+
 if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
     m()
\ No newline at end of file
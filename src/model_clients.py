@@ -0,0 +1,137 @@
+"""
+Process-wide registry for the OpenAI client and the prompt files it is used with.
+
+Every gunicorn worker builds a single pooled OpenAI client on first use and reuses it for
+all calls (the ASGI app keeps one AsyncOpenAI client the same way), the system instructions
+are read from disk only when the file changes, and API readiness is checked in the
+background so /health does not call OpenAI per probe. The openai package takes about half
+a second to import, so it is only imported when the first client is built.
+"""
+import hashlib
+import logging
+import os
+import threading
+import time
+from typing import TYPE_CHECKING
+
+if TYPE_CHECKING:
+    from openai import AsyncOpenAI, OpenAI
+
+logger = logging.getLogger(__name__)
+
+OPENAI_TIMEOUT = float(os.getenv('OPENAI_TIMEOUT', 60))
+OPENAI_MAX_RETRIES = int(os.getenv('OPENAI_MAX_RETRIES', 2))
+# How long a readiness result is trusted before /health triggers a new check
+OPENAI_READINESS_TTL = float(os.getenv('OPENAI_READINESS_TTL', 300))
+
+_client = None
+_client_lock = threading.Lock()
+_async_client = None
+
+_instructions = {}
+_instructions_lock = threading.Lock()
+
+_readiness = {'status': 'unknown', 'checked_at': None, 'error': None}
+_readiness_lock = threading.Lock()
+_readiness_refreshing = False
+
+
+def get_openai_client() -> 'OpenAI':
+    """Return the OpenAI client of this process, creating it on first use."""
+    global _client
+    if _client is None:
+        with _client_lock:
+            if _client is None:
+                from openai import OpenAI
+                _client = OpenAI(timeout=OPENAI_TIMEOUT, max_retries=OPENAI_MAX_RETRIES)
+                logger.info("Created OpenAI client")
+    return _client
+
+
+def get_async_openai_client() -> 'AsyncOpenAI':
+    """
+    Return the AsyncOpenAI client of this process; only used by the ASGI app. Its calls
+    run on the event loop, but the warm-up creates it in a thread (import and SSL setup block).
+    """
+    global _async_client
+    if _async_client is None:
+        with _client_lock:
+            if _async_client is None:
+                from openai import AsyncOpenAI
+                _async_client = AsyncOpenAI(timeout=OPENAI_TIMEOUT, max_retries=OPENAI_MAX_RETRIES)
+                logger.info("Created async OpenAI client")
+    return _async_client
+
+
+async def close_async_openai_client():
+    global _async_client
+    if _async_client is not None:
+        await _async_client.close()
+        _async_client = None
+
+
+def load_system_instructions(file_path) -> str:
+    """Return the contents of an instructions file, re-reading it only when its mtime changes."""
+    path = str(file_path)
+    mtime = os.stat(path).st_mtime_ns
+    cached = _instructions.get(path)
+    if cached and cached[0] == mtime:
+        return cached[1]
+
+    with _instructions_lock:
+        cached = _instructions.get(path)
+        if cached and cached[0] == mtime:
+            return cached[1]
+        with open(path, 'r', encoding='utf-8') as file:
+            content = file.read()
+        _instructions[path] = (mtime, content)
+        logger.info(f"Loaded {len(content)} characters of system instructions from {path}")
+        return content
+
+
+def instructions_version(file_path) -> str:
+    """Short content hash of the instructions file, changes whenever the prompt text does."""
+    content = load_system_instructions(file_path)
+    return hashlib.sha256(content.encode('utf-8')).hexdigest()[:16]
+
+
+def check_openai_readiness() -> dict:
+    """Call the OpenAI API once and store the result as the current readiness."""
+    try:
+        get_openai_client().models.list()
+        result = {'status': 'ready', 'checked_at': time.time(), 'error': None}
+    except Exception as e:
+        logger.error(f"OpenAI readiness check failed: {str(e)}")
+        result = {'status': 'error', 'checked_at': time.time(), 'error': str(e)}
+    with _readiness_lock:
+        _readiness.update(result)
+    return dict(result)
+
+
+def _refresh_readiness():
+    global _readiness_refreshing
+    try:
+        check_openai_readiness()
+    finally:
+        with _readiness_lock:
+            _readiness_refreshing = False
+
+
+def openai_readiness() -> dict:
+    """
+    Return the last known readiness without blocking. When the result is older than
+    OPENAI_READINESS_TTL a background re-check is started for the next caller.
+    """
+    global _readiness_refreshing
+    with _readiness_lock:
+        stale = _readiness['checked_at'] is None or time.time() - _readiness['checked_at'] > OPENAI_READINESS_TTL
+        if stale and not _readiness_refreshing:
+            _readiness_refreshing = True
+            threading.Thread(target=_refresh_readiness, name="openai-readiness", daemon=True).start()
+        return dict(_readiness)
+
+
+def init_model_clients():
+    """Build the client ahead of the first call and start the first readiness check (calls OpenAI)."""
+    get_openai_client()
+    openai_readiness()
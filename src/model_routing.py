@@ -0,0 +1,134 @@
+"""
+Which model serves each pipeline stage, and what each route costs.
+
+GENERATION_MODEL writes the email. Verification is a yes/no check, so it goes to the
+smaller VERIFY_MODEL first and only escalates to VERIFY_ESCALATION_MODEL when the small
+model says not verified, is less sure than VERIFY_ESCALATE_CONFIDENCE, or the call is in
+the VERIFY_AUDIT_RATE sample of confident ones (which measures how often it is wrong
+when it is sure). Every call is recorded per route (stage and model): latency, tokens and
+estimated cost, plus whether the two models agreed on each escalation, in Prometheus and
+in route_stats() for /health.
+"""
+import logging
+import os
+import random
+import threading
+
+from telemetry import MODEL_COST, ROUTE_ESCALATIONS, observe_model_call
+
+logger = logging.getLogger(__name__)
+
+GENERATION_MODEL = os.getenv('GENERATION_MODEL', 'gpt-4o')
+VERIFY_MODEL = os.getenv('VERIFY_MODEL', 'gpt-4o-mini')
+# Empty (or the same as VERIFY_MODEL) turns escalation off
+VERIFY_ESCALATION_MODEL = os.getenv('VERIFY_ESCALATION_MODEL', 'gpt-4o')
+VERIFY_ESCALATE_CONFIDENCE = float(os.getenv('VERIFY_ESCALATE_CONFIDENCE', 0.8))
+# Share of confident "verified" answers that are checked by the escalation model anyway
+VERIFY_AUDIT_RATE = float(os.getenv('VERIFY_AUDIT_RATE', 0.05))
+
+# USD per million (prompt, completion) tokens
+MODEL_PRICES = {
+    'gpt-4o': (2.50, 10.00),
+    'gpt-4o-2024-08-06': (2.50, 10.00),
+    'gpt-4o-mini': (0.15, 0.60),
+    'gpt-4o-mini-2024-07-18': (0.15, 0.60),
+}
+
+# Why a verification was escalated
+NOT_VERIFIED = 'not_verified'
+LOW_CONFIDENCE = 'low_confidence'
+AUDIT = 'audit'
+
+_lock = threading.Lock()
+_routes = {}
+_escalations = {}
+_unpriced = set()
+
+
+def escalation_enabled() -> bool:
+    return bool(VERIFY_ESCALATION_MODEL) and VERIFY_ESCALATION_MODEL != VERIFY_MODEL
+
+
+def final_verify_model() -> str:
+    """The model whose verdict counts when only one verification call is made (e.g. the Batch API)."""
+    return VERIFY_ESCALATION_MODEL if escalation_enabled() else VERIFY_MODEL
+
+
+def escalation_reason(is_verified: bool, confidence: float):
+    """Why the small model's verdict needs a second opinion, or None when it stands."""
+    if not escalation_enabled():
+        return None
+    if not is_verified:
+        return NOT_VERIFIED
+    if confidence < VERIFY_ESCALATE_CONFIDENCE:
+        return LOW_CONFIDENCE
+    if random.random() < VERIFY_AUDIT_RATE:
+        return AUDIT
+    return None
+
+
+def model_cost(model: str, usage) -> float:
+    """Estimated USD cost of a call's usage (0 for models missing from MODEL_PRICES)."""
+    if usage is None:
+        return 0.0
+    prices = MODEL_PRICES.get(model)
+    if prices is None:
+        if model not in _unpriced:
+            _unpriced.add(model)
+            logger.warning(f"No price for model {model}, its cost is not tracked")
+        return 0.0
+    return ((usage.prompt_tokens or 0) * prices[0] + (usage.completion_tokens or 0) * prices[1]) / 1_000_000
+
+
+def record_route_call(stage: str, model: str, seconds: float, usage=None):
+    """Record one model call of a stage: Prometheus latency/tokens/cost and the per-route totals."""
+    observe_model_call(model, stage, seconds, usage)
+    cost = model_cost(model, usage)
+    MODEL_COST.labels(model=model, call=stage).inc(cost)
+    with _lock:
+        route = _routes.setdefault(f"{stage}:{model}", {
+            'calls': 0, 'latency_total_ms': 0.0, 'prompt_tokens': 0, 'completion_tokens': 0, 'cost_usd': 0.0
+        })
+        route['calls'] += 1
+        route['latency_total_ms'] += seconds * 1000
+        route['cost_usd'] += cost
+        if usage is not None:
+            route['prompt_tokens'] += usage.prompt_tokens or 0
+            route['completion_tokens'] += usage.completion_tokens or 0
+
+
+def record_escalation(stage: str, reason: str, first_verdict: bool, final_verdict: bool):
+    """Record whether the escalation model agreed with the small model's verdict."""
+    outcome = 'agreed' if first_verdict == final_verdict else 'disagreed'
+    ROUTE_ESCALATIONS.labels(stage=stage, reason=reason, outcome=outcome).inc()
+    with _lock:
+        counts = _escalations.setdefault(stage, {}).setdefault(reason, {'agreed': 0, 'disagreed': 0})
+        counts[outcome] += 1
+    if outcome == 'disagreed':
+        logger.info(f"{stage} escalation ({reason}): small model said {first_verdict}, escalation model {final_verdict}")
+
+
+def route_stats() -> dict:
+    """Configured routes and what they did in this process, for /health."""
+    with _lock:
+        routes = {name: dict(route) for name, route in _routes.items()}
+        escalations = {stage: {reason: dict(counts) for reason, counts in reasons.items()}
+                       for stage, reasons in _escalations.items()}
+    for route in routes.values():
+        route['latency_avg_ms'] = round(route['latency_total_ms'] / route['calls'], 1) if route['calls'] else None
+        route['cost_usd'] = round(route['cost_usd'], 6)
+    for reasons in escalations.values():
+        for counts in reasons.values():
+            total = counts['agreed'] + counts['disagreed']
+            counts['disagreement_rate'] = round(counts['disagreed'] / total, 3) if total else None
+    return {
+        'config': {
+            'generate': GENERATION_MODEL,
+            'verify': VERIFY_MODEL,
+            'verify_escalation': VERIFY_ESCALATION_MODEL if escalation_enabled() else None,
+            'verify_escalate_confidence': VERIFY_ESCALATE_CONFIDENCE,
+            'verify_audit_rate': VERIFY_AUDIT_RATE,
+        },
+        'routes': routes,
+        'escalations': escalations,
+    }
@@ -0,0 +1,321 @@
+"""
+Shared Monday.com GraphQL client.
+
+One pooled keep-alive requests.Session per API key, so item reads and write-backs reuse
+warm connections instead of paying a TCP+TLS handshake per call. Calls have timeouts,
+are retried with backoff on connection errors, 5xx, 429 and complexity-budget errors
+(honoring the wait Monday asks for), and latency / complexity numbers are kept for /health.
+Calls go through resilience.monday_breaker: while it is open they raise DependencyUnavailable
+without touching the network.
+AsyncMondayClient does the same on httpx for the ASGI app (asgi_app.py); httpx is only
+imported by it, so the sync app does not pay for the import.
+"""
+import asyncio
+import logging
+import os
+import random
+import re
+import threading
+import time
+
+import requests
+from requests.adapters import HTTPAdapter
+
+from resilience import monday_breaker, record_monday_call
+from telemetry import observe_dependency_call, record_retry
+
+logger = logging.getLogger(__name__)
+
+MONDAY_API_URL = os.getenv('MONDAY_API_URL', 'https://api.monday.com/v2')
+MONDAY_API_VERSION = '2024-01'
+MONDAY_CONNECT_TIMEOUT = float(os.getenv('MONDAY_CONNECT_TIMEOUT', 5))
+MONDAY_READ_TIMEOUT = float(os.getenv('MONDAY_READ_TIMEOUT', 30))
+MONDAY_MAX_RETRIES = int(os.getenv('MONDAY_MAX_RETRIES', 3))
+MONDAY_RETRY_BASE_SECONDS = float(os.getenv('MONDAY_RETRY_BASE_SECONDS', 1))
+MONDAY_RETRY_MAX_SECONDS = float(os.getenv('MONDAY_RETRY_MAX_SECONDS', 60))
+# Every job worker thread (plus a request thread or two) may hold a connection
+MONDAY_POOL_SIZE = int(os.getenv('MONDAY_POOL_SIZE', int(os.getenv('JOB_WORKERS', 2)) + 2))
+# Connections of the asyncio client, shared by all in-flight jobs of an ASGI worker
+MONDAY_ASYNC_POOL_SIZE = int(os.getenv('MONDAY_ASYNC_POOL_SIZE', 100))
+
+# Monday reports rate limiting either with HTTP 429 or as GraphQL errors with these codes
+RATE_LIMIT_ERROR_CODES = {
+    'ComplexityException',
+    'COMPLEXITY_BUDGET_EXHAUSTED',
+    'RATE_LIMIT_EXCEEDED',
+    'maxConcurrencyExceeded',
+    'IP_RATE_LIMIT_EXCEEDED',
+}
+_RESET_IN_RE = re.compile(r'reset in (\d+) seconds?')
+
+
+class MondayAPIError(Exception):
+    """Raised when a Monday.com API call fails after all retries."""
+
+    def __init__(self, message, status_code=None, errors=None):
+        super().__init__(message)
+        self.status_code = status_code
+        self.errors = errors
+
+
+def _error_codes(body: dict) -> set:
+    """Collect error codes from both the legacy and the GraphQL-spec error formats."""
+    codes = set()
+    if body.get('error_code'):
+        codes.add(body['error_code'])
+    for error in body.get('errors') or []:
+        code = (error.get('extensions') or {}).get('code')
+        if code:
+            codes.add(code)
+    return codes
+
+
+def _retry_after(response, body: dict):
+    """Seconds Monday asked us to wait, if it said so."""
+    header = response.headers.get('Retry-After')
+    if header and header.isdigit():
+        return float(header)
+    for error in body.get('errors') or []:
+        seconds = (error.get('extensions') or {}).get('retry_in_seconds')
+        if seconds is not None:
+            return float(seconds)
+    messages = [body.get('error_message') or ''] + [e.get('message') or '' for e in body.get('errors') or []]
+    for message in messages:
+        match = _RESET_IN_RE.search(message)
+        if match:
+            return float(match.group(1))
+    return None
+
+
+def _headers(api_key: str) -> dict:
+    return {
+        "Authorization": f"Bearer {api_key}",
+        "Content-Type": "application/json",
+        "API-Version": MONDAY_API_VERSION
+    }
+
+
+class _MondayClientBase:
+    """Retry decisions and metrics shared by the blocking and the asyncio client."""
+
+    def __init__(self, api_url: str, max_retries: int):
+        self.api_url = api_url
+        self.max_retries = max_retries
+        self._lock = threading.Lock()
+        self._metrics = {
+            'calls': 0,
+            'errors': 0,
+            'retries': 0,
+            'rate_limited': 0,
+            'latency_total_ms': 0.0,
+            'latency_max_ms': 0.0,
+            'latency_last_ms': 0.0,
+            'complexity_last_query': None,
+            'complexity_budget_remaining': None,
+            'complexity_reset_in_seconds': None,
+        }
+
+    def stats(self) -> dict:
+        with self._lock:
+            stats = dict(self._metrics)
+        stats['latency_avg_ms'] = round(stats['latency_total_ms'] / stats['calls'], 1) if stats['calls'] else None
+        return stats
+
+    def _handle_attempt(self, attempt: int, start: float, response=None, error: Exception = None) -> tuple:
+        """
+        Record one attempt (a response, or the transport error that replaced it) and return
+        (body, retry delay). A delay of None means body is the result; when the attempt failed
+        and retries are exhausted, or the error is not retryable, MondayAPIError is raised.
+        """
+        if response is None:
+            self._record_call(start, error=True)
+            if attempt > self.max_retries:
+                record_monday_call(time.perf_counter() - start, failed=True)
+                raise MondayAPIError(f"Monday.com request failed: {str(error)}")
+            return None, self._backoff(attempt, None, f"{error.__class__.__name__}")
+
+        try:
+            body = response.json()
+        except ValueError:
+            body = {}
+
+        rate_limited = response.status_code == 429 or bool(_error_codes(body) & RATE_LIMIT_ERROR_CODES)
+        retryable = rate_limited or response.status_code >= 500
+        self._record_call(start, error=retryable or response.status_code != 200, rate_limited=rate_limited)
+
+        if retryable:
+            if attempt > self.max_retries:
+                record_monday_call(time.perf_counter() - start, failed=True)
+                raise MondayAPIError(
+                    f"Monday.com API error after {attempt} attempts: {response.status_code} - {response.text}",
+                    status_code=response.status_code,
+                    errors=body.get('errors')
+                )
+            reason = 'rate limited' if rate_limited else f"HTTP {response.status_code}"
+            return body, self._backoff(attempt, _retry_after(response, body), reason)
+
+        # Monday answered: a success for the circuit breaker even when the request was rejected
+        record_monday_call(time.perf_counter() - start, failed=False)
+        if response.status_code != 200:
+            raise MondayAPIError(
+                f"Monday.com API error: {response.status_code} - {response.text}",
+                status_code=response.status_code,
+                errors=body.get('errors')
+            )
+
+        self._record_complexity((body.get('data') or {}).get('complexity'))
+        return body, None
+
+    def _backoff(self, attempt: int, retry_after, reason: str) -> float:
+        """Seconds to wait before the next attempt."""
+        if retry_after is None:
+            delay = min(MONDAY_RETRY_MAX_SECONDS, MONDAY_RETRY_BASE_SECONDS * (2 ** (attempt - 1)))
+            delay += random.uniform(0, delay / 4)
+        else:
+            delay = min(MONDAY_RETRY_MAX_SECONDS, retry_after)
+        with self._lock:
+            self._metrics['retries'] += 1
+        record_retry('monday_rate_limited' if reason == 'rate limited' else 'monday')
+        logger.warning(f"Monday.com call {reason}, retry {attempt}/{self.max_retries} in {delay:.1f}s")
+        return delay
+
+    def _record_call(self, start: float, error: bool = False, rate_limited: bool = False):
+        elapsed_ms = (time.perf_counter() - start) * 1000
+        observe_dependency_call('monday', elapsed_ms / 1000, not error)
+        with self._lock:
+            self._metrics['calls'] += 1
+            self._metrics['errors'] += int(error)
+            self._metrics['rate_limited'] += int(rate_limited)
+            self._metrics['latency_total_ms'] += elapsed_ms
+            self._metrics['latency_last_ms'] = elapsed_ms
+            self._metrics['latency_max_ms'] = max(self._metrics['latency_max_ms'], elapsed_ms)
+
+    def _record_complexity(self, complexity):
+        if not complexity:
+            return
+        with self._lock:
+            self._metrics['complexity_last_query'] = complexity.get('query')
+            self._metrics['complexity_budget_remaining'] = complexity.get('after')
+            self._metrics['complexity_reset_in_seconds'] = complexity.get('reset_in_x_seconds')
+
+
+class MondayClient(_MondayClientBase):
+    """Pooled, retrying client for the Monday.com GraphQL API."""
+
+    def __init__(self, api_key: str, api_url: str = MONDAY_API_URL, pool_size: int = MONDAY_POOL_SIZE,
+                 timeout=(MONDAY_CONNECT_TIMEOUT, MONDAY_READ_TIMEOUT), max_retries: int = MONDAY_MAX_RETRIES):
+        super().__init__(api_url, max_retries)
+        self.timeout = timeout
+
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size, pool_block=True)
+        self.session.mount('https://', adapter)
+        self.session.mount('http://', adapter)
+        self.session.headers.update(_headers(api_key))
+
+    def execute(self, query: str, variables: dict = None) -> dict:
+        """
+        Run a GraphQL query or mutation and return the decoded JSON body.
+        GraphQL errors that are not rate limits are returned for the caller to inspect;
+        transport failures and exhausted retries raise MondayAPIError, an open circuit
+        DependencyUnavailable.
+        """
+        monday_breaker.before_call()
+        payload = {"query": query, "variables": variables or {}}
+        attempt = 0
+        while True:
+            attempt += 1
+            start = time.perf_counter()
+            response, error = None, None
+            try:
+                response = self.session.post(self.api_url, json=payload, timeout=self.timeout)
+            except (requests.ConnectionError, requests.Timeout) as e:
+                error = e
+
+            body, delay = self._handle_attempt(attempt, start, response, error)
+            if delay is None:
+                return body
+            time.sleep(delay)
+
+
+class AsyncMondayClient(_MondayClientBase):
+    """asyncio version of MondayClient on a pooled httpx.AsyncClient, used by the ASGI app."""
+
+    def __init__(self, api_key: str, api_url: str = MONDAY_API_URL, pool_size: int = MONDAY_ASYNC_POOL_SIZE,
+                 max_retries: int = MONDAY_MAX_RETRIES):
+        import httpx
+        super().__init__(api_url, max_retries)
+        self.http = httpx.AsyncClient(
+            headers=_headers(api_key),
+            timeout=httpx.Timeout(MONDAY_READ_TIMEOUT, connect=MONDAY_CONNECT_TIMEOUT),
+            limits=httpx.Limits(max_connections=pool_size, max_keepalive_connections=pool_size)
+        )
+
+    async def execute(self, query: str, variables: dict = None) -> dict:
+        """Same contract as MondayClient.execute."""
+        import httpx
+        monday_breaker.before_call()
+        payload = {"query": query, "variables": variables or {}}
+        attempt = 0
+        while True:
+            attempt += 1
+            start = time.perf_counter()
+            response, error = None, None
+            try:
+                response = await self.http.post(self.api_url, json=payload)
+            except httpx.TransportError as e:
+                error = e
+
+            body, delay = self._handle_attempt(attempt, start, response, error)
+            if delay is None:
+                return body
+            await asyncio.sleep(delay)
+
+    async def aclose(self):
+        await self.http.aclose()
+
+
+_clients = {}
+_clients_lock = threading.Lock()
+_async_clients = {}
+
+
+def get_monday_client(api_key: str) -> MondayClient:
+    """Return the process-wide client for this API key, creating it on first use."""
+    client = _clients.get(api_key)
+    if client is None:
+        with _clients_lock:
+            client = _clients.get(api_key)
+            if client is None:
+                client = MondayClient(api_key)
+                _clients[api_key] = client
+    return client
+
+
+def get_async_monday_client(api_key: str) -> AsyncMondayClient:
+    """
+    Return the async client for this API key; only used by the ASGI app. Its calls run on
+    the event loop, but the warm-up creates it in a thread (import and SSL setup block).
+    """
+    client = _async_clients.get(api_key)
+    if client is None:
+        with _clients_lock:
+            client = _async_clients.get(api_key)
+            if client is None:
+                client = AsyncMondayClient(api_key)
+                _async_clients[api_key] = client
+    return client
+
+
+async def close_async_monday_clients():
+    for client in list(_async_clients.values()):
+        await client.aclose()
+    _async_clients.clear()
+
+
+def monday_stats() -> dict:
+    """Metrics of every Monday client in this process (normally just one)."""
+    clients = list(_clients.values()) + list(_async_clients.values())
+    if len(clients) == 1:
+        return clients[0].stats()
+    return {'clients': [client.stats() for client in clients]}
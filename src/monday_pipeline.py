@@ -0,0 +1,360 @@
+"""
+Monday.com item pipeline: fetch an item, generate the update email and write it back.
+
+These functions used to live in app.py; they are kept here so the background job
+workers can run the pipeline without going through a Flask request. The *_async
+variants run the same steps on the async clients for the ASGI app (asgi_app.py).
+The column written to, the system instructions and the model come from the item's
+board config (board_config.py).
+"""
+import asyncio
+import logging
+
+from board_config import BoardConfig, get_board_config
+from board_schema import get_field_classifier
+from campaign_store import campaign_context
+from main_2 import m, m_async
+from model_clients import instructions_version
+from monday_client import get_async_monday_client, get_monday_client
+from prompt_builder import build_user_prompt
+from resilience import DependencyUnavailable
+from response_cache import get_response_cache, make_key
+from telemetry import SAMPLED, record_cache, span
+
+logger = logging.getLogger(__name__)
+
+ITEM_DETAILS_QUERY = """
+query ($itemId: [ID!]) {
+    complexity {
+        query
+        after
+        reset_in_x_seconds
+    }
+    items(ids: $itemId) {
+        id
+        name
+        board {
+            id
+        }
+        column_values {
+            id
+            text
+            value
+            type
+        }
+    }
+}
+"""
+
+UPDATE_EMAIL_MUTATION = """
+mutation ($itemId: ID!, $boardId: ID!, $columnId: String!, $emailBody: String!) {
+    complexity {
+        query
+        after
+        reset_in_x_seconds
+    }
+    change_simple_column_value(
+        item_id: $itemId,
+        board_id: $boardId,
+        column_id: $columnId,
+        value: $emailBody
+    ) {
+        id
+    }
+}
+"""
+
+
+def _fetched_item(data: dict):
+    """The item of an ITEM_DETAILS_QUERY response, or None"""
+    if 'data' in data and 'items' in data['data'] and data['data']['items']:
+        item = data['data']['items'][0]
+        logger.info(f"Board ID from API: {item['board']['id']}", extra=SAMPLED)
+        return item
+    return None
+
+def get_monday_board_and_item_details(item_id: int, api_key: str) -> dict:
+    """
+    Fetch item details from Monday.com; the board's columns come from the schema cache
+    """
+    variables = {
+        "itemId": [str(item_id)]
+    }
+
+    try:
+        item = _fetched_item(get_monday_client(api_key).execute(ITEM_DETAILS_QUERY, variables))
+        if item:
+            board_id = str(item['board']['id'])
+
+            # Column roles, compiled once per board
+            fields = get_field_classifier(board_id, api_key, [column_value['id'] for column_value in item['column_values']])
+
+            processed_data = fields.build_monday_data(item)
+
+            logger.info(f"Processing data for item: {item['name']}", extra=SAMPLED)
+
+            return processed_data
+
+    except DependencyUnavailable:
+        # Let the job queue defer the job instead of failing it
+        raise
+    except Exception as e:
+        logger.error(f"Error fetching Monday.com details: {str(e)}")
+        return None
+
+async def get_monday_board_and_item_details_async(item_id, api_key: str) -> dict:
+    """get_monday_board_and_item_details on the async Monday client"""
+    try:
+        item = _fetched_item(await get_async_monday_client(api_key).execute(ITEM_DETAILS_QUERY, {"itemId": [str(item_id)]}))
+        if item:
+            board_id = str(item['board']['id'])
+            # The schema cache is shared with the sync path; it rarely calls Monday, so a thread is fine
+            fields = await asyncio.to_thread(
+                get_field_classifier, board_id, api_key, [column_value['id'] for column_value in item['column_values']]
+            )
+            logger.info(f"Processing data for item: {item['name']}", extra=SAMPLED)
+            return fields.build_monday_data(item)
+
+    except DependencyUnavailable:
+        raise
+    except Exception as e:
+        logger.error(f"Error fetching Monday.com details: {str(e)}")
+        return None
+
+def format_qa_text(monday_data: dict) -> str:
+    """Build the user prompt (Q&A pairs, business description, campaign page) from the Monday.com data"""
+    if not monday_data or 'business' not in monday_data or 'qa_pairs' not in monday_data:
+        raise ValueError("Invalid Monday.com data format")
+
+    # Per-item detail, kept for LOG_SAMPLE_RATE of the items
+    logger.info(f"Business info: {monday_data.get('business', {})}", extra=SAMPLED)
+    logger.info(f"Number of QA pairs: {len(monday_data.get('qa_pairs', []))}", extra=SAMPLED)
+
+    # The pairs were selected by the board's FieldClassifier; ordering and the token budget live in prompt_builder
+    business_info = monday_data.get('business', {})
+    return build_user_prompt(
+        monday_data.get('qa_pairs', []),
+        business_info.get('description', ''),
+        campaign_context=campaign_context(business_info.get('name', ''))
+    ).text
+
+def email_cache_key(formatted_text: str, board: BoardConfig = None) -> str:
+    """Response cache key of a formatted prompt under the board's current instructions and model"""
+    board = board or get_board_config(None)
+    return make_key(formatted_text, instructions_version(board.system_instructions_path), board.generation_model)
+
+def generate_email_content(monday_data: dict, timings: dict = None) -> str:
+    """
+    Format the Monday.com Q&A and generate the email text. Raises on failure.
+    When a timings dict is passed, per-stage durations in ms are added to it.
+    """
+    with span('format', timings):
+        formatted_text = format_qa_text(monday_data)
+    board = get_board_config(monday_data.get('board_id'))
+
+    # Same Q&A, prompt and model as an earlier run: reuse that email
+    cache = get_response_cache()
+    if cache is not None:
+        cache_key = email_cache_key(formatted_text, board)
+        cached = cache.get(cache_key)
+        record_cache('response', cached is not None)
+        if cached is not None:
+            logger.info("Using cached email content")
+            if timings is not None:
+                timings['cache_hit'] = True
+            return cached
+
+    # Call m() from main_2.py to handle the OpenAI interaction
+    run = timings if timings is not None else {}
+    response = m(formatted_text, html_response=False, system_instructions_path=board.system_instructions_path,
+                 timings=run, model=board.generation_model)
+
+    if not response:
+        raise RuntimeError("No response received from main service")
+
+    # Only verified emails are replayed for the same Q&A
+    if cache is not None and run.get('verified'):
+        cache.put(cache_key, response)
+
+    # Response is already a string, just return it
+    return response
+
+def _prepare_prompt(monday_data: dict, with_cache_key: bool):
+    """(formatted prompt, board config, response cache key or None) of the item"""
+    formatted_text = format_qa_text(monday_data)
+    board = get_board_config(monday_data.get('board_id'))
+    return formatted_text, board, email_cache_key(formatted_text, board) if with_cache_key else None
+
+async def generate_email_content_async(monday_data: dict, timings: dict = None) -> str:
+    """
+    generate_email_content on the async OpenAI client. The blocking steps (token budget,
+    campaign_store and cache SQLite calls, board config and instructions mtime checks)
+    run in a thread, so the event loop keeps acknowledging webhooks meanwhile.
+    """
+    cache = get_response_cache()
+    with span('format', timings):
+        formatted_text, board, cache_key = await asyncio.to_thread(_prepare_prompt, monday_data, cache is not None)
+
+    if cache is not None:
+        cached = await asyncio.to_thread(cache.get, cache_key)
+        record_cache('response', cached is not None)
+        if cached is not None:
+            logger.info("Using cached email content")
+            if timings is not None:
+                timings['cache_hit'] = True
+            return cached
+
+    run = timings if timings is not None else {}
+    response = await m_async(formatted_text, html_response=False, system_instructions_path=board.system_instructions_path,
+                             timings=run, model=board.generation_model)
+
+    if not response:
+        raise RuntimeError("No response received from main service")
+
+    if cache is not None and run.get('verified'):
+        await asyncio.to_thread(cache.put, cache_key, response)
+
+    return response
+
+def prepare_and_run_service(monday_data: dict) -> str:
+    try:
+        return generate_email_content(monday_data)
+
+    except Exception as e:
+        logger.error(f"Error in prepare_and_run_service: {str(e)}")
+        logger.exception("Full stack trace:")
+        return f"Error generating email content: {str(e)}"
+
+def _email_update_variables(item_id, email_content: str, board_id: str) -> dict:
+    return {
+        "itemId": str(item_id),
+        "boardId": board_id,
+        "columnId": get_board_config(board_id).output_column,
+        "emailBody": email_content
+    }
+
+def _email_updated(data: dict, item_id) -> bool:
+    if data.get('data', {}).get('change_simple_column_value', {}).get('id'):
+        logger.info(f"Successfully updated email content for item {item_id}")
+        return True
+
+    if 'errors' in data:
+        logger.error(f"Monday.com API returned errors: {data['errors']}")
+
+    return False
+
+def update_monday_item_email(item_id: int, email_content: str, api_key: str, board_id: str) -> bool:
+    """Update the email content in Monday.com item"""
+    try:
+        data = get_monday_client(api_key).execute(UPDATE_EMAIL_MUTATION, _email_update_variables(item_id, email_content, board_id))
+        return _email_updated(data, item_id)
+
+    except DependencyUnavailable:
+        raise
+    except Exception as e:
+        logger.error(f"Error updating Monday.com item: {str(e)}")
+        return False
+
+async def update_monday_item_email_async(item_id, email_content: str, api_key: str, board_id: str) -> bool:
+    """update_monday_item_email on the async Monday client"""
+    try:
+        data = await get_async_monday_client(api_key).execute(
+            UPDATE_EMAIL_MUTATION, _email_update_variables(item_id, email_content, board_id)
+        )
+        return _email_updated(data, item_id)
+
+    except DependencyUnavailable:
+        raise
+    except Exception as e:
+        logger.error(f"Error updating Monday.com item: {str(e)}")
+        return False
+
+def update_monday_items_email(emails: dict, api_key: str, board_id: str) -> set:
+    """
+    Write several generated emails in one mutation (one aliased change per item).
+    emails maps item id -> email text; returns the ids Monday confirmed as updated.
+    """
+    if not emails:
+        return set()
+
+    params = ["$boardId: ID!", "$columnId: String!"]
+    fields = []
+    variables = {"boardId": board_id, "columnId": get_board_config(board_id).output_column}
+    aliases = {}
+    for i, (item_id, email_content) in enumerate(emails.items()):
+        params.append(f"$item{i}: ID!, $body{i}: String!")
+        fields.append(
+            f"i{i}: change_simple_column_value(item_id: $item{i}, board_id: $boardId, "
+            f"column_id: $columnId, value: $body{i}) {{ id }}"
+        )
+        variables[f"item{i}"] = str(item_id)
+        variables[f"body{i}"] = email_content
+        aliases[f"i{i}"] = str(item_id)
+
+    query = (
+        f"mutation ({', '.join(params)}) {{\n"
+        "    complexity { query after reset_in_x_seconds }\n    "
+        + "\n    ".join(fields)
+        + "\n}"
+    )
+
+    try:
+        data = get_monday_client(api_key).execute(query, variables)
+    except Exception as e:
+        logger.error(f"Error updating Monday.com items: {str(e)}")
+        return set()
+
+    if data.get('errors'):
+        logger.error(f"Monday.com API returned errors: {data['errors']}")
+    results = data.get('data') or {}
+    return {item_id for alias, item_id in aliases.items() if (results.get(alias) or {}).get('id')}
+
+def process_monday_item(item_id, api_key: str) -> dict:
+    """
+    Run the full fetch -> generate -> verify -> write-back pipeline for one item.
+    Raises on any failure so the job queue can retry it.
+    """
+    timings = {}
+    with span('fetch', timings):
+        monday_data = get_monday_board_and_item_details(item_id, api_key)
+        if not monday_data:
+            raise RuntimeError(f"Could not fetch Monday.com item {item_id}")
+
+    # m() verifies the generated email before returning it
+    email_content = generate_email_content(monday_data, timings=timings)
+    logger.info("Email generated successfully")
+
+    with span('write_back', timings):
+        if not update_monday_item_email(item_id, email_content, api_key, monday_data['board_id']):
+            raise RuntimeError(f"Failed to update Monday.com item {item_id}")
+    logger.info(f"Updated Monday.com item {item_id}")
+
+    return {
+        'item_id': str(item_id),
+        'board_id': monday_data['board_id'],
+        'email_length': len(email_content),
+        'timings': timings
+    }
+
+async def process_monday_item_async(item_id, api_key: str) -> dict:
+    """process_monday_item for the ASGI app's async job workers"""
+    timings = {}
+    with span('fetch', timings):
+        monday_data = await get_monday_board_and_item_details_async(item_id, api_key)
+        if not monday_data:
+            raise RuntimeError(f"Could not fetch Monday.com item {item_id}")
+
+    email_content = await generate_email_content_async(monday_data, timings=timings)
+    logger.info("Email generated successfully")
+
+    with span('write_back', timings):
+        if not await update_monday_item_email_async(item_id, email_content, api_key, monday_data['board_id']):
+            raise RuntimeError(f"Failed to update Monday.com item {item_id}")
+    logger.info(f"Updated Monday.com item {item_id}")
+
+    return {
+        'item_id': str(item_id),
+        'board_id': monday_data['board_id'],
+        'email_length': len(email_content),
+        'timings': timings
+    }
@@ -0,0 +1,155 @@
+"""
+Assembly of the user prompt sent with the system instructions.
+
+The Q&A pairs, business description and campaign page (campaign_store.py) are joined in
+one pass and counted with a local tokenizer (tiktoken, falling back to an estimate when it
+or its encoding file is not available). When the prompt is over PROMPT_TOKEN_BUDGET, the
+context fields (only background for the model, see systemInstructions.txt) are trimmed
+first, the campaign page before the description, then the longest answers are capped so
+short answers are sent whole. Everything per-item lives in the
+user message; the system message stays byte-identical between calls so it is a stable
+prefix for provider-side prompt caching.
+"""
+import logging
+import math
+import os
+import re
+import threading
+from dataclasses import dataclass
+
+from telemetry import PROMPT_TOKENS
+
+logger = logging.getLogger(__name__)
+
+# Tokens allowed for the user prompt (Q&A plus business description)
+PROMPT_TOKEN_BUDGET = int(os.getenv('PROMPT_TOKEN_BUDGET', 1500))
+# A trimmed field keeps at least this many tokens
+PROMPT_MIN_FIELD_TOKENS = int(os.getenv('PROMPT_MIN_FIELD_TOKENS', 40))
+# gpt-4o's encoding
+TOKENIZER_ENCODING = os.getenv('TOKENIZER_ENCODING', 'o200k_base')
+
+TRUNCATION_MARK = ' [...]'
+_SENTENCE_END_RE = re.compile(r'[.!?\n](?=\s|$)')
+
+_encoding = None
+_encoding_loaded = False
+_encoding_lock = threading.Lock()
+
+
+@dataclass
+class BuiltPrompt:
+    text: str
+    tokens: int
+    # Labels of the fields that were shortened to fit the budget
+    truncated: tuple = ()
+
+
+def _get_encoding():
+    """The tiktoken encoding, or None when tiktoken or its encoding file is unavailable."""
+    global _encoding, _encoding_loaded
+    if not _encoding_loaded:
+        with _encoding_lock:
+            if not _encoding_loaded:
+                try:
+                    import tiktoken
+                    _encoding = tiktoken.get_encoding(TOKENIZER_ENCODING)
+                except Exception as e:
+                    # tiktoken downloads the encoding on first use; set TIKTOKEN_CACHE_DIR to ship it
+                    logger.warning(f"tiktoken unavailable ({e.__class__.__name__}), estimating token counts")
+                _encoding_loaded = True
+    return _encoding
+
+
+def count_tokens(text: str) -> int:
+    encoding = _get_encoding()
+    if encoding is not None:
+        return len(encoding.encode(text))
+    # About 4 bytes of UTF-8 per token; overestimates Hebrew a little, which is the safe side
+    return math.ceil(len(text.encode('utf-8')) / 4)
+
+
+def truncate_to_tokens(text: str, max_tokens: int) -> str:
+    """Shorten text to about max_tokens, preferring to cut after a sentence or word."""
+    if count_tokens(text) <= max_tokens:
+        return text
+    encoding = _get_encoding()
+    if encoding is not None:
+        cut = encoding.decode(encoding.encode(text)[:max_tokens])
+    else:
+        cut = text.encode('utf-8')[:max_tokens * 4].decode('utf-8', errors='ignore')
+
+    sentence_ends = [match.end() for match in _SENTENCE_END_RE.finditer(cut)]
+    if sentence_ends and sentence_ends[-1] > len(cut) // 2:
+        cut = cut[:sentence_ends[-1]]
+    elif ' ' in cut[len(cut) // 2:]:
+        cut = cut[:cut.rindex(' ')]
+    return cut.rstrip() + TRUNCATION_MARK
+
+
+def _answer_cap(token_counts: list, available: int) -> int:
+    """Largest per-answer cap whose total fits in available tokens (water-filling)."""
+    remaining, count = available, len(token_counts)
+    for tokens in sorted(token_counts):
+        if tokens * count > remaining:
+            return max(PROMPT_MIN_FIELD_TOKENS, remaining // count)
+        remaining -= tokens
+        count -= 1
+    return max(token_counts, default=0)
+
+
+def _render(qa_pairs: list, context: dict) -> str:
+    parts = [f"Question: {question}\nAnswer: {answer}\n\n" for question, answer in qa_pairs]
+    parts.extend(f"{label}: {value}\n" for label, value in context.items() if value)
+    return ''.join(parts)
+
+
+def build_user_prompt(qa_pairs: list, business_desc: str = '', budget: int = None,
+                      campaign_context: str = '') -> BuiltPrompt:
+    """
+    Build the user prompt from the Monday.com Q&A pairs (dicts with question and answer, as
+    selected by FieldClassifier), the business description and the campaign page text,
+    within budget tokens (default PROMPT_TOKEN_BUDGET).
+    """
+    budget = budget or PROMPT_TOKEN_BUDGET
+    pairs = [(qa['question'], qa['answer']) for qa in qa_pairs]
+    context = {
+        'Business Description': (business_desc or '').strip(),
+        'Campaign Page': (campaign_context or '').strip(),
+    }
+
+    text = _render(pairs, context)
+    tokens = count_tokens(text)
+    truncated = []
+
+    if tokens > budget:
+        answer_tokens = [count_tokens(answer) for _, answer in pairs]
+        context_tokens = {label: count_tokens(value) if value else 0 for label, value in context.items()}
+        overhead = tokens - sum(answer_tokens) - sum(context_tokens.values())
+
+        # Context is only background for the model, so it gives way first, the campaign page before the description
+        over = tokens - budget
+        for label in ('Campaign Page', 'Business Description'):
+            if over <= 0 or not context_tokens[label]:
+                continue
+            keep = max(PROMPT_MIN_FIELD_TOKENS, context_tokens[label] - over)
+            if keep < context_tokens[label]:
+                context[label] = truncate_to_tokens(context[label], keep)
+                over -= context_tokens[label] - count_tokens(context[label])
+                context_tokens[label] = count_tokens(context[label])
+                truncated.append(label)
+
+        available = budget - overhead - sum(context_tokens.values())
+        if sum(answer_tokens) > available:
+            cap = _answer_cap(answer_tokens, available)
+            for i, (question, answer) in enumerate(pairs):
+                if answer_tokens[i] > cap:
+                    pairs[i] = (question, truncate_to_tokens(answer, cap))
+                    truncated.append(question)
+
+        text = _render(pairs, context)
+        tokens = count_tokens(text)
+        logger.info(f"Prompt trimmed to {tokens} tokens (budget {budget}), shortened {len(truncated)} fields",
+                    extra={'prompt_tokens': tokens, 'truncated_fields': truncated})
+
+    PROMPT_TOKENS.observe(tokens)
+    return BuiltPrompt(text=text, tokens=tokens, truncated=tuple(truncated))
@@ -0,0 +1,328 @@
+"""
+Circuit breakers, rate limiting and adaptive concurrency for the OpenAI and Monday.com calls.
+
+Each dependency has a CircuitBreaker: after CIRCUIT_FAILURE_THRESHOLD failed calls in a row
+(timeouts, connection errors, 429 and 5xx after the client's own retries) it opens and calls
+fail fast with DependencyUnavailable for CIRCUIT_RESET_SECONDS, then a few trial calls decide
+whether it closes again. OpenAI calls also take from per-process token buckets sized to the
+account's RPM / TPM limits. The job workers only claim a job while job_limiter has room and
+no circuit is open; the limit shrinks when calls get slower than their latency target or
+fail, and grows back as they recover, so work waits in the queue instead of piling up on a
+struggling dependency. The state of all three is reported by resilience_stats() on /health.
+"""
+import asyncio
+import logging
+import os
+import threading
+import time
+from contextlib import asynccontextmanager, contextmanager
+
+from telemetry import CIRCUIT_STATE, CONCURRENCY_LIMIT, SHED
+
+logger = logging.getLogger(__name__)
+
+CIRCUIT_FAILURE_THRESHOLD = int(os.getenv('CIRCUIT_FAILURE_THRESHOLD', 5))
+CIRCUIT_RESET_SECONDS = float(os.getenv('CIRCUIT_RESET_SECONDS', 30))
+# Calls let through to test a half-open circuit
+CIRCUIT_HALF_OPEN_CALLS = int(os.getenv('CIRCUIT_HALF_OPEN_CALLS', 1))
+
+# Account-wide OpenAI limits of our tier (0 = not limited here), shared by RATE_LIMIT_PROCESSES processes
+OPENAI_RPM_LIMIT = float(os.getenv('OPENAI_RPM_LIMIT', 0))
+OPENAI_TPM_LIMIT = float(os.getenv('OPENAI_TPM_LIMIT', 0))
+RATE_LIMIT_PROCESSES = int(os.getenv('RATE_LIMIT_PROCESSES', os.getenv('WEB_CONCURRENCY', 1)))
+# Completion tokens counted against the TPM bucket before the real usage is known
+OPENAI_COMPLETION_TOKENS_ESTIMATE = int(os.getenv('OPENAI_COMPLETION_TOKENS_ESTIMATE', 600))
+# A call that would wait longer than this for the bucket is rejected instead
+OPENAI_RATE_MAX_WAIT = float(os.getenv('OPENAI_RATE_MAX_WAIT', 30))
+
+# Calls slower than this count against the job concurrency limit
+OPENAI_LATENCY_TARGET = float(os.getenv('OPENAI_LATENCY_TARGET', 20))
+MONDAY_LATENCY_TARGET = float(os.getenv('MONDAY_LATENCY_TARGET', 5))
+JOB_CONCURRENCY_MIN = int(os.getenv('JOB_CONCURRENCY_MIN', 1))
+
+CLOSED = 'closed'
+OPEN = 'open'
+HALF_OPEN = 'half_open'
+_STATE_VALUES = {CLOSED: 0, HALF_OPEN: 1, OPEN: 2}
+
+
+class DependencyUnavailable(Exception):
+    """A call was not made because its dependency is failing or over its rate limit."""
+
+    def __init__(self, dependency: str, reason: str, retry_after: float = None):
+        super().__init__(f"{dependency} unavailable: {reason}")
+        self.dependency = dependency
+        self.reason = reason
+        self.retry_after = retry_after
+
+
+class CircuitBreaker:
+    """Consecutive-failure circuit breaker; safe to share between threads and the event loop."""
+
+    def __init__(self, name: str, failure_threshold: int = CIRCUIT_FAILURE_THRESHOLD,
+                 reset_seconds: float = CIRCUIT_RESET_SECONDS, half_open_calls: int = CIRCUIT_HALF_OPEN_CALLS):
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.reset_seconds = reset_seconds
+        self.half_open_calls = half_open_calls
+        self._lock = threading.Lock()
+        self._state = CLOSED
+        self._failures = 0
+        self._opened_at = None
+        self._trials = 0
+        self._trial_started = 0.0
+        self._times_opened = 0
+        CIRCUIT_STATE.labels(dependency=name).set(0)
+
+    def _set_state(self, state: str):
+        if state != self._state:
+            logger.warning(f"Circuit {self.name} {self._state} -> {state}")
+            self._state = state
+            CIRCUIT_STATE.labels(dependency=self.name).set(_STATE_VALUES[state])
+
+    def _state_now(self) -> str:
+        if self._state == OPEN and time.monotonic() - self._opened_at >= self.reset_seconds:
+            self._set_state(HALF_OPEN)
+            self._trials = 0
+        return self._state
+
+    def available(self) -> bool:
+        """True unless the circuit is open (a half-open circuit wants trial calls)."""
+        with self._lock:
+            return self._state_now() != OPEN
+
+    def before_call(self):
+        """Raise DependencyUnavailable when the call must not be made."""
+        with self._lock:
+            state = self._state_now()
+            if state == CLOSED:
+                return
+            now = time.monotonic()
+            # A trial whose outcome never came back (cancelled, shed) frees its slot after reset_seconds
+            if state == HALF_OPEN and (self._trials < self.half_open_calls
+                                       or now - self._trial_started >= self.reset_seconds):
+                if now - self._trial_started >= self.reset_seconds:
+                    self._trials = 0
+                self._trials += 1
+                self._trial_started = now
+                return
+            retry_after = max(0.0, self.reset_seconds - (now - self._opened_at)) if state == OPEN else 1.0
+        SHED.labels(dependency=self.name, reason='circuit_open').inc()
+        raise DependencyUnavailable(self.name, 'circuit open', retry_after)
+
+    def record(self, failed: bool):
+        """Outcome of a call that before_call let through."""
+        with self._lock:
+            # A call that started before the circuit opened says nothing about recovery
+            if self._state_now() == OPEN:
+                return
+            if not failed:
+                self._failures = 0
+                if self._state != CLOSED:
+                    self._set_state(CLOSED)
+                return
+            self._failures += 1
+            if self._state == HALF_OPEN or self._failures >= self.failure_threshold:
+                self._opened_at = time.monotonic()
+                self._times_opened += 1
+                self._set_state(OPEN)
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                'state': self._state_now(),
+                'consecutive_failures': self._failures,
+                'times_opened': self._times_opened,
+            }
+
+
+class TokenBucket:
+    """Refills at rate_per_second up to capacity; reserve() never blocks, callers sleep for what it returns."""
+
+    def __init__(self, name: str, rate_per_second: float, capacity: float, max_wait: float = OPENAI_RATE_MAX_WAIT):
+        self.name = name
+        self.rate = rate_per_second
+        self.capacity = capacity
+        self.max_wait = max_wait
+        self._tokens = capacity
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def reserve(self, amount: float = 1) -> float:
+        """
+        Take amount and return how long to wait before using it. The balance may go negative,
+        which queues later callers behind this one; past max_wait DependencyUnavailable is raised.
+        """
+        with self._lock:
+            now = time.monotonic()
+            self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+            self._updated = now
+            wait = max(0.0, (min(amount, self.capacity) - self._tokens) / self.rate)
+            if wait > self.max_wait:
+                SHED.labels(dependency=self.name, reason='rate_limit').inc()
+                raise DependencyUnavailable(self.name, 'rate limit', wait)
+            self._tokens -= amount
+        return wait
+
+    def stats(self) -> dict:
+        with self._lock:
+            tokens = min(self.capacity, self._tokens + (time.monotonic() - self._updated) * self.rate)
+        return {'available': round(tokens, 1), 'capacity': self.capacity, 'per_second': round(self.rate, 3)}
+
+
+class AdaptiveLimiter:
+    """
+    AIMD concurrency limit: every on-target call adds one slot up to max_limit, every slow or
+    failed one takes 10% off down to min_limit. try_acquire() never blocks.
+    """
+
+    def __init__(self, name: str, max_limit: int, min_limit: int = JOB_CONCURRENCY_MIN, backoff: float = 0.9):
+        self.name = name
+        self.min_limit = min_limit
+        self.backoff = backoff
+        self._lock = threading.Lock()
+        self.set_max(max_limit)
+        self._inflight = 0
+        self._deferred = 0
+
+    def set_max(self, max_limit: int):
+        """Size the limiter to the pool using it (worker threads or async job slots)."""
+        with self._lock:
+            self.max_limit = max(self.min_limit, max_limit)
+            self._limit = float(self.max_limit)
+        CONCURRENCY_LIMIT.labels(limiter=self.name).set(self.max_limit)
+
+    def try_acquire(self) -> bool:
+        with self._lock:
+            if self._inflight < int(self._limit):
+                self._inflight += 1
+                return True
+            self._deferred += 1
+            return False
+
+    def release(self):
+        with self._lock:
+            self._inflight -= 1
+
+    def observe(self, seconds: float, target: float, failed: bool = False):
+        """Feed one dependency call: slow or failed calls shrink the limit, on-target ones grow it."""
+        with self._lock:
+            if failed or seconds > target:
+                self._limit = max(self.min_limit, self._limit * self.backoff)
+            else:
+                self._limit = min(self.max_limit, self._limit + 1)
+            limit = int(self._limit)
+        CONCURRENCY_LIMIT.labels(limiter=self.name).set(limit)
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                'limit': int(self._limit),
+                'max_limit': self.max_limit,
+                'in_flight': self._inflight,
+                'deferred': self._deferred,
+            }
+
+
+def _is_openai_failure(error: Exception) -> bool:
+    """Errors that mean OpenAI is struggling, not that our request was wrong."""
+    # Only reached after a call, so openai is loaded by then (see model_clients)
+    import openai
+    return isinstance(error, (openai.APIConnectionError, openai.RateLimitError, openai.InternalServerError))
+
+
+openai_breaker = CircuitBreaker('openai')
+monday_breaker = CircuitBreaker('monday')
+BREAKERS = (openai_breaker, monday_breaker)
+
+
+def _per_minute_bucket(limit: float):
+    """This process's share of a per-minute limit; up to ten seconds' worth may go out in a burst."""
+    if limit <= 0:
+        return None
+    rate = limit / RATE_LIMIT_PROCESSES / 60
+    return TokenBucket('openai', rate, max(1.0, rate * 10))
+
+
+openai_requests_bucket = _per_minute_bucket(OPENAI_RPM_LIMIT)
+openai_tokens_bucket = _per_minute_bucket(OPENAI_TPM_LIMIT)
+
+# Sized by the worker pool that uses it (WorkerPool / AsyncWorkerPool)
+job_limiter = AdaptiveLimiter('jobs', max_limit=1)
+
+
+def accepting_jobs() -> bool:
+    """Whether a job worker should claim another job: no open circuit and a free slot (taken if so)."""
+    if not all(breaker.available() for breaker in BREAKERS):
+        return False
+    return job_limiter.try_acquire()
+
+
+def _admit_openai(messages) -> float:
+    """Pass the circuit breaker and reserve the call in the rate limits; seconds to wait before sending it."""
+    openai_breaker.before_call()
+    wait = 0.0
+    if openai_requests_bucket is not None:
+        wait = openai_requests_bucket.reserve(1)
+    if openai_tokens_bucket is not None:
+        # Imported here so the tokenizer only loads when TPM limiting is on
+        from prompt_builder import count_tokens
+        tokens = sum(count_tokens(message['content']) for message in messages) + OPENAI_COMPLETION_TOKENS_ESTIMATE
+        wait = max(wait, openai_tokens_bucket.reserve(tokens))
+    return wait
+
+
+@contextmanager
+def _openai_outcome():
+    """Feed the call's outcome to the breaker and its latency to job_limiter (cancelled calls count for neither)."""
+    started = time.perf_counter()
+    try:
+        yield
+    except Exception as e:
+        failed = _is_openai_failure(e)
+        openai_breaker.record(failed)
+        job_limiter.observe(time.perf_counter() - started, OPENAI_LATENCY_TARGET, failed)
+        raise
+    openai_breaker.record(False)
+    job_limiter.observe(time.perf_counter() - started, OPENAI_LATENCY_TARGET)
+
+
+@contextmanager
+def openai_call(messages):
+    """Guard one blocking OpenAI call: circuit breaker, rate limits and latency feedback."""
+    wait = _admit_openai(messages)
+    if wait:
+        time.sleep(wait)
+    with _openai_outcome():
+        yield
+
+
+@asynccontextmanager
+async def openai_call_async(messages):
+    """openai_call for the AsyncOpenAI client."""
+    if openai_tokens_bucket is not None:
+        # Counting the prompt's tokens blocks, keep it off the event loop
+        wait = await asyncio.to_thread(_admit_openai, messages)
+    else:
+        wait = _admit_openai(messages)
+    if wait:
+        await asyncio.sleep(wait)
+    with _openai_outcome():
+        yield
+
+
+def record_monday_call(seconds: float, failed: bool):
+    """Outcome of a Monday.com call (all its retries) that monday_breaker let through."""
+    monday_breaker.record(failed)
+    job_limiter.observe(seconds, MONDAY_LATENCY_TARGET, failed)
+
+
+def resilience_stats() -> dict:
+    return {
+        'circuits': {breaker.name: breaker.stats() for breaker in BREAKERS},
+        'openai_rate_limit': {
+            'requests': openai_requests_bucket.stats() if openai_requests_bucket is not None else None,
+            'tokens': openai_tokens_bucket.stats() if openai_tokens_bucket is not None else None,
+        },
+        'job_concurrency': job_limiter.stats(),
+    }
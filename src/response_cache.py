@@ -0,0 +1,150 @@
+"""
+Persistent cache of generated emails, keyed by the content that produced them.
+
+Monday fires the webhook again and again for the same item, so before calling m() the
+pipeline looks up a hash of the normalized Q&A text, the system-instructions version and
+the model name. Only emails the verifier passed are stored, so a rejected email (or one
+whose check was skipped while its circuit was open) is generated again next time.
+Entries live in a SQLite file shared by all gunicorn workers, expire after
+RESPONSE_CACHE_TTL seconds and the least recently used ones are evicted past
+RESPONSE_CACHE_MAX_ENTRIES. Hit/miss counters are stored in the same file.
+"""
+import hashlib
+import logging
+import os
+import re
+import sqlite3
+import threading
+import time
+import unicodedata
+from pathlib import Path
+
+logger = logging.getLogger(__name__)
+
+APP_ROOT = Path(os.path.dirname(os.path.abspath(__file__)))
+RESPONSE_CACHE_ENABLED = os.getenv('RESPONSE_CACHE_ENABLED', 'true').lower() == 'true'
+RESPONSE_CACHE_PATH = Path(os.getenv('RESPONSE_CACHE_PATH', APP_ROOT / 'data' / 'responses.db'))
+RESPONSE_CACHE_TTL = float(os.getenv('RESPONSE_CACHE_TTL', 7 * 24 * 3600))
+RESPONSE_CACHE_MAX_ENTRIES = int(os.getenv('RESPONSE_CACHE_MAX_ENTRIES', 5000))
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS responses (
+    key TEXT PRIMARY KEY,
+    value TEXT NOT NULL,
+    created_at REAL NOT NULL,
+    last_access REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS idx_responses_last_access ON responses (last_access);
+CREATE TABLE IF NOT EXISTS counters (
+    name TEXT PRIMARY KEY,
+    value INTEGER NOT NULL
+);
+"""
+
+_WHITESPACE_RE = re.compile(r'[ \t\r\f\v]+')
+
+
+def normalize_text(text: str) -> str:
+    """Unicode-normalize and collapse whitespace so cosmetic edits do not miss the cache."""
+    text = unicodedata.normalize('NFC', text or '')
+    lines = (_WHITESPACE_RE.sub(' ', line).strip() for line in text.split('\n'))
+    return '\n'.join(line for line in lines if line)
+
+
+def make_key(text: str, instructions_version: str, model: str) -> str:
+    payload = '\0'.join([normalize_text(text), instructions_version, model])
+    return hashlib.sha256(payload.encode('utf-8')).hexdigest()
+
+
+class ResponseCache:
+    """LRU + TTL key/value store in SQLite, safe to share between threads and processes."""
+
+    def __init__(self, db_path=RESPONSE_CACHE_PATH, ttl: float = RESPONSE_CACHE_TTL,
+                 max_entries: int = RESPONSE_CACHE_MAX_ENTRIES):
+        self.db_path = Path(db_path)
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self._local = threading.local()
+        os.makedirs(self.db_path.parent, exist_ok=True)
+        self._conn().executescript(_SCHEMA)
+
+    def _conn(self) -> sqlite3.Connection:
+        # One connection per thread and process, as in JobQueue: the cache may be opened in the
+        # gunicorn master when the app is preloaded, and a forked worker must not reuse its connection
+        conn = getattr(self._local, 'conn', None)
+        if conn is None or self._local.pid != os.getpid():
+            conn = sqlite3.connect(self.db_path, timeout=30, isolation_level=None)
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA synchronous=NORMAL')
+            self._local.conn = conn
+            self._local.pid = os.getpid()
+        return conn
+
+    def _count(self, name: str):
+        self._conn().execute(
+            "INSERT INTO counters (name, value) VALUES (?, 1) "
+            "ON CONFLICT(name) DO UPDATE SET value = value + 1",
+            (name,)
+        )
+
+    def get(self, key: str):
+        """Return the cached value, or None on a miss or an expired entry."""
+        now = time.time()
+        conn = self._conn()
+        row = conn.execute("SELECT value, created_at FROM responses WHERE key = ?", (key,)).fetchone()
+        if row is None or now - row[1] > self.ttl:
+            if row is not None:
+                conn.execute("DELETE FROM responses WHERE key = ?", (key,))
+            self._count('misses')
+            return None
+        conn.execute("UPDATE responses SET last_access = ? WHERE key = ?", (now, key))
+        self._count('hits')
+        return row[0]
+
+    def put(self, key: str, value: str):
+        now = time.time()
+        conn = self._conn()
+        conn.execute(
+            "INSERT OR REPLACE INTO responses (key, value, created_at, last_access) VALUES (?, ?, ?, ?)",
+            (key, value, now, now)
+        )
+        self._evict(conn, now)
+
+    def _evict(self, conn: sqlite3.Connection, now: float):
+        conn.execute("DELETE FROM responses WHERE created_at < ?", (now - self.ttl,))
+        size = conn.execute("SELECT COUNT(*) FROM responses").fetchone()[0]
+        if size > self.max_entries:
+            conn.execute(
+                "DELETE FROM responses WHERE key IN "
+                "(SELECT key FROM responses ORDER BY last_access LIMIT ?)",
+                (size - self.max_entries,)
+            )
+            self._count('evictions')
+
+    def stats(self) -> dict:
+        conn = self._conn()
+        counters = dict(conn.execute("SELECT name, value FROM counters").fetchall())
+        hits, misses = counters.get('hits', 0), counters.get('misses', 0)
+        return {
+            'entries': conn.execute("SELECT COUNT(*) FROM responses").fetchone()[0],
+            'hits': hits,
+            'misses': misses,
+            'evictions': counters.get('evictions', 0),
+            'hit_rate': round(hits / (hits + misses), 3) if hits + misses else None
+        }
+
+
+_cache = None
+_cache_lock = threading.Lock()
+
+
+def get_response_cache() -> ResponseCache:
+    """Return the process-wide cache, or None when RESPONSE_CACHE_ENABLED is off."""
+    global _cache
+    if not RESPONSE_CACHE_ENABLED:
+        return None
+    if _cache is None:
+        with _cache_lock:
+            if _cache is None:
+                _cache = ResponseCache()
+    return _cache
@@ -0,0 +1,319 @@
+"""
+Local fake Monday.com and OpenAI servers for benchmarks and offline runs.
+
+Both servers answer just enough of the real APIs for the email pipeline: Monday item,
+board and page queries plus column mutations; OpenAI chat completions (structured
+outputs for EmailOutput, FusedEmailOutput and MailResults, streamed or not), models,
+files and batches. Each has a latency/error profile so slow or flaky dependencies can be
+simulated. Point the app at them with MONDAY_API_URL and OPENAI_BASE_URL.
+"""
+import json
+import random
+import re
+import threading
+import time
+import uuid
+from dataclasses import dataclass
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+@dataclass
+class LatencyProfile:
+    """Response delay (mean +- uniform jitter, in ms) and the share of requests answered with an error."""
+    latency_ms: float = 0.0
+    jitter_ms: float = 0.0
+    error_rate: float = 0.0
+    error_status: int = 500
+
+    def delay(self):
+        latency = self.latency_ms + random.uniform(-self.jitter_ms, self.jitter_ms)
+        if latency > 0:
+            time.sleep(latency / 1000)
+
+    def should_fail(self) -> bool:
+        return self.error_rate > 0 and random.random() < self.error_rate
+
+
+class _StubServer(ThreadingHTTPServer):
+    daemon_threads = True
+    # Bursts of benchmark connections must not be refused
+    request_queue_size = 1024
+
+    def __init__(self, handler, profile: LatencyProfile, host='127.0.0.1', port=0):
+        super().__init__((host, port), handler)
+        self.profile = profile
+        self.requests_served = 0
+        self._thread = None
+
+    @property
+    def url(self) -> str:
+        return f"http://{self.server_address[0]}:{self.server_address[1]}"
+
+    def start(self):
+        self._thread = threading.Thread(target=self.serve_forever, name=self.__class__.__name__, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+
+class _JSONHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, format, *args):
+        pass
+
+    def _read_body(self) -> bytes:
+        length = int(self.headers.get('Content-Length') or 0)
+        return self.rfile.read(length) if length else b''
+
+    def _send(self, status: int, body, content_type='application/json'):
+        payload = body if isinstance(body, bytes) else json.dumps(body).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
+
+    def _simulate(self) -> bool:
+        """Apply the latency profile; returns False when an error response was sent."""
+        self.server.requests_served += 1
+        self.server.profile.delay()
+        if self.server.profile.should_fail():
+            self._send(self.server.profile.error_status, {'error': {'message': 'stub error', 'type': 'server_error'}})
+            return False
+        return True
+
+
+# --- Monday.com -------------------------------------------------------------
+
+DEFAULT_COLUMNS = [
+    {'id': 'name', 'title': 'Name', 'type': 'name'},
+    {'id': 'text_owner', 'title': 'שם בעל/ת העסק', 'type': 'text'},
+    {'id': 'long_text_status', 'title': 'ספרו לנו בבקשה בכמה משפטים מה שלום העסק שלכם', 'type': 'long_text'},
+    {'id': 'long_text_q1', 'title': 'What changed in the business since the loan?', 'type': 'long_text'},
+    {'id': 'long_text_q2', 'title': 'What are your plans for the next quarter?', 'type': 'long_text'},
+    {'id': 'status', 'title': 'Status', 'type': 'status'},
+    {'id': 'long_text_mkkg84hp', 'title': 'Email', 'type': 'long_text'},
+]
+
+
+class _MondayHandler(_JSONHandler):
+    def do_POST(self):
+        request = json.loads(self._read_body() or b'{}')
+        if not self._simulate():
+            return
+        query = request.get('query', '')
+        variables = request.get('variables') or {}
+        data = {'complexity': {'query': 100, 'after': 9_999_000, 'reset_in_x_seconds': 60}}
+
+        if query.lstrip().startswith('mutation'):
+            for alias in re.findall(r'(\w+)\s*:\s*change_simple_column_value', query) or ['change_simple_column_value']:
+                item_var = 'itemId' if alias == 'change_simple_column_value' else 'item' + alias[1:]
+                data[alias] = {'id': str(variables.get(item_var, '1'))}
+        elif 'next_items_page' in query:
+            data['next_items_page'] = {'cursor': None, 'items': []}
+        elif 'boards(' in query:
+            board = {'id': str((variables.get('boardId') or ['1'])[0]), 'columns': self.server.columns}
+            if 'items_page' in query:
+                count = min(int(variables.get('limit', 25)), self.server.board_items)
+                board['items_page'] = {'cursor': None, 'items': [self.server.item(str(i + 1)) for i in range(count)]}
+            data['boards'] = [board]
+        elif re.search(r'\bme\s*\{', query):
+            data['me'] = {'id': '1'}
+        elif 'items(' in query:
+            data['items'] = [dict(self.server.item(str(item_id)), board={'id': '1'})
+                             for item_id in variables.get('itemId', [])]
+        self._send(200, {'data': data, 'account_id': 1})
+
+
+class FakeMondayServer(_StubServer):
+    """Fake Monday.com GraphQL API; every item has the same Q&A answers."""
+
+    def __init__(self, profile: LatencyProfile = None, columns=None, board_items: int = 100, **kwargs):
+        super().__init__(_MondayHandler, profile or LatencyProfile(), **kwargs)
+        self.columns = columns or DEFAULT_COLUMNS
+        self.board_items = board_items
+
+    @property
+    def url(self) -> str:
+        return super().url + '/v2'
+
+    def item(self, item_id: str) -> dict:
+        answers = {
+            'name': f"Business {item_id}",
+            'text_owner': 'Dana Levi',
+            'long_text_status': 'The bakery is doing well, we opened a second oven line.',
+            'long_text_q1': 'We hired two employees and doubled weekend sales.',
+            'long_text_q2': 'Start delivering to cafes in the neighborhood.',
+            'status': 'Done',
+            'long_text_mkkg84hp': '',
+        }
+        return {
+            'id': item_id,
+            'name': f"Business {item_id}",
+            'column_values': [
+                {'id': col['id'], 'text': answers.get(col['id'], ''), 'value': None, 'type': col['type']}
+                for col in self.columns
+            ]
+        }
+
+
+# --- OpenAI -----------------------------------------------------------------
+
+def fake_structured_output(schema_name: str, user_content: str) -> dict:
+    """A plausible object for the response_format the pipeline asked for."""
+    if schema_name == 'MailResults':
+        return {'issueDesc': '', 'isVerified': True}
+    if schema_name == 'VerifierResults':
+        return {'issueDesc': '', 'isVerified': True, 'confidence': 0.9}
+    output = {
+        'emailSubject': 'An update from a business you supported',
+        'messageText': 'Dear lenders, thanks to your loan we hired two employees and doubled weekend sales. '
+                       'Next quarter we start delivering to cafes. Thank you for believing in us!',
+        'isReliable': True,
+        'isTooSad': False,
+        'businessName': 'Business',
+    }
+    if schema_name == 'FusedEmailOutput':
+        output.update(isVerified=True, issueDesc='', confidence=0.95)
+    return output
+
+
+def _schema_name(body: dict) -> str:
+    response_format = body.get('response_format') or {}
+    return (response_format.get('json_schema') or {}).get('name', 'EmailOutput')
+
+
+def fake_chat_completion(body: dict) -> dict:
+    messages = body.get('messages') or []
+    user_content = next((m.get('content') or '' for m in messages if m.get('role') == 'user'), '')
+    content = json.dumps(fake_structured_output(_schema_name(body), user_content), ensure_ascii=False)
+    prompt_tokens = sum(len(m.get('content') or '') for m in messages) // 4
+    return {
+        'id': f"chatcmpl-{uuid.uuid4().hex[:12]}",
+        'object': 'chat.completion',
+        'created': int(time.time()),
+        'model': body.get('model', 'gpt-4o'),
+        'choices': [{
+            'index': 0,
+            'finish_reason': 'stop',
+            'logprobs': None,
+            'message': {'role': 'assistant', 'content': content, 'refusal': None}
+        }],
+        'usage': {'prompt_tokens': prompt_tokens, 'completion_tokens': len(content) // 4,
+                  'total_tokens': prompt_tokens + len(content) // 4}
+    }
+
+
+def fake_chat_completion_chunks(completion: dict, chunk_chars: int = 4, include_usage: bool = False):
+    """The completion as a sequence of chat.completion.chunk objects, a few characters each."""
+    content = completion['choices'][0]['message']['content']
+    base = {'id': completion['id'], 'object': 'chat.completion.chunk',
+            'created': completion['created'], 'model': completion['model']}
+    for i in range(0, len(content), chunk_chars):
+        delta = {'content': content[i:i + chunk_chars]}
+        if i == 0:
+            delta['role'] = 'assistant'
+        yield dict(base, choices=[{'index': 0, 'delta': delta, 'finish_reason': None, 'logprobs': None}])
+    yield dict(base, choices=[{'index': 0, 'delta': {}, 'finish_reason': 'stop', 'logprobs': None}])
+    if include_usage:
+        yield dict(base, choices=[], usage=completion['usage'])
+
+
+class _OpenAIHandler(_JSONHandler):
+    def do_GET(self):
+        if not self._simulate():
+            return
+        path = self.path.split('?')[0]
+        if path.endswith('/models'):
+            self._send(200, {'object': 'list', 'data': [{'id': 'gpt-4o', 'object': 'model', 'created': 0, 'owned_by': 'stub'}]})
+        elif re.search(r'/batches/[^/]+$', path):
+            batch = self.server.batches.get(path.rsplit('/', 1)[1])
+            if batch is None:
+                self._send(404, {'error': {'message': 'batch not found'}})
+                return
+            # Batches complete on the first poll
+            batch['status'] = 'completed'
+            batch['request_counts'] = {'total': batch['_total'], 'completed': batch['_total'], 'failed': 0}
+            self._send(200, {k: v for k, v in batch.items() if not k.startswith('_')})
+        elif re.search(r'/files/[^/]+/content$', path):
+            content = self.server.files.get(path.split('/')[-2])
+            self._send(200 if content is not None else 404, (content or '').encode('utf-8'), 'application/jsonl')
+        else:
+            self._send(404, {'error': {'message': f"unknown path {path}"}})
+
+    def do_POST(self):
+        raw = self._read_body()
+        if not self._simulate():
+            return
+        path = self.path.split('?')[0]
+        if path.endswith('/chat/completions'):
+            body = json.loads(raw)
+            if body.get('stream'):
+                self._stream_chat_completion(body)
+            else:
+                self._send(200, fake_chat_completion(body))
+        elif path.endswith('/files'):
+            match = re.search(rb'filename="[^"]*"\r\n(?:[^\r\n]+\r\n)*\r\n(.*?)\r\n--', raw, re.S)
+            file_id = f"file-{uuid.uuid4().hex[:12]}"
+            self.server.files[file_id] = match.group(1).decode('utf-8') if match else ''
+            self._send(200, {'id': file_id, 'object': 'file', 'bytes': len(raw), 'created_at': int(time.time()),
+                             'filename': 'batch.jsonl', 'purpose': 'batch', 'status': 'processed'})
+        elif path.endswith('/batches'):
+            self._send(200, self._create_batch(json.loads(raw)))
+        else:
+            self._send(404, {'error': {'message': f"unknown path {path}"}})
+
+    def _stream_chat_completion(self, body: dict):
+        """Server-sent chunks over chunked transfer encoding; the profile delay is the time to first token."""
+        include_usage = bool((body.get('stream_options') or {}).get('include_usage'))
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/event-stream')
+        self.send_header('Transfer-Encoding', 'chunked')
+        self.end_headers()
+        for chunk in fake_chat_completion_chunks(fake_chat_completion(body), include_usage=include_usage):
+            self._write_chunk(f"data: {json.dumps(chunk, ensure_ascii=False)}\n\n".encode('utf-8'))
+            time.sleep(self.server.stream_chunk_ms / 1000)
+        self._write_chunk(b"data: [DONE]\n\n")
+        self.wfile.write(b"0\r\n\r\n")
+
+    def _write_chunk(self, data: bytes):
+        self.wfile.write(f"{len(data):x}\r\n".encode('ascii') + data + b"\r\n")
+        self.wfile.flush()
+
+    def _create_batch(self, request: dict) -> dict:
+        lines = [json.loads(line) for line in self.server.files.get(request['input_file_id'], '').splitlines() if line.strip()]
+        output = [
+            json.dumps({'id': f"batch_req_{i}", 'custom_id': line['custom_id'], 'error': None,
+                        'response': {'status_code': 200, 'request_id': str(i), 'body': fake_chat_completion(line['body'])}})
+            for i, line in enumerate(lines)
+        ]
+        output_file_id = f"file-{uuid.uuid4().hex[:12]}"
+        self.server.files[output_file_id] = '\n'.join(output)
+        batch_id = f"batch_{uuid.uuid4().hex[:12]}"
+        batch = {
+            'id': batch_id, 'object': 'batch', 'endpoint': request['endpoint'], 'errors': None,
+            'input_file_id': request['input_file_id'], 'completion_window': request['completion_window'],
+            'status': 'in_progress', 'output_file_id': output_file_id, 'error_file_id': None,
+            'created_at': int(time.time()), 'metadata': request.get('metadata'), '_total': len(lines),
+        }
+        self.server.batches[batch_id] = batch
+        return {k: v for k, v in batch.items() if not k.startswith('_')}
+
+
+class FakeOpenAIServer(_StubServer):
+    """Fake OpenAI API: chat completions (streamed or not), models, files and batches."""
+
+    def __init__(self, profile: LatencyProfile = None, stream_chunk_ms: float = 10, **kwargs):
+        super().__init__(_OpenAIHandler, profile or LatencyProfile(), **kwargs)
+        # Delay between streamed chunks
+        self.stream_chunk_ms = stream_chunk_ms
+        self.files = {}
+        self.batches = {}
+
+    @property
+    def url(self) -> str:
+        return super().url + '/v1'
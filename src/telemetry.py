@@ -0,0 +1,339 @@
+"""
+Tracing spans, Prometheus metrics and structured JSON logging for the email pipeline.
+
+Every stage (fetch, format, generate, verify, write-back) runs inside span(), which times
+it into a Prometheus histogram and logs one structured line. Request, job and item ids are
+kept in context variables and added to every log record, so all lines of one webhook can be
+found together. Metrics are served by /metrics; with PROMETHEUS_MULTIPROC_DIR set they are
+aggregated over all gunicorn workers.
+
+Request threads never write log lines themselves: the root logger's only handler puts the
+record on a bounded queue and a listener thread formats it and writes it to the console and
+the rotating file. When the queue is full the record is dropped and counted rather than
+making the request wait.
+"""
+import atexit
+import contextvars
+import copy
+import logging
+import os
+import queue
+import random
+import time
+import uuid
+import zlib
+from contextlib import contextmanager
+from logging.handlers import QueueHandler, QueueListener, RotatingFileHandler
+
+try:
+    import fcntl
+except ImportError:  # not on Windows; rotation then is not coordinated between processes
+    fcntl = None
+
+from prometheus_client import (
+    CONTENT_TYPE_LATEST,
+    CollectorRegistry,
+    Counter,
+    Gauge,
+    Histogram,
+    generate_latest,
+    multiprocess,
+)
+from pythonjsonlogger import jsonlogger
+
+logger = logging.getLogger(__name__)
+
+# LOG_FORMAT=text keeps the old human-readable lines (handy when running locally)
+LOG_FORMAT = os.getenv('LOG_FORMAT', 'json')
+LOG_LEVEL = os.getenv('LOG_LEVEL', 'INFO').upper()
+LOG_MAX_BYTES = int(os.getenv('LOG_MAX_BYTES', 20 * 1024 * 1024))
+LOG_BACKUP_COUNT = int(os.getenv('LOG_BACKUP_COUNT', 10))
+# Records waiting for the listener; past this they are dropped (spark_log_records_dropped)
+LOG_QUEUE_SIZE = int(os.getenv('LOG_QUEUE_SIZE', 10000))
+# Share of items whose verbose per-item lines (logged with extra=SAMPLED) are kept
+LOG_SAMPLE_RATE = float(os.getenv('LOG_SAMPLE_RATE', 0.1))
+
+# extra= for verbose per-item info lines, kept for LOG_SAMPLE_RATE of the items
+SAMPLED = {'sampled': True}
+
+request_id_var = contextvars.ContextVar('request_id', default=None)
+job_id_var = contextvars.ContextVar('job_id', default=None)
+item_id_var = contextvars.ContextVar('item_id', default=None)
+
+_LATENCY_BUCKETS = (0.01, 0.05, 0.1, 0.25, 0.5, 1, 2, 4, 8, 15, 30, 60, 120)
+
+STAGE_DURATION = Histogram(
+    'spark_stage_duration_seconds', 'Duration of email pipeline stages',
+    ['stage', 'outcome'], buckets=_LATENCY_BUCKETS
+)
+MODEL_LATENCY = Histogram(
+    'spark_model_call_duration_seconds', 'Latency of model API calls',
+    ['model', 'call'], buckets=_LATENCY_BUCKETS
+)
+MODEL_TOKENS = Counter('spark_model_tokens', 'Tokens used by model calls', ['model', 'call', 'kind'])
+MODEL_COST = Counter('spark_model_cost_usd', 'Estimated cost of model calls', ['model', 'call'])
+ROUTE_ESCALATIONS = Counter('spark_route_escalations', 'Escalated model calls and whether the models agreed',
+                            ['stage', 'reason', 'outcome'])
+DEPENDENCY_LATENCY = Histogram(
+    'spark_dependency_call_duration_seconds', 'Latency of outbound HTTP calls',
+    ['dependency', 'outcome'], buckets=_LATENCY_BUCKETS
+)
+PROMPT_TOKENS = Histogram(
+    'spark_prompt_tokens', 'Tokens of the built user prompt',
+    buckets=(100, 250, 500, 750, 1000, 1500, 2000, 3000, 5000)
+)
+CACHE_LOOKUPS = Counter('spark_cache_lookups', 'Cache lookups', ['cache', 'result'])
+RETRIES = Counter('spark_retries', 'Retried operations', ['operation'])
+JOBS = Counter('spark_jobs', 'Finished job attempts', ['outcome'])
+WEBHOOKS = Counter('spark_webhooks', 'Webhook deliveries', ['outcome'])
+CIRCUIT_STATE = Gauge('spark_circuit_state', 'Circuit breaker state (0 closed, 1 half-open, 2 open)',
+                      ['dependency'], multiprocess_mode='max')
+CONCURRENCY_LIMIT = Gauge('spark_concurrency_limit', 'Current adaptive concurrency limit',
+                          ['limiter'], multiprocess_mode='livesum')
+SHED = Counter('spark_shed_calls', 'Calls rejected by a circuit breaker or rate limit', ['dependency', 'reason'])
+LOG_DROPPED = Counter('spark_log_records_dropped', 'Log records dropped because the log queue was full')
+
+
+def new_request_id() -> str:
+    return uuid.uuid4().hex
+
+
+@contextmanager
+def correlation(request_id=None, job_id=None, item_id=None):
+    """Set the correlation ids for the code inside the block (and the log lines it writes)."""
+    tokens = []
+    for var, value in ((request_id_var, request_id), (job_id_var, job_id), (item_id_var, item_id)):
+        if value is not None:
+            tokens.append((var, var.set(str(value))))
+    try:
+        yield
+    finally:
+        for var, token in reversed(tokens):
+            var.reset(token)
+
+
+@contextmanager
+def span(stage: str, timings: dict = None, **attributes):
+    """
+    Time a pipeline stage: observe it in spark_stage_duration_seconds, log a structured
+    line with the correlation ids, and add '<stage>_ms' to timings when it is given.
+    """
+    started = time.perf_counter()
+    outcome = 'ok'
+    try:
+        yield
+    except Exception:
+        outcome = 'error'
+        raise
+    finally:
+        elapsed = time.perf_counter() - started
+        STAGE_DURATION.labels(stage=stage, outcome=outcome).observe(elapsed)
+        if timings is not None:
+            timings[f"{stage}_ms"] = round(elapsed * 1000, 1)
+        logger.info(
+            f"Stage {stage} {outcome} in {elapsed * 1000:.0f} ms",
+            extra={'stage': stage, 'outcome': outcome, 'duration_ms': round(elapsed * 1000, 1), **attributes}
+        )
+
+
+def observe_model_call(model: str, call: str, seconds: float, usage=None):
+    """Record latency and token usage of one model API call."""
+    MODEL_LATENCY.labels(model=model, call=call).observe(seconds)
+    if usage is not None:
+        MODEL_TOKENS.labels(model=model, call=call, kind='prompt').inc(usage.prompt_tokens or 0)
+        MODEL_TOKENS.labels(model=model, call=call, kind='completion').inc(usage.completion_tokens or 0)
+
+
+def observe_dependency_call(dependency: str, seconds: float, ok: bool):
+    DEPENDENCY_LATENCY.labels(dependency=dependency, outcome='ok' if ok else 'error').observe(seconds)
+
+
+def record_cache(cache: str, hit: bool):
+    CACHE_LOOKUPS.labels(cache=cache, result='hit' if hit else 'miss').inc()
+
+
+def record_retry(operation: str):
+    RETRIES.labels(operation=operation).inc()
+
+
+def metrics_response():
+    """(body, content type) of the Prometheus exposition for /metrics."""
+    if os.getenv('PROMETHEUS_MULTIPROC_DIR'):
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+        return generate_latest(registry), CONTENT_TYPE_LATEST
+    return generate_latest(), CONTENT_TYPE_LATEST
+
+
+class CorrelationFilter(logging.Filter):
+    """Adds request_id, job_id and item_id to every record (ids passed in extra= win)."""
+
+    def filter(self, record):
+        for name, var in (('request_id', request_id_var), ('job_id', job_id_var), ('item_id', item_id_var)):
+            if getattr(record, name, None) is None:
+                setattr(record, name, var.get())
+        return True
+
+
+def log_formatter(text_format: str) -> logging.Formatter:
+    """JSON formatter (the default) or the given plain-text format when LOG_FORMAT=text."""
+    if LOG_FORMAT == 'text':
+        return logging.Formatter(text_format)
+    return jsonlogger.JsonFormatter(
+        '%(asctime)s %(name)s %(levelname)s %(filename)s %(lineno)d %(message)s %(request_id)s %(job_id)s %(item_id)s',
+        rename_fields={'levelname': 'level', 'asctime': 'time'}
+    )
+
+
+class SamplingFilter(logging.Filter):
+    """
+    Keeps LOG_SAMPLE_RATE of the records logged with extra=SAMPLED. The choice is made per
+    item id, so a kept item has all its lines; warnings and errors are always kept.
+    """
+
+    def __init__(self, rate: float):
+        super().__init__()
+        self.rate = rate
+
+    def filter(self, record):
+        if not getattr(record, 'sampled', False) or record.levelno >= logging.WARNING or self.rate >= 1:
+            return True
+        key = getattr(record, 'item_id', None) or getattr(record, 'request_id', None)
+        if key is None:
+            return random.random() < self.rate
+        return zlib.crc32(str(key).encode()) % 10000 < self.rate * 10000
+
+
+class _NonBlockingQueueHandler(QueueHandler):
+    """QueueHandler that drops (and counts) records instead of waiting for room in the queue."""
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            LOG_DROPPED.inc()
+
+    def prepare(self, record):
+        # Merge the arguments into the message and render the traceback in the calling thread
+        # (they may not outlive it); the listener's formatters add the fields and the time.
+        record = copy.copy(record)
+        record.message = record.getMessage()
+        record.msg = record.message
+        record.args = None
+        if record.exc_info and not record.exc_text:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+        record.exc_info = None
+        return record
+
+
+class SharedRotatingFileHandler(RotatingFileHandler):
+    """
+    RotatingFileHandler for a file that several gunicorn workers append to: a worker that
+    finds the file was already rotated by another one reopens it instead of rotating it a
+    second time, and the rotation itself is done under a lock file.
+    """
+
+    def shouldRollover(self, record):
+        if self._rotated_elsewhere():
+            self._reopen()
+        return super().shouldRollover(record)
+
+    def doRollover(self):
+        with self._rotation_lock():
+            # Another worker may have rotated the file while this one waited for the lock
+            if self._rotated_elsewhere():
+                self._reopen()
+                self.stream.seek(0, 2)
+                if self.stream.tell() < self.maxBytes:
+                    return
+            super().doRollover()
+
+    def _rotated_elsewhere(self) -> bool:
+        if self.stream is None:
+            return False
+        try:
+            return os.stat(self.baseFilename).st_ino != os.fstat(self.stream.fileno()).st_ino
+        except FileNotFoundError:
+            return True
+
+    def _reopen(self):
+        self.stream.close()
+        self.stream = self._open()
+
+    @contextmanager
+    def _rotation_lock(self):
+        if fcntl is None:
+            yield
+            return
+        with open(f"{self.baseFilename}.lock", 'a') as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+
+_queue_handler = None
+_listener = None
+_listener_handlers = ()
+
+
+def _start_listener():
+    global _listener
+    _listener = QueueListener(_queue_handler.queue, *_listener_handlers, respect_handler_level=True)
+    _listener.start()
+
+
+def _restart_listener():
+    # A forked child (gunicorn preload) has no listener thread and may have inherited the
+    # queue's lock held: it gets a new queue and its own listener.
+    if _queue_handler is not None:
+        _queue_handler.queue = queue.Queue(LOG_QUEUE_SIZE)
+        _start_listener()
+
+
+def setup_logging(log_file_path):
+    """
+    Root logger writing through the log queue to a console and a rotating file handler,
+    with correlation ids and sampling. Calling it again does not add handlers twice.
+    """
+    global _queue_handler, _listener_handlers
+    logger = logging.getLogger()
+    logger.setLevel(LOG_LEVEL)
+    if _queue_handler is not None:
+        return logger
+
+    # Handlers of an earlier logging.basicConfig() would write every line a second time
+    for handler in logger.handlers[:]:
+        logger.removeHandler(handler)
+
+    console_handler = logging.StreamHandler()
+    console_handler.setFormatter(log_formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s'))
+
+    file_handler = SharedRotatingFileHandler(log_file_path, maxBytes=LOG_MAX_BYTES, backupCount=LOG_BACKUP_COUNT)
+    file_handler.setFormatter(log_formatter('%(asctime)s - %(name)s - %(levelname)s - %(filename)s:%(lineno)d - %(message)s'))
+    _listener_handlers = (console_handler, file_handler)
+
+    # The filters run in the logging thread, where the correlation ids are set
+    _queue_handler = _NonBlockingQueueHandler(queue.Queue(LOG_QUEUE_SIZE))
+    _queue_handler.addFilter(CorrelationFilter())
+    _queue_handler.addFilter(SamplingFilter(LOG_SAMPLE_RATE))
+    logger.addHandler(_queue_handler)
+
+    _start_listener()
+    atexit.register(stop_logging)
+    os.register_at_fork(after_in_child=_restart_listener)
+    return logger
+
+
+def stop_logging():
+    """Write out the queued records and stop the listener thread (registered at exit)."""
+    global _listener
+    if _listener is None:
+        return
+    listener, _listener = _listener, None
+    try:
+        listener.stop()
+    except queue.Full:
+        # No room for the stop marker; the daemon listener thread ends with the process
+        pass
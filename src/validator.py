@@ -1,29 +1,21 @@
 from pydantic import BaseModel
-from openai import OpenAI
+from model_clients import get_async_openai_client, get_openai_client
+from resilience import DependencyUnavailable, openai_call, openai_call_async
+from model_routing import (
+    VERIFY_ESCALATION_MODEL,
+    VERIFY_MODEL,
+    escalation_enabled,
+    escalation_reason,
+    record_escalation,
+    record_route_call,
+)
 import logging
-import os
 import json
-from dotenv import load_dotenv
-from pathlib import Path
+import time
 
 # Add logger initialization
 logger = logging.getLogger(__name__)
 
-# Get the project root directory and load .env
-ROOT_DIR = Path(__file__).resolve().parent.parent
-ENV_PATH = ROOT_DIR / '.env'
-load_dotenv(ENV_PATH)
-
-# Get the API key
-api_key = os.getenv('OPENAI_API_KEY')
-if not api_key:
-    raise ValueError("OPENAI_API_KEY not found in environment variables")
-
-# Initialize OpenAI client with explicit API key
-client = OpenAI(
-    api_key=api_key
-)
-
 questionsAndAnswers = "question: how are you doing recently? answer: I am doing well"
 message = "I am writing to update that i'm doing well"
 
@@ -31,28 +23,130 @@ class MailResults(BaseModel):
     issueDesc: str
     isVerified: bool
 
+# Verdict of the small verification model, with how sure it is (decides escalation, see model_routing)
+class VerifierResults(MailResults):
+    confidence: float
+
+VERIFY_SYSTEM_CONTENT = "You need to verify that the emailmessage generally reflects the user's answers in the questions and answers. If it does, set isVerified=True. If it does not, set isVerified=False and provide issueDesc with a description of why the message is incorrect. Respond in JSON format."
+VERIFY_CONFIDENCE_CONTENT = " Set confidence to a number between 0 and 1 for how sure you are of that check."
+
+def verificationMessages(Questions_and_Answers, emailmessage, with_confidence=False):
+    """Chat messages of a verification call (shared with the batch mode)."""
+    return [
+        {"role": "system", "content": VERIFY_SYSTEM_CONTENT + (VERIFY_CONFIDENCE_CONTENT if with_confidence else "")},
+        {"role": "user", "content": f"Questions and answers:\n{Questions_and_Answers}\n\nEmail:\n{emailmessage}"},
+    ]
+
+def _verification_failed(error):
+    """Not-verified result for a verification call that could not be made or failed"""
+    if isinstance(error, DependencyUnavailable):
+        # Shed by the circuit breaker / rate limit: say so instead of a generic failure
+        logger.warning(f"Email not verified, {str(error)}")
+        return MailResults(issueDesc=f"Verification skipped: {str(error)}", isVerified=False)
+    logger.error(f"Failed to validate email: {str(error)}")
+    return MailResults(
+        issueDesc="Validation failed due to technical error",
+        isVerified=False
+    )
+
+def _first_response_format():
+    # Escalation is decided on the small model's confidence, so only then it is asked for
+    return VerifierResults if escalation_enabled() else MailResults
+
+def _as_mail_results(results):
+    return MailResults(issueDesc=results.issueDesc, isVerified=results.isVerified)
+
+def _escalation_reason(first):
+    if not isinstance(first, VerifierResults):
+        return None
+    return escalation_reason(first.isVerified, first.confidence)
+
+def _escalation_failed(first, usage, error):
+    logger.warning(f"Escalated verification failed, keeping the {VERIFY_MODEL} verdict: {str(error)}")
+    return _as_mail_results(first), usage
+
+def _combined_usage(first, second):
+    if first is None or second is None:
+        return first or second
+    # openai is only imported once a call was made (see model_clients)
+    from openai.types import CompletionUsage
+    return CompletionUsage(
+        prompt_tokens=first.prompt_tokens + second.prompt_tokens,
+        completion_tokens=first.completion_tokens + second.completion_tokens,
+        total_tokens=first.total_tokens + second.total_tokens
+    )
+
+def _verify_call(model, Questions_and_Answers, emailmessage, response_format):
+    """One verification call; returns the parsed verdict and the usage."""
+    messages = verificationMessages(Questions_and_Answers, emailmessage,
+                                    with_confidence=response_format is VerifierResults)
+    with openai_call(messages):
+        started = time.perf_counter()
+        completion = get_openai_client().beta.chat.completions.parse(
+            model=model,
+            messages=messages,
+            response_format=response_format
+        )
+    record_route_call('verify', model, time.perf_counter() - started, completion.usage)
+
+    # Extract the MailResults object from the completion
+    return completion.choices[0].message.parsed, completion.usage
+
+async def _verify_call_async(model, Questions_and_Answers, emailmessage, response_format):
+    messages = verificationMessages(Questions_and_Answers, emailmessage,
+                                    with_confidence=response_format is VerifierResults)
+    async with openai_call_async(messages):
+        started = time.perf_counter()
+        completion = await get_async_openai_client().beta.chat.completions.parse(
+            model=model,
+            messages=messages,
+            response_format=response_format
+        )
+    record_route_call('verify', model, time.perf_counter() - started, completion.usage)
+    return completion.choices[0].message.parsed, completion.usage
+
 def mailVerifed(Questions_and_Answers, emailmessage):
+    mail_results, _ = mailVerifedWithUsage(Questions_and_Answers, emailmessage)
+    return mail_results
+
+def mailVerifedWithUsage(Questions_and_Answers, emailmessage):
+    """
+    Same as mailVerifed but also returns the token usage of the calls (None on failure).
+    The small VERIFY_MODEL answers first; not verified, unsure or audited verdicts are
+    checked again by VERIFY_ESCALATION_MODEL, whose verdict then counts.
+    """
     try:
-        systemContent = "You need to verify that the emailmessage generally reflects the user's answers in the questions and answers. If it does, set isVerified=True. If it does not, set isVerified=False and provide issueDesc with a description of why the message is incorrect. Respond in JSON format."
-        
-        completion = client.beta.chat.completions.parse(
-            model="gpt-4o",  
-            messages=[
-                {"role": "system", "content": systemContent},
-                {"role": "user", "content": Questions_and_Answers},
-            ],
-            response_format=MailResults
-        )
-        
-        # Extract the MailResults object from the completion
-        mail_results = completion.choices[0].message.parsed
-        
-        return mail_results  # Return the parsed MailResults object instead of the whole completion
+        first, usage = _verify_call(VERIFY_MODEL, Questions_and_Answers, emailmessage, _first_response_format())
+    except Exception as e:
+        return _verification_failed(e), None
 
+    reason = _escalation_reason(first)
+    if reason is None:
+        return _as_mail_results(first), usage
+
+    try:
+        final, escalation_usage = _verify_call(VERIFY_ESCALATION_MODEL, Questions_and_Answers, emailmessage,
+                                               MailResults)
     except Exception as e:
-        logger.error(f"Failed to validate email: {str(e)}")
-        return MailResults(
-            issueDesc="Validation failed due to technical error",
-            isVerified=False
-        )
+        return _escalation_failed(first, usage, e)
+    record_escalation('verify', reason, first.isVerified, final.isVerified)
+    return final, _combined_usage(usage, escalation_usage)
+
+async def mailVerifedWithUsageAsync(Questions_and_Answers, emailmessage):
+    """mailVerifedWithUsage on the AsyncOpenAI client, for the ASGI app."""
+    try:
+        first, usage = await _verify_call_async(VERIFY_MODEL, Questions_and_Answers, emailmessage, _first_response_format())
+    except Exception as e:
+        return _verification_failed(e), None
 
+    reason = _escalation_reason(first)
+    if reason is None:
+        return _as_mail_results(first), usage
+
+    try:
+        final, escalation_usage = await _verify_call_async(VERIFY_ESCALATION_MODEL, Questions_and_Answers,
+                                                             emailmessage, MailResults)
+    except Exception as e:
+        return _escalation_failed(first, usage, e)
+    record_escalation('verify', reason, first.isVerified, final.isVerified)
+    return final, _combined_usage(usage, escalation_usage)
@@ -0,0 +1,167 @@
+"""
+Worker warm-up: pay the one-time costs before the first real request does.
+
+A new worker builds the OpenAI and Monday.com clients and opens their pooled TLS
+connections (one cheap call each), reads the board config and each board's instructions,
+loads the tokenizer and fetches the schemas of WARMUP_BOARD_IDS. Until that is done
+/health answers 503 "warming", so a load balancer only sends traffic to warm workers.
+Every step is timed and a failing step is logged and recorded, not retried: the worker
+is marked ready anyway, the normal per-call retries and circuit breakers take over.
+The ASGI app runs warm_up_async() in its lifespan instead, which warms the async clients
+it actually uses.
+"""
+import asyncio
+import logging
+import os
+import threading
+import time
+
+from config import settings
+
+logger = logging.getLogger(__name__)
+
+WARMUP_ENABLED = os.getenv('WARMUP_ENABLED', 'true').lower() == 'true'
+# Boards whose schemas are fetched ahead of the first webhook (comma separated ids)
+WARMUP_BOARD_IDS = [board_id.strip() for board_id in os.getenv('WARMUP_BOARD_IDS', '').split(',') if board_id.strip()]
+
+_state = {'ready': not WARMUP_ENABLED, 'started_at': None, 'finished_at': None, 'steps': {}}
+_state_lock = threading.Lock()
+
+
+def _record_step(name: str, started: float, error: Exception = None):
+    result = {'ms': round((time.perf_counter() - started) * 1000, 1)}
+    if error is not None:
+        logger.warning(f"Warm-up step {name} failed: {str(error)}")
+        result['error'] = str(error)
+    with _state_lock:
+        _state['steps'][name] = result
+
+
+def _run_step(name: str, step):
+    started = time.perf_counter()
+    try:
+        step()
+    except Exception as e:
+        _record_step(name, started, e)
+    else:
+        _record_step(name, started)
+
+
+async def _run_step_async(name: str, step):
+    started = time.perf_counter()
+    try:
+        await step()
+    except Exception as e:
+        _record_step(name, started, e)
+    else:
+        _record_step(name, started)
+
+
+def _check_monday_body(body: dict):
+    if body.get('errors'):
+        raise RuntimeError(f"Monday.com answered with errors: {body['errors']}")
+
+
+def _warm_openai():
+    from model_clients import check_openai_readiness
+    # Builds the client and opens its first connection; the result is the first readiness too
+    result = check_openai_readiness()
+    if result['status'] != 'ready':
+        raise RuntimeError(result['error'])
+
+
+def _warm_monday():
+    from monday_client import get_monday_client
+    _check_monday_body(get_monday_client(settings.monday_api_key).execute("query { me { id } }"))
+
+
+async def _warm_openai_async():
+    from model_clients import get_async_openai_client
+    # Created in a thread: the deferred import and the SSL context take long enough to delay webhook acks
+    client = await asyncio.to_thread(get_async_openai_client)
+    await client.models.list()
+
+
+async def _warm_monday_async():
+    from monday_client import get_async_monday_client
+    client = await asyncio.to_thread(get_async_monday_client, settings.monday_api_key)
+    _check_monday_body(await client.execute("query { me { id } }"))
+
+
+def _warm_prompts():
+    from board_config import get_board_registry
+    from model_clients import load_system_instructions
+    from prompt_builder import count_tokens
+    registry = get_board_registry()
+    load_system_instructions(settings.system_instructions_path)
+    for board_id in registry.stats()['boards']:
+        load_system_instructions(registry.get(board_id).system_instructions_path)
+    count_tokens('')
+
+
+def _warm_boards():
+    from board_schema import get_board_schema
+    for board_id in WARMUP_BOARD_IDS:
+        get_board_schema(board_id, settings.monday_api_key)
+
+
+def _begin() -> float:
+    with _state_lock:
+        _state.update(ready=False, started_at=time.time(), finished_at=None, steps={})
+    return time.perf_counter()
+
+
+def _finish(started: float):
+    with _state_lock:
+        _state.update(ready=True, finished_at=time.time())
+        failed = [name for name, step in _state['steps'].items() if 'error' in step]
+    logger.info(f"Worker {os.getpid()} warmed up in {time.perf_counter() - started:.1f}s"
+                + (f", failed steps: {', '.join(failed)}" if failed else ""))
+
+
+def warm_up():
+    """Run every warm-up step in this thread, then mark the worker ready."""
+    started = _begin()
+    _run_step('prompts', _warm_prompts)
+    _run_step('openai', _warm_openai)
+    _run_step('monday', _warm_monday)
+    if WARMUP_BOARD_IDS:
+        _run_step('board_schemas', _warm_boards)
+    _finish(started)
+
+
+def start_warm_up():
+    """Warm up in a background thread; the worker accepts connections meanwhile and /health says when it is done."""
+    if not WARMUP_ENABLED:
+        return
+    with _state_lock:
+        _state['ready'] = False
+    threading.Thread(target=warm_up, name="warm-up", daemon=True).start()
+
+
+async def warm_up_async():
+    """warm_up for the ASGI app: the async clients, with the blocking steps in a thread."""
+    if not WARMUP_ENABLED:
+        return
+    started = _begin()
+    await _run_step_async('prompts', lambda: asyncio.to_thread(_warm_prompts))
+    # Both connections are opened at the same time
+    await asyncio.gather(_run_step_async('openai', _warm_openai_async), _run_step_async('monday', _warm_monday_async))
+    if WARMUP_BOARD_IDS:
+        await _run_step_async('board_schemas', lambda: asyncio.to_thread(_warm_boards))
+    _finish(started)
+
+
+def is_ready() -> bool:
+    with _state_lock:
+        return _state['ready']
+
+
+def warmup_stats() -> dict:
+    with _state_lock:
+        return {
+            'ready': _state['ready'],
+            'started_at': _state['started_at'],
+            'finished_at': _state['finished_at'],
+            'steps': {name: dict(step) for name, step in _state['steps'].items()},
+        }
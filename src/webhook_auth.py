@@ -0,0 +1,118 @@
+"""
+Checks that a webhook request really comes from Monday.com, shared by the Flask app
+(app.py) and the ASGI app (asgi_app.py). Monday.com's address ranges are the
+"monday_ip_ranges" of the board config (board_config.py).
+
+check_webhook_request() only looks at the client address and the headers, so a request
+that is turned away costs no body read, JSON parse or queue lookup:
+- the client address, taken from X-Forwarded-For behind TRUSTED_PROXY_COUNT proxies the
+  way werkzeug's ProxyFix does, must be in Monday.com's ranges (the answer per address is
+  cached until the board config is reloaded);
+- the declared body must not be larger than WEBHOOK_MAX_BYTES;
+- with MONDAY_SIGNING_SECRET set, the Authorization header must be a JWT signed with the
+  app's signing secret (HS256) that has not expired, with MONDAY_JWT_AUDIENCE as its
+  audience when that is set. The secret is read once, with the other settings.
+
+The webhook body itself is read at most WEBHOOK_MAX_BYTES far (a bounded read in both apps),
+also when no Content-Length is sent. Monday.com's URL verification
+(a body of just {"challenge": "..."}) is not documented to carry the JWT, so a request that
+fails only the signature check is still answered when its body is such a challenge: it has
+passed the address and size checks and echoing the challenge reveals nothing.
+"""
+import logging
+import os
+from functools import lru_cache
+from ipaddress import ip_address
+
+from board_config import get_board_registry
+from config import settings
+from telemetry import SAMPLED
+
+logger = logging.getLogger(__name__)
+
+# Proxies in front of the app (nginx) whose X-Forwarded-For entries are trusted
+TRUSTED_PROXY_COUNT = int(os.getenv('TRUSTED_PROXY_COUNT', 1))
+WEBHOOK_MAX_BYTES = int(os.getenv('WEBHOOK_MAX_BYTES', 256 * 1024))
+MONDAY_JWT_AUDIENCE = os.getenv('MONDAY_JWT_AUDIENCE') or None
+
+# (status code, error) of a rejected request
+UNAUTHORIZED_IP = (403, 'Unauthorized')
+TOO_LARGE = (413, 'Request body too large')
+INVALID_SIGNATURE = (401, 'Invalid signature')
+
+_jwt = None
+
+
+def client_address(forwarded_for: str, peer: str, trusted_proxies: int = TRUSTED_PROXY_COUNT) -> str:
+    """
+    The client's address behind trusted_proxies proxies: each proxy appends the address it
+    got the request from, so the client is that many entries from the end of the list.
+    Without the header, or with fewer entries than proxies, it is the connection's peer.
+    """
+    if trusted_proxies and forwarded_for:
+        hops = [hop.strip() for hop in forwarded_for.split(',')]
+        if len(hops) >= trusted_proxies:
+            return hops[-trusted_proxies]
+    return peer
+
+
+@lru_cache(maxsize=4096)
+def _is_monday_ip(client_ip: str, networks: tuple) -> bool:
+    try:
+        address = ip_address(client_ip)
+    except ValueError:
+        logger.info(f"Malformed client IP: {client_ip}", extra=SAMPLED)
+        return False
+    return any(address in network for network in networks)
+
+
+def is_monday_ip(client_ip: str) -> bool:
+    """Whether the address is in one of Monday.com's ranges (False for a malformed address)"""
+    return _is_monday_ip(client_ip or '', get_board_registry().monday_networks())
+
+
+def _jwt_module():
+    # PyJWT is only needed when MONDAY_SIGNING_SECRET is set; imported on first use
+    global _jwt
+    if _jwt is None:
+        import jwt
+        _jwt = jwt
+    return _jwt
+
+
+def verify_monday_jwt(authorization: str, secret: str = None):
+    """The claims of Monday.com's signed Authorization header, or None when it is missing or not valid."""
+    secret = secret or settings.monday_signing_secret
+    if not authorization:
+        return None
+    token = authorization[7:] if authorization.startswith('Bearer ') else authorization
+    jwt = _jwt_module()
+    try:
+        return jwt.decode(token, secret, algorithms=['HS256'], audience=MONDAY_JWT_AUDIENCE,
+                          options={'verify_aud': MONDAY_JWT_AUDIENCE is not None})
+    except jwt.InvalidTokenError as e:
+        logger.info(f"Rejected webhook signature: {str(e)}", extra=SAMPLED)
+        return None
+
+
+def is_challenge(data) -> bool:
+    """Whether a parsed webhook body is Monday.com's URL verification, {"challenge": "<string>"}"""
+    return isinstance(data, dict) and set(data) == {'challenge'} and isinstance(data['challenge'], str)
+
+
+def check_webhook_request(client_ip: str, authorization: str = None, content_length: int = None):
+    """
+    (status code, error) when the request must be rejected, None when it may be processed.
+    Reads nothing but the client address and headers; INVALID_SIGNATURE is checked last, so
+    a request rejected with it may still be a challenge (see is_challenge).
+    """
+    if not is_monday_ip(client_ip):
+        # Sampled: a scan should not cost a log line per request
+        logger.info(f"Request from unauthorized IP: {client_ip}", extra=SAMPLED)
+        return UNAUTHORIZED_IP
+    if content_length is not None and content_length > WEBHOOK_MAX_BYTES:
+        logger.info(f"Webhook body of {content_length} bytes from {client_ip} rejected", extra=SAMPLED)
+        return TOO_LARGE
+    if settings.monday_signing_secret and verify_monday_jwt(authorization) is None:
+        return INVALID_SIGNATURE
+    return None
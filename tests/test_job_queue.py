@@ -0,0 +1,43 @@
+"""A job that never reaches fail() (its worker died) must not be reclaimed forever."""
+import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src'))
+
+import job_queue  # noqa: E402
+from job_queue import FAILED, RUNNING, JobQueue  # noqa: E402
+
+
+def expire_lease(queue, job_id):
+    queue._conn().execute("UPDATE jobs SET lease_until = 0 WHERE id = ?", (job_id,))
+
+
+def test_expired_lease_on_last_attempt_fails_the_job(tmp_path, monkeypatch):
+    monkeypatch.setattr(job_queue, 'JOB_DEBOUNCE_SECONDS', 0)
+    queue = JobQueue(tmp_path / 'jobs.db', max_attempts=2)
+    job_id, _ = queue.enqueue('42')
+
+    for attempt in (1, 2):
+        job = queue.claim()
+        assert (job['id'], job['attempts']) == (job_id, attempt)
+        expire_lease(queue, job_id)
+
+    assert queue.claim() is None
+    job = queue.get(job_id)
+    assert job['status'] == FAILED
+    assert job['attempts'] == 2
+
+    # The item is no longer blocked by the dead job
+    new_job_id, _ = queue.enqueue('42')
+    assert queue.claim()['id'] == new_job_id
+
+
+def test_expired_lease_with_attempts_left_is_claimed_again(tmp_path, monkeypatch):
+    monkeypatch.setattr(job_queue, 'JOB_DEBOUNCE_SECONDS', 0)
+    queue = JobQueue(tmp_path / 'jobs.db', max_attempts=3)
+    job_id, _ = queue.enqueue('42')
+    queue.claim()
+    expire_lease(queue, job_id)
+
+    job = queue.claim()
+    assert (job['id'], job['attempts'], job['status']) == (job_id, 2, RUNNING)
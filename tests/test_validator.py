@@ -0,0 +1,69 @@
+"""The verification call must show the model the email it is checking, next to the Q&A."""
+import os
+import sys
+from types import SimpleNamespace
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src'))
+
+import validator  # noqa: E402
+
+QA = "question: how are you doing recently? answer: I am doing well"
+EMAIL = "Dear lender, our borrower reports they are doing well."
+
+
+class FakeCompletions:
+    def __init__(self, verdicts):
+        self.verdicts = list(verdicts)
+        self.requests = []
+
+    def parse(self, model, messages, response_format):
+        self.requests.append({'model': model, 'messages': messages})
+        return SimpleNamespace(
+            choices=[SimpleNamespace(message=SimpleNamespace(parsed=response_format(**self.verdicts.pop(0))))],
+            usage=None,
+        )
+
+
+def fake_client(monkeypatch, *verdicts):
+    completions = FakeCompletions(verdicts)
+    client = SimpleNamespace(beta=SimpleNamespace(chat=SimpleNamespace(completions=completions)))
+    monkeypatch.setattr(validator, 'get_openai_client', lambda: client)
+    return completions
+
+
+def user_content(request):
+    return next(message['content'] for message in request['messages'] if message['role'] == 'user')
+
+
+def test_verification_messages_carry_the_email():
+    content = validator.verificationMessages(QA, EMAIL)[-1]['content']
+    assert QA in content
+    assert EMAIL in content
+
+
+def test_verification_request_includes_the_email(monkeypatch):
+    monkeypatch.setattr(validator, 'escalation_enabled', lambda: False)
+    completions = fake_client(monkeypatch, {'issueDesc': '', 'isVerified': True})
+
+    results, _ = validator.mailVerifedWithUsage(QA, EMAIL)
+
+    assert results.isVerified
+    assert len(completions.requests) == 1
+    assert QA in user_content(completions.requests[0])
+    assert EMAIL in user_content(completions.requests[0])
+
+
+def test_escalated_request_includes_the_email(monkeypatch):
+    monkeypatch.setattr(validator, 'escalation_enabled', lambda: True)
+    completions = fake_client(
+        monkeypatch,
+        {'issueDesc': 'unsure', 'isVerified': False, 'confidence': 0.1},
+        {'issueDesc': '', 'isVerified': True},
+    )
+
+    results, _ = validator.mailVerifedWithUsage(QA, EMAIL)
+
+    assert results.isVerified
+    assert [request['model'] for request in completions.requests] == [validator.VERIFY_MODEL,
+                                                                       validator.VERIFY_ESCALATION_MODEL]
+    assert all(EMAIL in user_content(request) for request in completions.requests)